@@ -0,0 +1,325 @@
+import json
+import os
+import sys
+import csv
+import glob
+import time
+import random
+import numpy as np
+from tqdm import tqdm
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+import argparse
+from annotation_views import materialize
+from validate_coco import validate_coco_content
+import bboxes_to_centerpoints_human_error as human_error
+import bboxes_to_centerpoints_geo_error as geo_error
+
+PIPELINES = ['human_error', 'geo_error']
+SUMMARY_FIELDS = ['file', 'status', 'images', 'annotations', 'categories', 'read_s', 'process_s', 'write_s',
+                  'total_s', 'outputs', 'message']
+SIZES_NAME = 'category_sizes.json'
+
+
+def find_coco_files(path, exclude = []):
+    '''
+    PURPOSE: List the coco files to process from a directory or a glob,
+             skipping the outputs of earlier runs
+    IN:
+     - path: str, directory (its *.json files are used) or glob pattern
+     - exclude: list of strs, paths of this run's own outputs to skip as well
+    OUT:
+     - fps: sorted list of strs
+    '''
+    if os.path.isdir(path):
+        path = os.path.join(path, '*.json')
+    exclude = set(os.path.abspath(fp) for fp in exclude)
+    fps = [fp for fp in glob.glob(path) if '_cp_' not in os.path.basename(fp) 
+           and os.path.basename(fp) != SIZES_NAME and os.path.abspath(fp) not in exclude]
+    return sorted(fps)
+
+def _output_path(fp, out_dir, suffix):
+    base = os.path.basename(fp).split('.')[0] + suffix
+    return os.path.join(out_dir or os.path.dirname(fp), base)
+
+def output_dirs(fps, out_dir = None):
+    '''
+    PURPOSE: Pick where each file's outputs go. Under out_dir, the inputs'
+             subdirectories below their common root are mirrored, so inputs
+             sharing a basename (regions/*/train.json) don't overwrite each
+             other
+    IN:
+     - fps: list of strs, paths to coco annotations
+     - out_dir: str, optional, otherwise outputs go next to each input
+    OUT:
+     - dirs: list of strs, one output directory per file
+    '''
+    if not out_dir:
+        return [os.path.dirname(fp) for fp in fps]
+    parents = [os.path.dirname(os.path.abspath(fp)) for fp in fps]
+    root = os.path.commonpath(parents) if parents else ''
+    return [os.path.normpath(os.path.join(out_dir, os.path.relpath(p, root))) for p in parents]
+
+def check_output_collisions(fps, dirs):
+    '''
+    PURPOSE: Fail before any work starts if two inputs would write the same
+             outputs, e.g. a.json and a.v2.json in one directory
+    IN:
+     - fps: list of strs, paths to coco annotations
+     - dirs: list of strs, from output_dirs
+    '''
+    seen = {}
+    for fp, d in zip(fps, dirs):
+        stem = os.path.abspath(_output_path(fp, d, ''))
+        if stem in seen:
+            raise ValueError(f'{seen[stem]} and {fp} would write the same outputs ({stem}_cp_*.json)')
+        seen[stem] = fp
+
+def _quiet_worker():
+    # many files at once would interleave their progress bars
+    sys.stderr = open(os.devnull, 'w')
+
+def _size_sums(fp):
+    '''
+    PURPOSE: Per file part of the aggregated category sizes. Files which can't
+             be read or fail validation are left out rather than stopping the
+             batch, process_file records them
+    OUT:
+     - sums: dict, category name to [sum of sizes in meters, count]
+     - gsd_sum: [sum of image GSDs, count]
+     - message: str, why the file was left out, or None
+    '''
+    try:
+        with open(fp, 'r') as f:
+            content = json.load(f)
+        # the shared sizes and GSD stand in for any this file lacks
+        report = validate_coco_content(content, avg_img_gsd = 1)
+        if report['errors']:
+            return {}, [0.0, 0], '; '.join(report['errors'])
+        estimates = human_error.estimate_category_size_content(content)
+        sums = {v['name']: [float(np.sum(v['sizes'])), len(v['sizes'])] for v in estimates.values()}
+        gsds = [g for g in human_error.image_gsd_lookup(content).values() if g != None]
+    except Exception as e:
+        return {}, [0.0, 0], f'{type(e).__name__}: {e}'
+    return sums, [float(np.sum(gsds)), len(gsds)], None
+
+def aggregate_category_sizes(fps, workers = None):
+    '''
+    PURPOSE: Average category sizes, by category name, and the image GSD over
+             every annotation of every file, reading files in parallel
+    IN:
+     - fps: list of strs, paths to coco annotations
+     - workers: int, optional, number of worker processes
+    OUT:
+     - stats: dict with 'categories' (name to average size in meters and
+              annotation count), 'avg_gsd' and 'skipped' (path to the reason
+              for each file left out)
+    '''
+    totals = {}
+    gsd_total = [0.0, 0]
+    skipped = {}
+    with ProcessPoolExecutor(max_workers = workers, initializer = _quiet_worker) as pool:
+        for fp, (sums, gsd_sum, message) in zip(fps, tqdm(pool.map(_size_sums, fps), total = len(fps), desc = 'Aggregating Category Sizes')):
+            if message != None:
+                skipped[fp] = message
+                continue
+            for name, (s, n) in sums.items():
+                t = totals.setdefault(name, [0.0, 0])
+                t[0] += s
+                t[1] += n
+            gsd_total[0] += gsd_sum[0]
+            gsd_total[1] += gsd_sum[1]
+
+    categories = {name: {'average': s / n if n else None, 'count': n} for name, (s, n) in totals.items()}
+    avg_gsd = gsd_total[0] / gsd_total[1] if gsd_total[1] else None
+    return {'categories': categories, 'avg_gsd': avg_gsd, 'skipped': skipped}
+
+def process_file(fp, pipeline, params, seed = None, shared = None, out_dir = None):
+    '''
+    PURPOSE: Run one pipeline on one coco file, timing each stage. Category
+             sizes are written to the output files; the input isn't rewritten
+    IN:
+     - fp: str, path to coco annotations
+     - pipeline: str, 'human_error' (centerpoint jitter then square bboxes)
+                 or 'geo_error' (per image shift in meters then square bboxes)
+     - params: dict, 'max_shift' for human_error, 'shift_meters' and
+               'shift_percent' for geo_error, and optionally 'avg_gsd'
+     - seed: int, optional, seed for this file's random shifts
+     - shared: dict, optional, from aggregate_category_sizes, used instead of
+               this file's own category sizes and average GSD
+     - out_dir: str, optional, directory to write this file's outputs to,
+                otherwise next to the input
+    OUT:
+     - row: dict, one line of the summary, see SUMMARY_FIELDS
+    '''
+    row = {'file': fp, 'status': 'ok', 'outputs': '', 'message': ''}
+    start = time.time()
+    try:
+        with open(fp, 'r') as f:
+            content = json.load(f)
+        row['read_s'] = time.time() - start
+        row.update(images = len(content.get('images', [])), annotations = len(content.get('annotations', [])),
+                   categories = len(content.get('categories', [])))
+
+        avg_gsd = params.get('avg_gsd') or (shared or {}).get('avg_gsd')
+        report = validate_coco_content(content, avg_img_gsd = avg_gsd, require_size_estimates = shared == None)
+        if report['errors']:
+            row.update(status = 'invalid', message = '; '.join(report['errors']))
+            return row
+
+        process_start = time.time()
+        gsd_lookup = human_error.image_gsd_lookup(content)
+        if shared != None:
+            estimates = {c['id']: {'average': shared['categories'].get(c['name'], {}).get('average')} for c in content['categories']}
+        else:
+            estimates = human_error.estimate_category_size_content(content, gsd_lookup)
+        if avg_gsd == None:
+            avg_gsd = human_error.get_average_image_gsd_content(content)
+        content['categories'] = human_error.categories_with_sizes(content['categories'], estimates)
+
+        if seed != None:
+            random.seed(seed)
+        if pipeline == 'human_error':
+            suffix = f'_cp_{params["max_shift"]}'
+            cp = human_error.convert_anns_centerpoint_content(content, params['max_shift'])
+            sq = human_error.average_bboxes_from_centerpoints_content(cp, avg_gsd, gsd_lookup = gsd_lookup)
+        else:
+            suffix = f'_cp_{params["shift_meters"]}_meters_{params["shift_percent"]}_percent'
+            cp = geo_error.convert_anns_centerpoint_meters_content(content, avg_gsd, shift_meters = params['shift_meters'],
+                                                                   percentage_shift = params['shift_percent'],
+                                                                   random_amount = True, gsd_lookup = gsd_lookup)
+            sq = geo_error.average_bboxes_from_centerpoints_content(cp, avg_gsd, gsd_lookup = gsd_lookup)
+        row['process_s'] = time.time() - process_start
+
+        write_start = time.time()
+        outputs = [_output_path(fp, out_dir, suffix + '.json'), _output_path(fp, out_dir, suffix + '_square.json')]
+        for out_fp, out_content in zip(outputs, [cp, sq]):
+            with open(out_fp + '.part', 'w') as f:
+                json.dump(out_content, f, default = materialize)
+            os.replace(out_fp + '.part', out_fp)
+        row['write_s'] = time.time() - write_start
+        row['outputs'] = ';'.join(outputs)
+    except Exception as e:
+        row.update(status = 'error', message = f'{type(e).__name__}: {e}')
+    finally:
+        row['total_s'] = time.time() - start
+    return row
+
+def process_batch(fps, pipeline, params, workers = None, seed = None, aggregate_sizes = False, out_dir = None,
+                  summary_fp = None):
+    '''
+    PURPOSE: Run a pipeline on many coco files with a bounded process pool.
+             Each worker reads, transforms and writes its own file, so reads
+             and writes of some files overlap the CPU work on others, and only
+             a couple of files per worker are in flight at once
+    IN:
+     - fps: list of strs, paths to coco annotations
+     - pipeline, params: see process_file
+     - out_dir: str, optional, where to write, mirroring the inputs'
+                subdirectories, otherwise next to each input
+     - workers: int, optional, number of worker processes
+     - seed: int, optional, seed for the random shifts, offset for each file
+     - aggregate_sizes: boolean, use category sizes and a fallback GSD
+                        averaged over all the files instead of per file
+     - summary_fp: str, optional, where to write the per file summary csv
+    OUT:
+     - rows: list of summary dicts, in the order of fps
+     - shared: dict, aggregated sizes from aggregate_category_sizes, or None
+    '''
+    workers = workers or os.cpu_count() or 1
+    dirs = output_dirs(fps, out_dir)
+    check_output_collisions(fps, dirs)
+    if out_dir:
+        for d in set(dirs):
+            os.makedirs(d, exist_ok = True)
+
+    shared = aggregate_category_sizes(fps, workers) if aggregate_sizes else None
+
+    rows = {}
+    pending = {}
+    todo = list(enumerate(fps))
+    with ProcessPoolExecutor(max_workers = workers, initializer = _quiet_worker) as pool:
+        with tqdm(total = len(fps), desc = 'Processing Files') as bar:
+            while todo or pending:
+                # keep the pool busy without loading every file at once
+                while todo and len(pending) < 2 * workers:
+                    n, fp = todo.pop(0)
+                    sd = seed + n if seed != None else None
+                    pending[pool.submit(process_file, fp, pipeline, params, sd, shared, dirs[n])] = fp
+                done, _ = wait(pending, return_when = FIRST_COMPLETED)
+                for future in done:
+                    rows[pending.pop(future)] = future.result()
+                    bar.update(1)
+
+    rows = [rows[fp] for fp in fps]
+    if summary_fp:
+        write_summary(summary_fp, rows)
+    return rows, shared
+
+def write_summary(summary_fp, rows):
+    '''
+    IN:
+     - summary_fp: str, csv path
+     - rows: list of dicts from process_file
+    '''
+    with open(summary_fp, 'w', newline = '') as f:
+        writer = csv.DictWriter(f, fieldnames = SUMMARY_FIELDS)
+        writer.writeheader()
+        for row in rows:
+            writer.writerow({k: round(v, 3) if isinstance(v, float) else v for k, v in row.items()})
+
+
+if __name__ == "__main__":
+
+    # Initialize parser
+    parser = argparse.ArgumentParser()
+    # Adding optional argument
+    parser.add_argument("-input", "--input", help = "str, directory of coco files, or a glob such as 'regions/*/train.json'")
+    parser.add_argument("-pipeline", "--pipeline", help = "Which script's pipeline to run on each file", choices = PIPELINES, default = 'human_error')
+    parser.add_argument("-max_shift", "--max_shift", help = "int, maximum centerpoint jitter in pixels for human_error", required = False, default = 5)
+    parser.add_argument("-shift_meters", "--shift_meters", help = "int, shift in meters for geo_error", required = False, default = 5)
+    parser.add_argument("-shift_percent", "--shift_percent", help = "[0-100] percentage of images to shift for geo_error", required = False, default = 100)
+    parser.add_argument("-avg_gsd", "--avg_gsd", help = "Average image GSD to use where an image doesn't have one", required = False)
+    parser.add_argument("-aggregate_sizes", "--aggregate_sizes", help = "Use category sizes averaged over all the files instead of per file", action = "store_true")
+    parser.add_argument("-workers", "--workers", help = "int, number of worker processes", required = False)
+    parser.add_argument("-seed", "--seed", help = "int, seed for the random shifts, offset for each file", required = False)
+    parser.add_argument("-out_dir", "--out_dir", help = "str, where to write outputs, otherwise next to each input", required = False)
+    parser.add_argument("-summary_fp", "--summary_fp", help = "str, per file summary csv, defaults to batch_summary.csv in out_dir or the current directory", required = False)
+
+    # Read arguments from command line
+    args = parser.parse_args()
+
+    summary_fp = args.summary_fp or os.path.join(args.out_dir or '.', 'batch_summary.csv')
+    sizes_fp = os.path.join(os.path.dirname(summary_fp), SIZES_NAME)
+
+    fps = find_coco_files(args.input, exclude = [summary_fp, sizes_fp])
+    if not fps:
+        print(f'No coco files found at {args.input}')
+        sys.exit(1)
+    print(f'Processing {len(fps)} files')
+
+    params = {'max_shift': int(args.max_shift), 'shift_meters': int(args.shift_meters),
+              'shift_percent': int(args.shift_percent), 'avg_gsd': float(args.avg_gsd) if args.avg_gsd else None}
+
+    try:
+        rows, shared = process_batch(fps, args.pipeline, params, workers = int(args.workers) if args.workers else None,
+                                     seed = int(args.seed) if args.seed else None, aggregate_sizes = args.aggregate_sizes,
+                                     out_dir = args.out_dir, summary_fp = summary_fp)
+    except ValueError as e:
+        print(e)
+        sys.exit(1)
+
+    if shared != None:
+        with open(sizes_fp, 'w') as f:
+            json.dump(shared, f, indent = 3)
+        print('Aggregated category sizes:')
+        for name, v in shared['categories'].items():
+            avg = round(v['average'], 1) if v['average'] != None else None
+            print(f'{name}: {avg} meters over {v["count"]} annotations')
+        for fp, message in shared['skipped'].items():
+            print(f' Left out of the sizes: {fp}: {message}')
+
+    failed = [r for r in rows if r['status'] != 'ok']
+    print(f'{len(rows) - len(failed)} of {len(rows)} files processed, summary in {summary_fp}')
+    for r in failed:
+        print(f' {r["status"].upper()}: {r["file"]}: {r["message"]}')
+    sys.exit(1 if failed else 0)
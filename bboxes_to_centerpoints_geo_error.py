@@ -4,6 +4,14 @@ from tqdm import tqdm
 import numpy as np
 import random
 import argparse
+import sys
+import time
+from annotation_views import AnnotationView, materialize
+from validate_coco import validate_coco
+from run_planner import plan_geo_error, print_plan, record_throughput
+from image_metadata import image_metadata, gsd_lookup_with_metadata, image_bounds, clip_bbox
+from image_partitions import ImagePartitioner, iter_coco_annotations, load_coco_head, require_ijson, write_annotation_variants
+from image_sampling import image_shift_draws, select_shifts, STRATA
 
 
 def anns_on_image(im_id, contents):
@@ -26,7 +34,21 @@ def anns_on_image(im_id, contents):
     
     return on_image
 
-def average_bboxes_from_centerpoints(anns_path, avg_img_gsd = None):
+def anns_by_image(contents):
+    '''
+    PURPOSE: Group every annotation by image in one pass, instead of scanning
+             all annotations for each image with anns_on_image
+    IN: 
+        - contents: coco gt json contents
+    OUT:
+        - image_anns: dict, image id to the list of annotations on that image
+    '''
+    image_anns = {}
+    for a in contents['annotations']:
+        image_anns.setdefault(a['image_id'], []).append(a)
+    return image_anns
+
+def average_bboxes_from_centerpoints(anns_path, avg_img_gsd = None, img_fp = None, clip = False, stream = False):
     '''
     PURPOSE: After finding average object sizes, and using bounding boxes to add
              centerpoints (all to a coco annotation file), replace bounding boxes 
@@ -36,52 +58,113 @@ def average_bboxes_from_centerpoints(anns_path, avg_img_gsd = None):
      - avg_img_gsd: float or int, optional, average image size in dataset, 
                     which will be used as a default if an image doesn't have 
                     a noted GSD. 
+     - img_fp: str, optional, image directory. GSDs missing from the file are 
+               read from the image headers where possible, see image_metadata
+     - clip: boolean, whether to clip the square bboxes to the image bounds
+     - stream: boolean, stream the annotations with ijson, one at a time,
+               instead of loading the file whole
     OUT:
      - new_anns_path: str, path to new annotation file
     '''
     
     # open annotation file
-    with open(anns_path, 'r') as f:
-        content = json.load(f)
+    if stream:
+        content = load_coco_head(anns_path)
+    else:
+        with open(anns_path, 'r') as f:
+            content = json.load(f)
+
+    gsd_lookup = image_gsd_lookup(content)
+    meta = {}
+    if img_fp:
+        meta = image_metadata(content, img_fp)
+        gsd_lookup = gsd_lookup_with_metadata(gsd_lookup, meta)
+    bounds = image_bounds(content, meta) if clip else None
+
+    new_anns_path = anns_path.split('.')[0] + '_square.json'
+
+    if stream:
+        if avg_img_gsd == None:
+            avg_img_gsd = get_average_image_gsd_content(content, gsd_lookup)
+        squares = square_annotations(iter_coco_annotations(anns_path), category_size_lookup(content), gsd_lookup, 
+                                     avg_img_gsd, bounds)
+        write_annotation_variants(content, [new_anns_path], ([a] for a in squares))
+        return new_anns_path
+
+    content = average_bboxes_from_centerpoints_content(content, avg_img_gsd, gsd_lookup = gsd_lookup, bounds = bounds)
+
+    if os.path.exists(new_anns_path):
+        os.remove(new_anns_path)
+    
+    with open(new_anns_path, 'w') as f:
+        json.dump(content, f, default = materialize)
+
+    return new_anns_path
+
+def average_bboxes_from_centerpoints_content(content, avg_img_gsd = None, gsd_lookup = None, bounds = None):
+    '''
+    PURPOSE: In-memory version of average_bboxes_from_centerpoints. The input
+             contents are left untouched
+    IN:
+     - content: dict, coco contents with centerpoints and category sizes
+     - avg_img_gsd: float or int, optional, GSD used where an image has none
+     - gsd_lookup: dict, optional, image id to GSD from image_gsd_lookup
+     - bounds: dict, optional, image id to (width, height) from image_bounds,
+               square bboxes are clipped to these
+    OUT:
+     - new_content: dict, coco contents with square bboxes
+    '''
 
     # if necessary, get average gsd
+    if gsd_lookup == None:
+        gsd_lookup = image_gsd_lookup(content)
     if avg_img_gsd == None:
-        avg_img_gsd = get_average_image_gsd(anns_path)
+        avg_img_gsd = get_average_image_gsd_content(content, gsd_lookup)
+    size_lookup = category_size_lookup(content)
     
     # pull out key sections of file
     anns = content['annotations']
 
     # adjust bounding boxes based on centerpoints and object sizes
-    new_annotations = []
+    new_annotations = list(square_annotations(anns, size_lookup, gsd_lookup, avg_img_gsd, bounds))
+
+    new_content = dict(content)
+    new_content['annotations'] = new_annotations
+
+    return new_content
+
+def square_annotations(anns, size_lookup, gsd_lookup, avg_img_gsd, bounds = None):
+    '''
+    PURPOSE: The square bbox of each annotation, one at a time, so they can be
+             written as they're made
+    IN:
+     - anns: iterable of annotations with object centers
+     - size_lookup: dict, from category_size_lookup
+     - gsd_lookup: dict, from image_gsd_lookup
+     - avg_img_gsd: float or int, GSD used where an image has none
+     - bounds: dict, optional, see average_bboxes_from_centerpoints_content
+    OUT: generator of annotations with square bboxes
+    '''
     for a in tqdm(anns, desc = 'Creating Square Bboxes'):
-        new_a = a.copy()
+        new_a = AnnotationView(a)
         [x,y] = a['object_center']
-        obj_size = get_obj_size_from_id(a['category_id'], content)
-        im_gsd = get_im_gsd_from_id(a['image_id'], content)
-        if im_gsd != None:
-            ob_h_w = int(obj_size/im_gsd)
-        else:
-            try:
+        obj_size = size_lookup.get(a['category_id'])
+        im_gsd = gsd_lookup.get(a['image_id'])
+        try:
+            if im_gsd != None:
+                ob_h_w = int(obj_size/im_gsd)
+            else:
                 ob_h_w = int(obj_size/avg_img_gsd)
-            except:
-                print(f'object size is {obj_size} and the average gsd is {avg_img_gsd}')
+        except (TypeError, ValueError, ZeroDivisionError):
+            used_gsd = im_gsd if im_gsd != None else f'the average gsd {avg_img_gsd}'
+            raise ValueError(f'Cannot size annotation {a["id"]}: object size is {obj_size} and the gsd is {used_gsd}')
         square_bbox = [x - (ob_h_w/2), y - (ob_h_w/2), ob_h_w, ob_h_w]
+        if bounds != None and a['image_id'] in bounds:
+            square_bbox = clip_bbox(square_bbox, *bounds[a['image_id']])
         new_a['bbox'] = square_bbox
-        new_annotations.append(new_a)
-
-    content['annotations'] = new_annotations
-
-    new_anns_path = anns_path.split('.')[0] + '_square.json'
-
-    if os.path.exists(new_anns_path):
-        os.remove(new_anns_path)
-    
-    with open(new_anns_path, 'w') as f:
-        json.dump(content, f)
+        yield new_a
 
-    return new_anns_path
-
-def estimate_category_size(anns_path, write_out = False, matched_files = []):
+def estimate_category_size(anns_path, write_out = False, matched_files = [], img_fp = None, stream = False):
     '''
     PURPOSE: Get average sizes in meters for each object category in a 
              coco dataset and optionally add them to the file, with the option
@@ -91,14 +174,76 @@ def estimate_category_size(anns_path, write_out = False, matched_files = []):
      - write_out: boolean, whether or not to write the values into the coco file
      - matched_files : list of strs, paths to other files to write our average 
                        object sizes to
+     - img_fp: str, optional, image directory. GSDs missing from the file are 
+               read from the image headers where possible, see image_metadata
+     - stream: boolean, stream the annotations with ijson, one at a time,
+               instead of loading the files whole
     OUT:
      - estimates: dict, contains information about each category keyed to its id
     '''
 
     # open annotation file
-    with open(anns_path, 'r') as f:
-        content = json.load(f)
+    if stream:
+        content = load_coco_head(anns_path)
+    else:
+        with open(anns_path, 'r') as f:
+            content = json.load(f)
     
+    gsd_lookup = image_gsd_lookup(content)
+    if img_fp:
+        gsd_lookup = gsd_lookup_with_metadata(gsd_lookup, image_metadata(content, img_fp))
+    anns = iter_coco_annotations(anns_path) if stream else content['annotations']
+    estimates = estimate_category_size_content(dict(content, annotations = anns), gsd_lookup)
+
+    if write_out:
+        # the files are rewritten in place, so check before writing that every
+        # category they use got a size, rather than failing on it later
+        sized = set(k for k, v in estimates.items() if np.isfinite(v['average']))
+        anns = iter_coco_annotations(anns_path) if stream else content['annotations']
+        for fp, used in [(anns_path, set(a['category_id'] for a in anns))] + \
+                        [(fp, set(a['category_id'] for a in iter_coco_annotations(fp))) for fp in matched_files]:
+            unsized = used - sized
+            if unsized:
+                raise ValueError(f'{fp} uses categories whose size can\'t be estimated from {anns_path}: '
+                                 + ', '.join(str(c) for c in sorted(unsized, key = str)))
+
+        new_cats = categories_with_sizes(content['categories'], estimates)
+        content['categories'] = new_cats
+
+        if stream:
+            for fp in [anns_path] + matched_files:
+                head = load_coco_head(fp)
+                head['categories'] = new_cats
+                write_annotation_variants(head, [fp + '.part'], ([a] for a in iter_coco_annotations(fp)))
+                os.replace(fp + '.part', fp)
+            return estimates
+
+        os.remove(anns_path)
+
+        with open(anns_path, 'w') as f:
+            json.dump(content, f)
+        
+        for fp in matched_files:
+            with open(fp, 'r') as f:
+                f_contents = json.load(f)
+            f_contents['categories'] = new_cats
+            os.remove(fp)
+            with open(fp, 'w') as f:
+                json.dump(f_contents, f)
+    return estimates
+
+def estimate_category_size_content(content, gsd_lookup = None):
+    '''
+    PURPOSE: In-memory version of estimate_category_size, without writing
+    IN:
+     - content: dict, coco contents
+     - gsd_lookup: dict, optional, image id to GSD from image_gsd_lookup
+    OUT:
+     - estimates: dict, contains information about each category keyed to its id
+    '''
+    if gsd_lookup == None:
+        gsd_lookup = image_gsd_lookup(content)
+
     # pull out key sections of file
     cats = content['categories']
     anns = content['annotations']
@@ -114,7 +259,7 @@ def estimate_category_size(anns_path, write_out = False, matched_files = []):
 
         # get largest side of object
         size = max(bbox[2:3])
-        im_gsd = get_im_gsd_from_id(a['image_id'], content)
+        im_gsd = gsd_lookup.get(a['image_id'])
         if im_gsd != None:
           size_m = size*im_gsd
           estimates[a['category_id']]['sizes'].append(size_m)
@@ -124,46 +269,68 @@ def estimate_category_size(anns_path, write_out = False, matched_files = []):
         avg = np.mean(v['sizes'])
         estimates[k]['average'] = avg
 
-    new_cats = []
-    if write_out:
-
-        for c in cats:
-            new_c = c.copy()
-            new_c['average_size'] = estimates[c['id']]['average']
-            new_cats.append(new_c)
-        content['categories'] = new_cats
-
-        os.remove(anns_path)
-
-        with open(anns_path, 'w') as f:
-            json.dump(content, f)
-        
-        for fp in matched_files:
-            with open(fp, 'r') as f:
-                f_contents = json.load(f)
-            f_contents['categories'] = new_cats
-            os.remove(fp)
-            with open(fp, 'w') as f:
-                json.dump(f_contents, f)
     return estimates
 
+def categories_with_sizes(cats, estimates):
+    '''
+    IN:
+     - cats: list of coco category dicts
+     - estimates: dict, from estimate_category_size
+    OUT:
+     - new_cats: list of category dicts with 'average_size' added
+    '''
+    new_cats = []
+    for c in cats:
+        new_c = c.copy()
+        new_c['average_size'] = estimates[c['id']]['average']
+        new_cats.append(new_c)
+    return new_cats
+
 
-def get_average_image_gsd(anns_path):
+def get_average_image_gsd(anns_path, img_fp = None, stream = False):
     '''
     PURPOSE: Find the average GSD of the images in a coco ground truth file
     IN:
      - anns_path: str, path to coco annotation file
+     - img_fp: str, optional, image directory. GSDs missing from the file are 
+               read from the image headers where possible, see image_metadata
+     - stream: boolean, stream past the annotations with ijson instead of
+               loading the file whole
+    OUT:
+     - avg_img_gsd: float, average gsd of images in dataset
+    '''
+    if stream:
+        content = load_coco_head(anns_path)
+    else:
+        with open(anns_path, 'r') as f:
+            content = json.load(f)
+
+    gsd_lookup = None
+    if img_fp:
+        gsd_lookup = gsd_lookup_with_metadata(image_gsd_lookup(content), image_metadata(content, img_fp))
+    return get_average_image_gsd_content(content, gsd_lookup)
+
+def get_average_image_gsd_content(content, gsd_lookup = None):
+    '''
+    PURPOSE: In-memory version of get_average_image_gsd
+    IN:
+     - content: dict, coco contents
+     - gsd_lookup: dict, optional, image id to GSD, such as one with GSDs
+                   from the image headers from gsd_lookup_with_metadata,
+                   otherwise the file's own GSDs are averaged
     OUT:
      - avg_img_gsd: float, average gsd of images in dataset
     '''
-    with open(anns_path, 'r') as f:
-        content = json.load(f)
     images = content['images']
 
     gsd_vals = []
 
     for i in tqdm(images, desc = 'Finding Average Image GSD'):
-        if 'acquisition_data' in i.keys():
+        if gsd_lookup != None:
+            gsd_val = gsd_lookup.get(i['id'])
+            if gsd_val != None:
+                gsd_vals.append(gsd_val)
+        elif 'acquisition_data' in i.keys():
             gsd_val = i['acquisition_data']['GSD'][0]
             if gsd_val != None:
                 gsd_vals.append(gsd_val)
@@ -172,6 +339,37 @@ def get_average_image_gsd(anns_path):
 
     return avg_img_gsd
 
+def image_gsd_lookup(gt_content):
+    '''
+    PURPOSE: Index every image's GSD by id once, instead of searching the
+             image list for each annotation with get_im_gsd_from_id
+    IN:
+     - gt_content: the content from a coco ground truth file
+    OUT:
+     - lookup: dict, image id to GSD (or None if it isn't available)
+    '''
+    lookup = {}
+    for i in gt_content['images']:
+        if i['id'] in lookup:
+            continue
+        try:
+            lookup[i['id']] = i['acquisition_data']['GSD'][0]
+        except (KeyError, IndexError, TypeError):
+            lookup[i['id']] = None
+    return lookup
+
+def category_size_lookup(gt_content):
+    '''
+    IN:
+     - gt_content: the content from a coco ground truth file
+    OUT:
+     - lookup: dict, category id to average size (or None if it isn't recorded)
+    '''
+    lookup = {}
+    for c in gt_content['categories']:
+        lookup.setdefault(c['id'], c.get('average_size'))
+    return lookup
+
 def get_im_gsd_from_id(im_id, gt_content):
     '''
     PURPOSE: Get the GSD of an image based on its id in a coco file
@@ -252,7 +450,7 @@ def make_cat_ids_match(src_anns, match_anns):
     # Remap the annotations in match_anns
     new_annotations = []
     for a in match_gt['annotations']:
-        new_a = a.copy()
+        new_a = AnnotationView(a)
         new_a['category_id'] = cat_map[a['category_id']]
         new_annotations.append(new_a)
     
@@ -262,11 +460,12 @@ def make_cat_ids_match(src_anns, match_anns):
     # Save out a new file
     os.remove(match_anns)
     with open(match_anns, 'w') as f:
-        json.dump(match_gt, f)
+        json.dump(match_gt, f, default = materialize)
 
     return 
 
-def convert_anns_centerpoint_meters(anns_path, avg_img_gsd, shift_meters = 5, percentage_shift = 100, random_amount = False):
+def convert_anns_centerpoint_meters(anns_path, avg_img_gsd, shift_meters = 5, percentage_shift = 100, random_amount = False,
+                                    max_memory_mb = None, img_fp = None, seed = None, stratify = None, gsd_buckets = 4):
     '''
     PURPOSE: Convert an annotation file with image-oriented bounding boxes to 
              center point annotations instead
@@ -275,26 +474,172 @@ def convert_anns_centerpoint_meters(anns_path, avg_img_gsd, shift_meters = 5, pe
      - avg_img_gsd
      - shift_meters = 5
      - percentage_shift = 100
+     - max_memory_mb: int, optional, group the annotations by image out of 
+                      core within roughly this much memory, for files too 
+                      large to load or not ordered by image
+     - img_fp: str, optional, image directory. GSDs missing from the file are 
+               read from the image headers where possible, see image_metadata
+     - seed: int, optional, seed for a repeatable selection of shifted images
+     - stratify: list, optional, any of 'gsd' and 'category', select the
+                 shifted images evenly across GSD buckets and/or the images'
+                 most common category, see image_sampling
+     - gsd_buckets: int, number of GSD quantile buckets to stratify by
     OUT:
      - new_anns_path: str, path to new annotations
     '''
+    return convert_anns_centerpoint_meters_sweep(anns_path, avg_img_gsd, shift_meters = shift_meters, 
+                                                 percentages = [percentage_shift], random_amount = random_amount, 
+                                                 max_memory_mb = max_memory_mb, img_fp = img_fp, seed = seed, 
+                                                 stratify = stratify, gsd_buckets = gsd_buckets)[0]
+
+def convert_anns_centerpoint_meters_sweep(anns_path, avg_img_gsd, shift_meters = 5, percentages = [100], random_amount = False,
+                                          max_memory_mb = None, img_fp = None, seed = None, stratify = None, gsd_buckets = 4):
+    '''
+    PURPOSE: convert_anns_centerpoint_meters for several shift percentages,
+             loading the file once. With a seed or stratify, the images and
+             their shifts are drawn once for all percentages, so the images 
+             shifted at a lower percentage are a subset of those shifted at a 
+             higher one, and are shifted the same way in both
+    IN:
+     - percentages: list of ints, 0-100, one output file for each
+     - the rest: see convert_anns_centerpoint_meters
+    OUT:
+     - new_anns_paths: list of strs, paths to new annotations, one per percentage
+    '''
+    new_anns_paths = [anns_path.split('.')[0] + f'_cp_{shift_meters}_meters_{p}_percent.json' for p in percentages]
+    sampled = seed != None or bool(stratify)
+
+    if max_memory_mb:
+        require_ijson()
+        head = load_coco_head(anns_path)
+        gsd_lookup = image_gsd_lookup(head)
+        if img_fp:
+            gsd_lookup = gsd_lookup_with_metadata(gsd_lookup, image_metadata(head, img_fp))
+
+        draws = None
+        if sampled:
+            ann_image_ids = ann_category_ids = None
+            if stratify and 'category' in stratify:
+                pairs = [(a['image_id'], a['category_id']) for a in iter_coco_annotations(anns_path)]
+                ann_image_ids = [p[0] for p in pairs]
+                ann_category_ids = [p[1] for p in pairs]
+            draws = image_shift_draws(head['images'], gsd_lookup, avg_img_gsd, shift_meters = shift_meters, 
+                                      random_amount = random_amount, seed = seed, stratify = stratify, 
+                                      gsd_buckets = gsd_buckets, ann_image_ids = ann_image_ids, 
+                                      ann_category_ids = ann_category_ids)
+
+        with ImagePartitioner(max_memory_mb, expected_bytes = os.path.getsize(anns_path)) as parts:
+            parts.add_all(iter_coco_annotations(anns_path))
+            for percentage_shift, new_anns_path in zip(percentages, new_anns_paths):
+                shifts, _ = plan_image_shifts(head['images'], gsd_lookup, avg_img_gsd, shift_meters = shift_meters, 
+                                              percentage_shift = percentage_shift, random_amount = random_amount,
+                                              draws = draws)
+                new_anns = ([shift_annotation(a, shifts.get(im_id))]
+                            for im_id, anns in tqdm(parts.iter_groups(), desc = 'Shifting points by image') for a in anns)
+                write_annotation_variants(head, [new_anns_path], new_anns)
+
+        return new_anns_paths
 
     # open the annotation file
     with open(anns_path, 'r') as f:
         ann_contents = json.load(f)
         
-    # Pull out key section
-    images = ann_contents['images']
-    
+    gsd_lookup = image_gsd_lookup(ann_contents)
+    if img_fp:
+        gsd_lookup = gsd_lookup_with_metadata(gsd_lookup, image_metadata(ann_contents, img_fp))
+    image_anns = anns_by_image(ann_contents)
+
+    draws = None
+    if sampled:
+        ann_image_ids = ann_category_ids = None
+        if stratify and 'category' in stratify:
+            ann_image_ids = [a['image_id'] for a in ann_contents['annotations']]
+            ann_category_ids = [a['category_id'] for a in ann_contents['annotations']]
+        draws = image_shift_draws(ann_contents['images'], gsd_lookup, avg_img_gsd, shift_meters = shift_meters, 
+                                  random_amount = random_amount, seed = seed, stratify = stratify, gsd_buckets = gsd_buckets,
+                                  ann_image_ids = ann_image_ids, ann_category_ids = ann_category_ids)
+
+    for percentage_shift, new_anns_path in zip(percentages, new_anns_paths):
+        new_contents = convert_anns_centerpoint_meters_content(ann_contents, avg_img_gsd, shift_meters = shift_meters, 
+                                                               percentage_shift = percentage_shift, random_amount = random_amount,
+                                                               gsd_lookup = gsd_lookup, image_anns = image_anns, draws = draws)
+
+        if os.path.exists(new_anns_path):
+            os.remove(new_anns_path)
+        
+        with open(new_anns_path, 'w') as f:
+            json.dump(new_contents, f, default = materialize)
+
+    return new_anns_paths
+
+def convert_anns_centerpoint_meters_content(ann_contents, avg_img_gsd, shift_meters = 5, percentage_shift = 100, 
+                                            random_amount = False, gsd_lookup = None, image_anns = None, draws = None):
+    '''
+    PURPOSE: In-memory version of convert_anns_centerpoint_meters. The input
+             contents are left untouched
+    IN:
+     - ann_contents: dict, coco contents
+     - avg_img_gsd, shift_meters, percentage_shift, random_amount: see
+       convert_anns_centerpoint_meters
+     - gsd_lookup: dict, optional, image id to GSD from image_gsd_lookup
+     - image_anns: dict, optional, image id to annotations from anns_by_image
+     - draws: dict, optional, from image_sampling.image_shift_draws
+    OUT:
+     - new_contents: dict, coco contents with object centers
+    '''
+    if gsd_lookup == None:
+        gsd_lookup = image_gsd_lookup(ann_contents)
+    if image_anns == None:
+        image_anns = anns_by_image(ann_contents)
+        
+    shifts, images_regular = plan_image_shifts(ann_contents['images'], gsd_lookup, avg_img_gsd, shift_meters = shift_meters, 
+                                               percentage_shift = percentage_shift, random_amount = random_amount,
+                                               draws = draws)
+        
+    # annotations on shifted images first, then the rest, each in shuffled order
+    new_anns = []
+    for im_id, image_shift in shifts.items():
+        for a in image_anns.get(im_id, []):
+            new_anns.append(shift_annotation(a, image_shift))
+
+    for i in images_regular:
+        for a in image_anns.get(i['id'], []):
+            new_anns.append(shift_annotation(a, None))
+
+    new_contents = dict(ann_contents)
+    new_contents['annotations'] = new_anns
+
+    return new_contents
+
+def plan_image_shifts(images, gsd_lookup, avg_img_gsd, shift_meters = 5, percentage_shift = 100, random_amount = False,
+                      draws = None):
+    '''
+    PURPOSE: Choose which images to shift and, for each, the shift amount and
+             direction its annotations will all share
+    IN:
+     - images: list of coco image dicts
+     - gsd_lookup: dict, image id to GSD from image_gsd_lookup
+     - avg_img_gsd, shift_meters, percentage_shift, random_amount: see
+       convert_anns_centerpoint_meters
+     - draws: dict, optional, from image_sampling.image_shift_draws, take
+              the images and shifts from these instead of the random module
+    OUT:
+     - shifts: dict, image id to (shift, vertical direction, horizontal 
+               direction) for each shifted image, in the order they were drawn
+     - images_regular: list of the image dicts left unshifted
+    '''
+    if draws != None:
+        return select_shifts(draws, images, percentage_shift)
+
     shift_decimal = (percentage_shift/100)
     split_point = int(len(images)*shift_decimal)
     images_shuffle = random.sample(images, len(images))
     images_shift = images_shuffle[:split_point]
     images_regular = images_shuffle[split_point:]
         
-    new_anns = []
+    shifts = {}
     for i in tqdm(images_shift, desc = f'Shifting points on {percentage_shift}% of the images'):
-        im_gsd = get_im_gsd_from_id(i['id'], ann_contents)
+        im_gsd = gsd_lookup.get(i['id'])
         if im_gsd:
             if random_amount:
                 shift = random.choice(range(1, int(shift_meters/im_gsd)+1))
@@ -315,58 +660,48 @@ def convert_anns_centerpoint_meters(anns_path, avg_img_gsd, shift_meters = 5, pe
          # randomly select a movement
         v_d = random.choice(vert_opts)
         h_d = random.choice(hori_opts)
-        
-        anns = anns_on_image(i['id'], ann_contents)
-        for a in anns:
-        
-            new_a = a.copy()
-            x1, y1, w, h = a['bbox']
-            x_c = x1 + int(w/2)
-            y_c = y1 + int(h/2)
-            
-            # move the point:
-            if v_d == 'up':
-                y_c += shift
-            elif v_d == 'down':
-                y_c -= shift
-        
-            if h_d == 'right':
-                x_c += shift
-            elif h_d == 'left':
-                x_c -= shift
-          
-            # make sure there are no negatives
-            if x_c < 0:
-               x_c = 0
-            if y_c < 0:
-               y_c = 0
-
-            new_a['object_center'] = [x_c, y_c]
-            new_anns.append(new_a)
-            
-    for i in images_regular:
-        anns = anns_on_image(i['id'], ann_contents)
-        
-        for a in anns:
-            new_a = a.copy()
-            x1, y1, w, h = a['bbox']
-            x_c = x1 + int(w/2)
-            y_c = y1 + int(h/2)
-            new_a['object_center'] = [x_c, y_c]
-            new_anns.append(new_a)
 
-    ann_contents['annotations'] = new_anns
+        shifts[i['id']] = (shift, v_d, h_d)
 
-    # create and save new annotation file
-    new_anns_path = anns_path.split('.')[0] + f'_cp_{shift_meters}_meters_{percentage_shift}_percent.json'
+    return shifts, images_regular
 
-    if os.path.exists(new_anns_path):
-        os.remove(new_anns_path)
+def shift_annotation(a, image_shift):
+    '''
+    PURPOSE: Add an object center to an annotation, moved by its image's shift
+    IN:
+     - a: dict, coco annotation
+     - image_shift: tuple, (shift, v_d, h_d) from plan_image_shifts, or None
+                    if the image isn't shifted
+    OUT:
+     - new_a: AnnotationView, the annotation with 'object_center'
+    '''
+    new_a = AnnotationView(a)
+    x1, y1, w, h = a['bbox']
+    x_c = x1 + int(w/2)
+    y_c = y1 + int(h/2)
+
+    if image_shift != None:
+        shift, v_d, h_d = image_shift
+            
+        # move the point:
+        if v_d == 'up':
+            y_c += shift
+        elif v_d == 'down':
+            y_c -= shift
     
-    with open(new_anns_path, 'w') as f:
-        json.dump(ann_contents, f)
+        if h_d == 'right':
+            x_c += shift
+        elif h_d == 'left':
+            x_c -= shift
+      
+        # make sure there are no negatives
+        if x_c < 0:
+           x_c = 0
+        if y_c < 0:
+           y_c = 0
 
-    return new_anns_path
+    new_a['object_center'] = [x_c, y_c]
+    return new_a
 
 
 
@@ -378,16 +713,44 @@ if __name__ == "__main__":
     # Adding optional argument
     parser.add_argument("-train_fp", "--train_fp", help = "File path to geococo train annotations")
     parser.add_argument("-shift_meters", "--shift_meters", help = "Int, the number of meters you would like annotations to be shifted, on an image-by-image basis, in meters")
-    parser.add_argument("-shift_percent", "--shift_percent", help = "[0-100]The percentage of images you would like to shift by the value in shift_meters", required = False, default = 100)
+    parser.add_argument("-shift_percent", "--shift_percent", nargs = '+', help = "[0-100]The percentage of images you would like to shift by the value in shift_meters, several for a sweep", required = False, default = [100])
     parser.add_argument("-avg_gsd", "--avg_gsd", help = "Average image GSD you would like to use", required = False)
+    parser.add_argument("-max_memory_mb", "--max_memory_mb", help = "int, group annotations by image out of core within roughly this much memory", required = False)
+    parser.add_argument("-img_fp", "--img_fp", help = "str, File path to the images, to read GSDs missing from the annotations from the image headers", required = False)
+    parser.add_argument("-clip", "--clip", help = "Clip the square bboxes to the image bounds", action = "store_true")
+    parser.add_argument("-seed", "--seed", help = "int, seed for a repeatable selection of shifted images, nested across a sweep", required = False)
+    parser.add_argument("-stratify", "--stratify", nargs = '+', help = "Select shifted images evenly across 'gsd' buckets and/or each image's dominant 'category'", choices = STRATA, required = False)
+    parser.add_argument("-gsd_buckets", "--gsd_buckets", help = "int, number of GSD quantile buckets to stratify by", required = False, default = 4)
+    parser.add_argument("-plan", "--plan", help = "Report what the run would write, and whether it fits on disk, without doing it", action = "store_true")
     
     # Read arguments from command line
     args = parser.parse_args()
     
     print("shift_percentage", args.shift_percent)
     
+    # with max_memory_mb every stage streams the file rather than loading it
+    max_memory_mb = int(args.max_memory_mb) if args.max_memory_mb else None
+    stream = bool(max_memory_mb)
+    if stream:
+        require_ijson()
+    
+    # check the file before any transform starts, with any GSDs the image
+    # headers fill in
+    report = validate_coco(args.train_fp, avg_img_gsd = args.avg_gsd, require_size_estimates = True, img_fp = args.img_fp,
+                           stream = stream)
+    if report['errors']:
+        sys.exit(1)
+    
+    if args.plan:
+        plan = plan_geo_error(args.train_fp, shift_meters = int(args.shift_meters), percentage_shift = [int(p) for p in args.shift_percent],
+                              max_memory_mb = max_memory_mb)
+        print_plan(plan)
+        sys.exit(0 if plan['fits'] else 1)
+    
+    start = time.time()
+    
     # add size estimates in meters to the object categories
-    estimates = estimate_category_size(args.train_fp, True)
+    estimates = estimate_category_size(args.train_fp, True, img_fp = args.img_fp, stream = stream)
     print('Estimated category sizes:')
     for k in estimates.keys():
           name = estimates[k]['name']
@@ -396,25 +759,25 @@ if __name__ == "__main__":
     
     
     shift_m =int(args.shift_meters)
+    percentages = [int(p) for p in args.shift_percent]
+    sampling = dict(seed = int(args.seed) if args.seed else None, stratify = args.stratify, 
+                    gsd_buckets = int(args.gsd_buckets))
         
     if args.avg_gsd:
-        # convert bounding boxes to square boxes around centerpoints based on gsd and 
-        # average object size
-        # add centerpoints to the annotations
-        train_c_cp = convert_anns_centerpoint_meters(args.train_fp, args.avg_gsd, shift_meters = shift_m, percentage_shift = int(args.shift_percent), random_amount = True)
-        train_anns_sq = average_bboxes_from_centerpoints(train_c_cp, avg_img_gsd = float(args.avg_gsd))
+        avg_img_gsd = float(args.avg_gsd)
     else:
-        
         # get the average image gsd value
-        avg_img_gsd = get_average_image_gsd(args.train_fp)
+        avg_img_gsd = get_average_image_gsd(args.train_fp, img_fp = args.img_fp, stream = stream)
         print(f'Average Image GSD: {avg_img_gsd}')
-        train_c_cp = convert_anns_centerpoint_meters(args.train_fp, avg_img_gsd, shift_meters = shift_m, percentage_shift = int(args.shift_percent), random_amount = True)
+
+    # add centerpoints to the annotations, one file per shift percentage
+    train_c_cps = convert_anns_centerpoint_meters_sweep(args.train_fp, avg_img_gsd, shift_meters = shift_m, percentages = percentages, 
+                                                        random_amount = True, max_memory_mb = max_memory_mb, img_fp = args.img_fp, 
+                                                        **sampling)
+    for train_c_cp in train_c_cps:
         # convert bounding boxes to square boxes around centerpoints based on gsd and 
         # average object size
-        train_anns_sq = average_bboxes_from_centerpoints(train_c_cp, avg_img_gsd = avg_img_gsd)
-    
-    
-    
-    
-    
-   
+        train_anns_sq = average_bboxes_from_centerpoints(train_c_cp, avg_img_gsd = avg_img_gsd, img_fp = args.img_fp, clip = args.clip,
+                                                         stream = stream)
+
+    record_throughput('geo_error_anns_per_s', report['counts']['annotations'] * len(percentages), time.time() - start)
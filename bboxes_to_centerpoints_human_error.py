@@ -4,9 +4,15 @@ from tqdm import tqdm
 import numpy as np
 import random
 import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import sys
+from annotation_views import AnnotationView, materialize
+from validate_coco import validate_coco
+from image_metadata import image_metadata, gsd_lookup_with_metadata, image_bounds, clip_bbox
+from image_partitions import iter_coco_annotations, write_annotation_variants
 
 
-def average_bboxes_from_centerpoints(anns_path, avg_img_gsd = None):
+def average_bboxes_from_centerpoints(anns_path, avg_img_gsd = None, img_fp = None, clip = False):
     '''
     PURPOSE: After finding average object sizes, and using bounding boxes to add
              centerpoints (all to a coco annotation file), replace bounding boxes 
@@ -16,6 +22,9 @@ def average_bboxes_from_centerpoints(anns_path, avg_img_gsd = None):
      - avg_img_gsd: float or int, optional, average image size in dataset, 
                     which will be used as a default if an image doesn't have 
                     a noted GSD. 
+     - img_fp: str, optional, image directory. GSDs missing from the file are 
+               read from the image headers where possible, see image_metadata
+     - clip: boolean, whether to clip the square bboxes to the image bounds
     OUT:
      - new_anns_path: str, path to new annotation file
     '''
@@ -24,9 +33,45 @@ def average_bboxes_from_centerpoints(anns_path, avg_img_gsd = None):
     with open(anns_path, 'r') as f:
         content = json.load(f)
 
+    gsd_lookup = image_gsd_lookup(content)
+    meta = {}
+    if img_fp:
+        meta = image_metadata(content, img_fp)
+        gsd_lookup = gsd_lookup_with_metadata(gsd_lookup, meta)
+    bounds = image_bounds(content, meta) if clip else None
+
+    content = average_bboxes_from_centerpoints_content(content, avg_img_gsd, gsd_lookup = gsd_lookup, bounds = bounds)
+
+    new_anns_path = anns_path.split('.')[0] + '_square.json'
+
+    if os.path.exists(new_anns_path):
+        os.remove(new_anns_path)
+    
+    with open(new_anns_path, 'w') as f:
+        json.dump(content, f, default = materialize)
+
+    return new_anns_path
+
+def average_bboxes_from_centerpoints_content(content, avg_img_gsd = None, gsd_lookup = None, bounds = None):
+    '''
+    PURPOSE: In-memory version of average_bboxes_from_centerpoints. The input
+             contents are left untouched
+    IN:
+     - content: dict, coco contents with centerpoints and category sizes
+     - avg_img_gsd: float or int, optional, GSD used where an image has none
+     - gsd_lookup: dict, optional, image id to GSD from image_gsd_lookup
+     - bounds: dict, optional, image id to (width, height) from image_bounds,
+               square bboxes are clipped to these
+    OUT:
+     - new_content: dict, coco contents with square bboxes
+    '''
+
     # if necessary, get average gsd
+    if gsd_lookup == None:
+        gsd_lookup = image_gsd_lookup(content)
     if avg_img_gsd == None:
-        avg_img_gsd = get_average_image_gsd(anns_path)
+        avg_img_gsd = get_average_image_gsd_content(content, gsd_lookup)
+    size_lookup = category_size_lookup(content)
     
     # pull out key sections of file
     anns = content['annotations']
@@ -34,34 +79,30 @@ def average_bboxes_from_centerpoints(anns_path, avg_img_gsd = None):
     # adjust bounding boxes based on centerpoints and object sizes
     new_annotations = []
     for a in tqdm(anns, desc = 'Creating Square Bboxes'):
-        new_a = a.copy()
+        new_a = AnnotationView(a)
         [x,y] = a['centerpoint']
-        obj_size = get_obj_size_from_id(a['category_id'], content)
-        im_gsd = get_im_gsd_from_id(a['image_id'], content)
-        if im_gsd != None:
-            ob_h_w = int(obj_size/im_gsd)
-        else:
-            try:
+        obj_size = size_lookup.get(a['category_id'])
+        im_gsd = gsd_lookup.get(a['image_id'])
+        try:
+            if im_gsd != None:
+                ob_h_w = int(obj_size/im_gsd)
+            else:
                 ob_h_w = int(obj_size/avg_img_gsd)
-            except:
-                print(f'object size is {obj_size} and the average gsd is {avg_img_gsd}')
+        except (TypeError, ValueError, ZeroDivisionError):
+            used_gsd = im_gsd if im_gsd != None else f'the average gsd {avg_img_gsd}'
+            raise ValueError(f'Cannot size annotation {a["id"]}: object size is {obj_size} and the gsd is {used_gsd}')
         square_bbox = [x - (ob_h_w/2), y - (ob_h_w/2), ob_h_w, ob_h_w]
+        if bounds != None and a['image_id'] in bounds:
+            square_bbox = clip_bbox(square_bbox, *bounds[a['image_id']])
         new_a['bbox'] = square_bbox
         new_annotations.append(new_a)
 
-    content['annotations'] = new_annotations
-
-    new_anns_path = anns_path.split('.')[0] + '_square.json'
-
-    if os.path.exists(new_anns_path):
-        os.remove(new_anns_path)
-    
-    with open(new_anns_path, 'w') as f:
-        json.dump(content, f)
+    new_content = dict(content)
+    new_content['annotations'] = new_annotations
 
-    return new_anns_path
+    return new_content
 
-def estimate_category_size(anns_path, write_out = False, matched_files = []):
+def estimate_category_size(anns_path, write_out = False, matched_files = [], img_fp = None):
     '''
     PURPOSE: Get average sizes in meters for each object category in a 
              coco dataset and optionally add them to the file, with the option
@@ -71,6 +112,8 @@ def estimate_category_size(anns_path, write_out = False, matched_files = []):
      - write_out: boolean, whether or not to write the values into the coco file
      - matched_files : list of strs, paths to other files to write our average 
                        object sizes to
+     - img_fp: str, optional, image directory. GSDs missing from the file are 
+               read from the image headers where possible, see image_metadata
     OUT:
      - estimates: dict, contains information about each category keyed to its id
     '''
@@ -79,6 +122,51 @@ def estimate_category_size(anns_path, write_out = False, matched_files = []):
     with open(anns_path, 'r') as f:
         content = json.load(f)
     
+    gsd_lookup = image_gsd_lookup(content)
+    if img_fp:
+        gsd_lookup = gsd_lookup_with_metadata(gsd_lookup, image_metadata(content, img_fp))
+    estimates = estimate_category_size_content(content, gsd_lookup)
+
+    if write_out:
+        # the files are rewritten in place, so check before writing that every
+        # category they use got a size, rather than failing on it later
+        sized = set(k for k, v in estimates.items() if np.isfinite(v['average']))
+        for fp, used in [(anns_path, set(a['category_id'] for a in content['annotations']))] + \
+                        [(fp, set(a['category_id'] for a in iter_coco_annotations(fp))) for fp in matched_files]:
+            unsized = used - sized
+            if unsized:
+                raise ValueError(f'{fp} uses categories whose size can\'t be estimated from {anns_path}: '
+                                 + ', '.join(str(c) for c in sorted(unsized, key = str)))
+
+        new_cats = categories_with_sizes(content['categories'], estimates)
+        content['categories'] = new_cats
+
+        os.remove(anns_path)
+
+        with open(anns_path, 'w') as f:
+            json.dump(content, f)
+        
+        for fp in matched_files:
+            with open(fp, 'r') as f:
+                f_contents = json.load(f)
+            f_contents['categories'] = new_cats
+            os.remove(fp)
+            with open(fp, 'w') as f:
+                json.dump(f_contents, f)
+    return estimates
+
+def estimate_category_size_content(content, gsd_lookup = None):
+    '''
+    PURPOSE: In-memory version of estimate_category_size, without writing
+    IN:
+     - content: dict, coco contents
+     - gsd_lookup: dict, optional, image id to GSD from image_gsd_lookup
+    OUT:
+     - estimates: dict, contains information about each category keyed to its id
+    '''
+    if gsd_lookup == None:
+        gsd_lookup = image_gsd_lookup(content)
+
     # pull out key sections of file
     cats = content['categories']
     anns = content['annotations']
@@ -94,7 +182,7 @@ def estimate_category_size(anns_path, write_out = False, matched_files = []):
 
         # get largest side of object
         size = max(bbox[2:3])
-        im_gsd = get_im_gsd_from_id(a['image_id'], content)
+        im_gsd = gsd_lookup.get(a['image_id'])
         if im_gsd != None:
           size_m = size*im_gsd
           estimates[a['category_id']]['sizes'].append(size_m)
@@ -104,46 +192,63 @@ def estimate_category_size(anns_path, write_out = False, matched_files = []):
         avg = np.mean(v['sizes'])
         estimates[k]['average'] = avg
 
-    new_cats = []
-    if write_out:
-
-        for c in cats:
-            new_c = c.copy()
-            new_c['average_size'] = estimates[c['id']]['average']
-            new_cats.append(new_c)
-        content['categories'] = new_cats
-
-        os.remove(anns_path)
-
-        with open(anns_path, 'w') as f:
-            json.dump(content, f)
-        
-        for fp in matched_files:
-            with open(fp, 'r') as f:
-                f_contents = json.load(f)
-            f_contents['categories'] = new_cats
-            os.remove(fp)
-            with open(fp, 'w') as f:
-                json.dump(f_contents, f)
     return estimates
 
+def categories_with_sizes(cats, estimates):
+    '''
+    IN:
+     - cats: list of coco category dicts
+     - estimates: dict, from estimate_category_size
+    OUT:
+     - new_cats: list of category dicts with 'average_size' added
+    '''
+    new_cats = []
+    for c in cats:
+        new_c = c.copy()
+        new_c['average_size'] = estimates[c['id']]['average']
+        new_cats.append(new_c)
+    return new_cats
 
-def get_average_image_gsd(anns_path):
+
+def get_average_image_gsd(anns_path, img_fp = None):
     '''
     PURPOSE: Find the average GSD of the images in a coco ground truth file
     IN:
      - anns_path: str, path to coco annotation file
+     - img_fp: str, optional, image directory. GSDs missing from the file are 
+               read from the image headers where possible, see image_metadata
     OUT:
      - avg_img_gsd: float, average gsd of images in dataset
     '''
     with open(anns_path, 'r') as f:
         content = json.load(f)
+
+    gsd_lookup = None
+    if img_fp:
+        gsd_lookup = gsd_lookup_with_metadata(image_gsd_lookup(content), image_metadata(content, img_fp))
+    return get_average_image_gsd_content(content, gsd_lookup)
+
+def get_average_image_gsd_content(content, gsd_lookup = None):
+    '''
+    PURPOSE: In-memory version of get_average_image_gsd
+    IN:
+     - content: dict, coco contents
+     - gsd_lookup: dict, optional, image id to GSD, such as one with GSDs
+                   from the image headers from gsd_lookup_with_metadata,
+                   otherwise the file's own GSDs are averaged
+    OUT:
+     - avg_img_gsd: float, average gsd of images in dataset
+    '''
     images = content['images']
 
     gsd_vals = []
 
     for i in tqdm(images, desc = 'Finding Average Image GSD'):
-        if 'acquisition_data' in i.keys():
+        if gsd_lookup != None:
+            gsd_val = gsd_lookup.get(i['id'])
+            if gsd_val != None:
+                gsd_vals.append(gsd_val)
+        elif 'acquisition_data' in i.keys():
             gsd_val = i['acquisition_data']['GSD'][0]
             if gsd_val != None:
                 gsd_vals.append(gsd_val)
@@ -152,6 +257,37 @@ def get_average_image_gsd(anns_path):
 
     return avg_img_gsd
 
+def image_gsd_lookup(gt_content):
+    '''
+    PURPOSE: Index every image's GSD by id once, instead of searching the
+             image list for each annotation with get_im_gsd_from_id
+    IN:
+     - gt_content: the content from a coco ground truth file
+    OUT:
+     - lookup: dict, image id to GSD (or None if it isn't available)
+    '''
+    lookup = {}
+    for i in gt_content['images']:
+        if i['id'] in lookup:
+            continue
+        try:
+            lookup[i['id']] = i['acquisition_data']['GSD'][0]
+        except (KeyError, IndexError, TypeError):
+            lookup[i['id']] = None
+    return lookup
+
+def category_size_lookup(gt_content):
+    '''
+    IN:
+     - gt_content: the content from a coco ground truth file
+    OUT:
+     - lookup: dict, category id to average size (or None if it isn't recorded)
+    '''
+    lookup = {}
+    for c in gt_content['categories']:
+        lookup.setdefault(c['id'], c.get('average_size'))
+    return lookup
+
 def get_im_gsd_from_id(im_id, gt_content):
     '''
     PURPOSE: Get the GSD of an image based on its id in a coco file
@@ -232,7 +368,7 @@ def make_cat_ids_match(src_anns, match_anns):
     # Remap the annotations in match_anns
     new_annotations = []
     for a in match_gt['annotations']:
-        new_a = a.copy()
+        new_a = AnnotationView(a)
         new_a['category_id'] = cat_map[a['category_id']]
         new_annotations.append(new_a)
     
@@ -242,7 +378,7 @@ def make_cat_ids_match(src_anns, match_anns):
     # Save out a new file
     os.remove(match_anns)
     with open(match_anns, 'w') as f:
-        json.dump(match_gt, f)
+        json.dump(match_gt, f, default = materialize)
 
     return 
 
@@ -261,13 +397,37 @@ def convert_anns_centerpoint(anns_path, max_shift = 5):
     with open(anns_path, 'r') as f:
         ann_contents = json.load(f)
     
+    ann_contents = convert_anns_centerpoint_content(ann_contents, max_shift)
+
+    # create and save new annotation file
+    new_anns_path = anns_path.split('.')[0] + f'_cp_{max_shift}.json'
+
+    if os.path.exists(new_anns_path):
+        os.remove(new_anns_path)
+    
+    with open(new_anns_path, 'w') as f:
+        json.dump(ann_contents, f, default = materialize)
+
+    return new_anns_path
+
+def convert_anns_centerpoint_content(ann_contents, max_shift = 5):
+    '''
+    PURPOSE: In-memory version of convert_anns_centerpoint. The input contents
+             are left untouched
+    IN:
+     - ann_contents: dict, coco contents
+     - max_shift: int, maximum distance the point may shift 
+    OUT:
+     - new_contents: dict, coco contents with centerpoints
+    '''
+    
     # grab those annotations
     annotations = ann_contents['annotations']
 
     # add randomly shifted centerpoints to each annotation
     new_anns = []
     for a in annotations:
-        new_a = a.copy()
+        new_a = AnnotationView(a)
         x1, y1, w, h = a['bbox']
         x_c = x1 + int(w/2)
         y_c = y1 + int(h/2)
@@ -275,18 +435,10 @@ def convert_anns_centerpoint(anns_path, max_shift = 5):
         new_a['centerpoint'] = random_shift_point([x_c, y_c], max_shift)
         new_anns.append(new_a)
 
-    ann_contents['annotations'] = new_anns
-
-    # create and save new annotation file
-    new_anns_path = anns_path.split('.')[0] + f'_cp_{max_shift}.json'
-
-    if os.path.exists(new_anns_path):
-        os.remove(new_anns_path)
-    
-    with open(new_anns_path, 'w') as f:
-        json.dump(ann_contents, f)
+    new_contents = dict(ann_contents)
+    new_contents['annotations'] = new_anns
 
-    return new_anns_path
+    return new_contents
 
 def random_shift_point(pt, max_shift = 5):
     '''
@@ -331,6 +483,260 @@ def random_shift_point(pt, max_shift = 5):
 
     return [x,y]
 
+def annotator_centerpoints(bboxes, n_annotators = 5, max_shift = 5, seed = None):
+    '''
+    PURPOSE: Simulate several annotators clicking the center of each box at once,
+             using the same jitter rules as random_shift_point
+    IN:
+     - bboxes: array-like, n x 4 coco bboxes [x1, y1, w, h]
+     - n_annotators: int, number of independent annotators to simulate
+     - max_shift: int, maximum distance a point may shift
+     - seed: int, optional, seed for the random generator
+    OUT:
+     - points: numpy array, n x n_annotators x 2 jittered [x,y] points
+    '''
+    rng = np.random.default_rng(seed)
+    bboxes = np.asarray(bboxes).reshape(-1, 4)
+
+    # true centers, truncated the same way as convert_anns_centerpoint
+    centers = bboxes[:, :2] + np.trunc(bboxes[:, 2:] / 2).astype(bboxes.dtype)
+
+    # each axis moves -1, 0 or +1 times a shift of 1 to max_shift pixels
+    shape = (len(bboxes), n_annotators, 2)
+    directions = rng.integers(-1, 2, size = shape)
+    amounts = rng.integers(1, max_shift + 1, size = shape)
+
+    points = centers[:, None, :] + directions * amounts
+
+    # make sure there are no negatives
+    return np.maximum(points, 0)
+
+def consensus_centerpoints(points, method = 'mean'):
+    '''
+    PURPOSE: Combine the points of several simulated annotators into one point
+    IN:
+     - points: numpy array, n x n_annotators x 2, from annotator_centerpoints
+     - method: str, 'mean' or 'median'
+    OUT:
+     - consensus: numpy array, n x 2 consensus [x,y] points
+    '''
+    if method == 'mean':
+        return points.mean(axis = 1)
+    elif method == 'median':
+        return np.median(points, axis = 1)
+    raise ValueError(f'Unknown consensus method: {method}')
+
+def convert_anns_centerpoint_multi(anns_path, n_annotators = 5, max_shift = 5,
+                                   consensus = 'mean', write_variants = False,
+                                   seed = None):
+    '''
+    PURPOSE: Simulate several annotators at once instead of one per run. All
+             jitters are drawn in one batch and kept as an annotations x
+             n_annotators x 2 array, next to a file of consensus centerpoints
+    IN:
+     - anns_path: str, path to annotations
+     - n_annotators: int, number of independent annotators to simulate
+     - max_shift: int, maximum distance the point may shift
+     - consensus: str, 'mean' or 'median', how the annotators are combined
+     - write_variants: boolean, whether to also write one annotation file per
+                       simulated annotator
+     - seed: int, optional, seed for the random generator
+    OUT:
+     - new_anns_path: str, path to the consensus annotations
+     - points: numpy array, n x n_annotators x 2 simulated centerpoints
+    '''
+
+    # open the annotation file
+    with open(anns_path, 'r') as f:
+        ann_contents = json.load(f)
+
+    # grab those annotations
+    annotations = ann_contents['annotations']
+
+    # draw every annotator's points in one batch
+    bboxes = np.array([a['bbox'] for a in annotations]).reshape(-1, 4)
+    points = annotator_centerpoints(bboxes, n_annotators, max_shift, seed)
+    agreed = consensus_centerpoints(points, consensus)
+
+    # keep the raw points alongside the annotation files
+    base_path = anns_path.split('.')[0] + f'_cp_{max_shift}_x{n_annotators}'
+    np.save(base_path + '.npy', points)
+
+    new_anns_path = base_path + f'_{consensus}.json'
+    out_paths = [new_anns_path]
+    if write_variants:
+        out_paths += [base_path + f'_a{k}.json' for k in range(n_annotators)]
+
+    def annotation_sets():
+        for n, a in enumerate(tqdm(annotations, desc = 'Writing Centerpoints')):
+            new_a = AnnotationView(a)
+            new_a['centerpoint'] = agreed[n].tolist()
+            variants = [new_a]
+            if write_variants:
+                for pt in points[n].tolist():
+                    new_a = AnnotationView(a)
+                    new_a['centerpoint'] = pt
+                    variants.append(new_a)
+            yield variants
+
+    write_annotation_variants(ann_contents, out_paths, annotation_sets())
+
+    return new_anns_path, points
+
+
+_split_tables = {}
+
+def _init_split_worker(categories, avg_img_gsd, img_fp = None, clip = False):
+    '''
+    PURPOSE: Give each worker process the shared, read-only tables computed 
+             once from the reference split
+    '''
+    _split_tables['categories'] = categories
+    _split_tables['avg_img_gsd'] = avg_img_gsd
+    _split_tables['img_fp'] = img_fp
+    _split_tables['clip'] = clip
+
+def _process_split(split_fp, max_shift, seed):
+    '''
+    PURPOSE: Run the centerpoint and square bbox steps on one split, inside a
+             worker set up by _init_split_worker
+    IN:
+     - split_fp: str, path to coco annotations for this split
+     - max_shift: int, maximum distance a point may shift
+     - seed: int, optional, seed for this split's random shifts
+    OUT:
+     - paths: tuple of strs, the centerpoint and square annotation paths
+    '''
+    if seed != None:
+        random.seed(seed)
+
+    with open(split_fp, 'r') as f:
+        content = json.load(f)
+    content['categories'] = _split_tables['categories']
+
+    # add centerpoints to the annotations
+    c_cp = convert_anns_centerpoint_content(content, max_shift)
+    cp_path = split_output_path(split_fp, max_shift)
+    with open(cp_path, 'w') as f:
+        json.dump(c_cp, f, default = materialize)
+
+    # convert bounding boxes to square boxes around centerpoints
+    gsd_lookup = image_gsd_lookup(content)
+    meta = {}
+    if _split_tables['img_fp']:
+        meta = image_metadata(content, _split_tables['img_fp'])
+        gsd_lookup = gsd_lookup_with_metadata(gsd_lookup, meta)
+    bounds = image_bounds(content, meta) if _split_tables['clip'] else None
+    sq = average_bboxes_from_centerpoints_content(c_cp, _split_tables['avg_img_gsd'], gsd_lookup = gsd_lookup, bounds = bounds)
+    sq_path = cp_path.split('.')[0] + '_square.json'
+    with open(sq_path, 'w') as f:
+        json.dump(sq, f, default = materialize)
+
+    return cp_path, sq_path
+
+def split_output_path(split_fp, max_shift):
+    '''
+    IN:
+     - split_fp: str, path to coco annotations for a split
+     - max_shift: int, maximum distance a point may shift
+    OUT:
+     - cp_path: str, where the split's centerpoints go, the square bboxes
+                go next to it
+    '''
+    return split_fp.split('.')[0] + f'_cp_{max_shift}.json'
+
+def check_split_collisions(split_fps, max_shift):
+    '''
+    PURPOSE: Fail before any split is submitted if two would write the same
+             outputs, e.g. train.json and train.v2.json, as they are written
+             by parallel workers at once
+    IN:
+     - split_fps: list of strs, paths to coco annotations
+     - max_shift: int, maximum distance a point may shift
+    '''
+    seen = {}
+    for fp in split_fps:
+        out_fp = os.path.abspath(split_output_path(fp, max_shift))
+        if out_fp in seen:
+            raise ValueError(f'{seen[out_fp]} and {fp} would write the same outputs ({out_fp})')
+        seen[out_fp] = fp
+
+def process_splits(split_fps, max_shift = 5, avg_img_gsd = None, workers = None, seed = None, img_fp = None, clip = False):
+    '''
+    PURPOSE: Run the whole pipeline on any number of splits (train/val/test or
+             k folds) at once. Category sizes and the fallback GSD are 
+             computed once from the first, reference, split and shared with 
+             parallel workers, one split per worker, so the run takes about as
+             long as the largest split. The input files are not rewritten; 
+             the category sizes are written to the output files
+    IN:
+     - split_fps: list of strs, paths to coco annotations, reference first
+     - max_shift: int, maximum distance a point may shift
+     - avg_img_gsd: float, optional, GSD used where an image has none, 
+                    otherwise the reference split's average
+     - workers: int, optional, number of worker processes
+     - seed: int, optional, seed for the random shifts, offset for each split
+     - img_fp: str, optional, image directory to read missing GSDs and image
+               sizes from, see image_metadata
+     - clip: boolean, whether to clip the square bboxes to the image bounds
+    OUT:
+     - estimates: dict, category size estimates from the reference split
+     - outputs: dict, split path to its (centerpoint path, square path)
+    '''
+    check_split_collisions(split_fps, max_shift)
+
+    with open(split_fps[0], 'r') as f:
+        reference = json.load(f)
+
+    gsd_lookup = image_gsd_lookup(reference)
+    if img_fp:
+        gsd_lookup = gsd_lookup_with_metadata(gsd_lookup, image_metadata(reference, img_fp))
+    estimates = estimate_category_size_content(reference, gsd_lookup)
+    categories = categories_with_sizes(reference['categories'], estimates)
+    if avg_img_gsd == None:
+        avg_img_gsd = get_average_image_gsd_content(reference, gsd_lookup)
+    del reference, gsd_lookup
+
+    # the reference's categories replace each split's own, so every category
+    # a split uses must be there with a size, or its worker fails once others
+    # are running
+    sized = set(c['id'] for c in categories if np.isfinite(c['average_size']))
+    for fp in split_fps:
+        missing = set(a['category_id'] for a in iter_coco_annotations(fp)) - sized
+        if missing:
+            raise ValueError(f'{fp} uses categories without a size from the reference split {split_fps[0]}: '
+                             + ', '.join(str(c) for c in sorted(missing, key = str)))
+
+    seeds = [seed + n if seed != None else None for n in range(len(split_fps))]
+    workers = min(workers or os.cpu_count() or 1, len(split_fps))
+    outputs = {}
+    with ProcessPoolExecutor(max_workers = workers, initializer = _init_split_worker, 
+                             initargs = (categories, avg_img_gsd, img_fp, clip)) as pool:
+        futures = {pool.submit(_process_split, fp, max_shift, sd): fp for fp, sd in zip(split_fps, seeds)}
+        for future in tqdm(as_completed(futures), total = len(futures), desc = 'Processing Splits'):
+            outputs[futures[future]] = future.result()
+
+    return estimates, outputs
+
+def validate_splits(split_fps, avg_img_gsd = None, img_fp = None):
+    '''
+    PURPOSE: Validate every split before a run, the others against the
+             categories the first, reference, split can size, since its 
+             sizes are the ones written to all of them
+    IN:
+     - split_fps: list of strs, paths to coco annotations, reference first
+     - avg_img_gsd: float, optional, the fallback GSD the run will use
+     - img_fp: str, optional, image directory the run reads missing GSDs from
+    OUT:
+     - valid: boolean, whether every split passed, the reports are printed
+    '''
+    # GSDs the image headers fill in count, as they do in the run
+    reference = validate_coco(split_fps[0], avg_img_gsd = avg_img_gsd, require_size_estimates = True, img_fp = img_fp)
+    sized = reference.get('sized_categories')
+    reports = [reference] + [validate_coco(fp, avg_img_gsd = avg_img_gsd, sized_categories = sized, img_fp = img_fp) 
+                             for fp in split_fps[1:]]
+    return not any(r['errors'] for r in reports)
+
 
 if __name__ == "__main__":
     
@@ -340,36 +746,81 @@ if __name__ == "__main__":
     parser.add_argument("-train_fp", "--train_fp", help = "File path to geococo train annotations")
     parser.add_argument("-val_fp", "--val_fp", help = "File path to geococo val annotations")
     parser.add_argument("-avg_gsd", "--avg_gsd", help = "Average image GSD you would like to use", required = False)
+    parser.add_argument("-n_annotators", "--n_annotators", help = "int, simulate this many annotators in one pass and use their consensus centerpoints", required = False)
+    parser.add_argument("-consensus", "--consensus", help = "How simulated annotators are combined, 'mean' or 'median'", required = False, default = 'mean')
+    parser.add_argument("-write_variants", "--write_variants", help = "Also write one annotation file per simulated annotator", action = "store_true")
+    parser.add_argument("-seed", "--seed", help = "int, seed for the simulated annotators", required = False)
+    parser.add_argument("-splits", "--splits", nargs = '+', help = "File paths to any number of geococo splits, processed in parallel; category sizes and the average GSD come from the first", required = False)
+    parser.add_argument("-workers", "--workers", help = "int, number of worker processes for -splits", required = False)
+    parser.add_argument("-img_fp", "--img_fp", help = "str, File path to the images, to read GSDs missing from the annotations from the image headers", required = False)
+    parser.add_argument("-clip", "--clip", help = "Clip the square bboxes to the image bounds", action = "store_true")
     
     # Read arguments from command line
     args = parser.parse_args()
     
-    # add size estimates in meters to the object categories
-    estimates = estimate_category_size(args.train_fp, True, [args.val_fp])
-    print('Estimated category sizes:')
-    for k in estimates.keys():
-          name = estimates[k]['name']
-          avg = round(estimates[k]['average'], 1)
-          print(f'{name}: {avg} meters')
+    if args.splits:
+        if args.n_annotators:
+            parser.error('-n_annotators is not supported with -splits')
+        
+        # check every split before any transform starts, each against the
+        # category sizes the reference split will give them
+        if not validate_splits(args.splits, avg_img_gsd = args.avg_gsd, img_fp = args.img_fp):
+            sys.exit(1)
+        
+        try:
+            estimates, outputs = process_splits(args.splits, avg_img_gsd = float(args.avg_gsd) if args.avg_gsd else None,
+                                                workers = int(args.workers) if args.workers else None,
+                                                seed = int(args.seed) if args.seed else None,
+                                                img_fp = args.img_fp, clip = args.clip)
+        except ValueError as e:
+            print(f'ERROR: {e}')
+            sys.exit(1)
+        print('Estimated category sizes:')
+        for k in estimates.keys():
+              name = estimates[k]['name']
+              avg = round(estimates[k]['average'], 1)
+              print(f'{name}: {avg} meters')
+    else:
+        # check both files before any transform starts, val against the
+        # category sizes train will give it
+        if not validate_splits([args.train_fp, args.val_fp], avg_img_gsd = args.avg_gsd, img_fp = args.img_fp):
+            sys.exit(1)
+    
+        # add size estimates in meters to the object categories
+        estimates = estimate_category_size(args.train_fp, True, [args.val_fp], img_fp = args.img_fp)
+        print('Estimated category sizes:')
+        for k in estimates.keys():
+              name = estimates[k]['name']
+              avg = round(estimates[k]['average'], 1)
+              print(f'{name}: {avg} meters')
     
-    # add centerpoints to the annotations
-    train_c_cp = convert_anns_centerpoint(args.train_fp)
-    val_c_cp = convert_anns_centerpoint(args.val_fp)
+        # add centerpoints to the annotations
+        if args.n_annotators:
+            seed = int(args.seed) if args.seed else None
+            train_c_cp, _ = convert_anns_centerpoint_multi(args.train_fp, n_annotators = int(args.n_annotators), 
+                                                           consensus = args.consensus, write_variants = args.write_variants, seed = seed)
+            # offset the seed so val doesn't reuse train's draws
+            seed = seed + 1 if seed != None else None
+            val_c_cp, _ = convert_anns_centerpoint_multi(args.val_fp, n_annotators = int(args.n_annotators), 
+                                                         consensus = args.consensus, write_variants = args.write_variants, seed = seed)
+        else:
+            train_c_cp = convert_anns_centerpoint(args.train_fp)
+            val_c_cp = convert_anns_centerpoint(args.val_fp)
     
-    if args.avg_gsd:
-        # convert bounding boxes to square boxes around centerpoints based on gsd and 
-        # average object size
-        train_anns_sq = average_bboxes_from_centerpoints(train_c_cp, avg_img_gsd = float(args.avg_gsd))
-        val_anns_sq = average_bboxes_from_centerpoints(val_c_cp, avg_img_gsd = float(args.avg_gsd))
-    else:
+        if args.avg_gsd:
+            # convert bounding boxes to square boxes around centerpoints based on gsd and 
+            # average object size
+            train_anns_sq = average_bboxes_from_centerpoints(train_c_cp, avg_img_gsd = float(args.avg_gsd), img_fp = args.img_fp, clip = args.clip)
+            val_anns_sq = average_bboxes_from_centerpoints(val_c_cp, avg_img_gsd = float(args.avg_gsd), img_fp = args.img_fp, clip = args.clip)
+        else:
         
-        # get the average image gsd value
-        avg_img_gsd = get_average_image_gsd(train_c_cp)
-        print(f'Average Image GSD: {avg_img_gsd}')
-        # convert bounding boxes to square boxes around centerpoints based on gsd and 
-        # average object size
-        train_anns_sq = average_bboxes_from_centerpoints(train_c_cp, avg_img_gsd = avg_img_gsd)
-        val_anns_sq = average_bboxes_from_centerpoints(val_c_cp, avg_img_gsd = avg_img_gsd)
+            # get the average image gsd value
+            avg_img_gsd = get_average_image_gsd(train_c_cp, img_fp = args.img_fp)
+            print(f'Average Image GSD: {avg_img_gsd}')
+            # convert bounding boxes to square boxes around centerpoints based on gsd and 
+            # average object size
+            train_anns_sq = average_bboxes_from_centerpoints(train_c_cp, avg_img_gsd = avg_img_gsd, img_fp = args.img_fp, clip = args.clip)
+            val_anns_sq = average_bboxes_from_centerpoints(val_c_cp, avg_img_gsd = avg_img_gsd, img_fp = args.img_fp, clip = args.clip)
     
     
     
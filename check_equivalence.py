@@ -0,0 +1,694 @@
+import json
+import os
+import sys
+import time
+import random
+import shutil
+import tempfile
+import threading
+import numpy as np
+import argparse
+from annotation_views import materialize
+import bboxes_to_centerpoints_human_error as human_error
+import bboxes_to_centerpoints_geo_error as geo_error
+import full_scene_vs_single_class as full_scene
+import image_partitions
+from image_sampling import image_shift_draws, gsd_strata
+from chip_scenes import tile_starts, assign_to_tiles
+from coco_daemon import CocoDaemon, send_request
+
+'''
+Reference implementations: the original algorithms of convert_anns_centerpoint,
+convert_anns_centerpoint_meters, estimate_category_size,
+average_bboxes_from_centerpoints and single_cat_dataset, on contents instead of
+files. Lookups by id use dicts which return what the original linear scans
+returned (the first match), so the references stay fast on large datasets.
+'''
+
+def ref_random_shift_point(pt, max_shift = 5):
+    x,y = pt
+    vert_opts = ['up', 'down', 'centered']
+    hori_opts = ['left', 'right', 'centered']
+    v_d = random.choice(vert_opts)
+    h_d = random.choice(hori_opts)
+    v_s = random.choice(range(1, max_shift+1))
+    h_s = random.choice(range(1, max_shift+1))
+    if v_d == 'up':
+        y += v_s
+    elif v_d == 'down':
+        y -= v_s
+    if h_d == 'right':
+        x += h_s
+    elif h_d == 'left':
+        x -= h_s
+    if x < 0:
+       x = 0
+    if y < 0:
+       y = 0
+    return [x,y]
+
+def _ref_gsd_index(content):
+    index = {}
+    for i in content['images']:
+        if i['id'] in index:
+            continue
+        try:
+            index[i['id']] = i['acquisition_data']['GSD'][0]
+        except:
+            index[i['id']] = None
+    return index
+
+def _ref_anns_index(content):
+    index = {}
+    for a in content['annotations']:
+        index.setdefault(a['image_id'], []).append(a)
+    return index
+
+def ref_centerpoints(content, max_shift = 5):
+    new_anns = []
+    for a in content['annotations']:
+        new_a = a.copy()
+        x1, y1, w, h = a['bbox']
+        x_c = x1 + int(w/2)
+        y_c = y1 + int(h/2)
+        new_a['centerpoint'] = ref_random_shift_point([x_c, y_c], max_shift)
+        new_anns.append(new_a)
+    content['annotations'] = new_anns
+    return content
+
+def ref_with_points(content, points):
+    '''
+    ref_centerpoints with the points given rather than drawn, for the engines
+    which draw with numpy
+    '''
+    new_anns = []
+    for a, pt in zip(content['annotations'], points):
+        new_a = a.copy()
+        new_a['centerpoint'] = pt
+        new_anns.append(new_a)
+    content['annotations'] = new_anns
+    return content
+
+def ref_estimates(content):
+    gsds = _ref_gsd_index(content)
+    estimates = {}
+    for c in content['categories']:
+        estimates[c['id']] = {'name': c['name'], 'sizes': []}
+    for a in content['annotations']:
+        bbox = a['bbox']
+        size = max(bbox[2:3])
+        im_gsd = gsds.get(a['image_id'])
+        if im_gsd != None:
+          size_m = size*im_gsd
+          estimates[a['category_id']]['sizes'].append(size_m)
+    for k,v in estimates.items():
+        avg = np.mean(v['sizes'])
+        estimates[k]['average'] = avg
+    return estimates
+
+def ref_with_sizes(cats, estimates):
+    new_cats = []
+    for c in cats:
+        new_c = c.copy()
+        new_c['average_size'] = estimates[c['id']]['average']
+        new_cats.append(new_c)
+    return new_cats
+
+def ref_average_gsd(content):
+    gsd_vals = []
+    for i in content['images']:
+        if 'acquisition_data' in i.keys():
+            gsd_val = i['acquisition_data']['GSD'][0]
+            if gsd_val != None:
+                gsd_vals.append(gsd_val)
+    return np.average(gsd_vals)
+
+def ref_squares(content, avg_img_gsd, center_key = 'centerpoint'):
+    gsds = _ref_gsd_index(content)
+    sizes = {}
+    for c in content['categories']:
+        sizes.setdefault(c['id'], c['average_size'])
+    new_annotations = []
+    for a in content['annotations']:
+        new_a = a.copy()
+        [x,y] = a[center_key]
+        obj_size = sizes.get(a['category_id'])
+        im_gsd = gsds.get(a['image_id'])
+        if im_gsd != None:
+            ob_h_w = int(obj_size/im_gsd)
+        else:
+            ob_h_w = int(obj_size/avg_img_gsd)
+        new_a['bbox'] = [x - (ob_h_w/2), y - (ob_h_w/2), ob_h_w, ob_h_w]
+        new_annotations.append(new_a)
+    content['annotations'] = new_annotations
+    return content
+
+def ref_geo_shift(content, avg_img_gsd, shift_meters = 5, percentage_shift = 100, random_amount = False):
+    gsds = _ref_gsd_index(content)
+    on_image = _ref_anns_index(content)
+    images = content['images']
+    split_point = int(len(images)*(percentage_shift/100))
+    images_shuffle = random.sample(images, len(images))
+    images_shift = images_shuffle[:split_point]
+    images_regular = images_shuffle[split_point:]
+
+    new_anns = []
+    for i in images_shift:
+        im_gsd = gsds.get(i['id'])
+        if im_gsd:
+            if random_amount:
+                shift = random.choice(range(1, int(shift_meters/im_gsd)+1))
+            else:
+                shift = shift_meters/im_gsd
+        else:
+            if random_amount:
+                shift = random.choice(range(1, int(shift_meters/avg_img_gsd)+1))
+            else:
+                shift = shift_meters/avg_img_gsd
+        v_d = random.choice(['up', 'down', 'centered'])
+        h_d = random.choice(['left', 'right', 'centered'])
+        for a in on_image.get(i['id'], []):
+            new_a = a.copy()
+            x1, y1, w, h = a['bbox']
+            x_c = x1 + int(w/2)
+            y_c = y1 + int(h/2)
+            if v_d == 'up':
+                y_c += shift
+            elif v_d == 'down':
+                y_c -= shift
+            if h_d == 'right':
+                x_c += shift
+            elif h_d == 'left':
+                x_c -= shift
+            if x_c < 0:
+               x_c = 0
+            if y_c < 0:
+               y_c = 0
+            new_a['object_center'] = [x_c, y_c]
+            new_anns.append(new_a)
+
+    for i in images_regular:
+        for a in on_image.get(i['id'], []):
+            new_a = a.copy()
+            x1, y1, w, h = a['bbox']
+            new_a['object_center'] = [x1 + int(w/2), y1 + int(h/2)]
+            new_anns.append(new_a)
+
+    content['annotations'] = new_anns
+    return content
+
+def ref_single_cat(content, cat_id):
+    new_anns = [a for a in content['annotations'] if a['category_id'] == cat_id]
+    if len(new_anns) < 1:
+        return None
+    content['annotations'] = new_anns
+    for c in content['categories']:
+        if c['id'] == cat_id:
+            new_cats = [c]
+    content['categories'] = new_cats
+    on_image = _ref_anns_index(content)
+    content['images'] = [i for i in content['images'] if len(on_image.get(i['id'], [])) > 0]
+    return content
+
+def ref_full_scene(content, content_1c):
+    on_image = _ref_anns_index(content)
+    ims_options = content_1c['images']
+    random.shuffle(ims_options)
+    target_anns = len(content_1c['annotations'])
+    anns_mc = []
+    ims_mc = []
+    im_index = 0
+    while len(anns_mc) < target_anns:
+        add_im = ims_options[im_index]
+        ims_mc.append(add_im)
+        anns_mc.extend(on_image.get(add_im['id'], []))
+        im_index += 1
+    content['annotations'] = anns_mc
+    content['images'] = ims_mc
+    return content
+
+
+def synthetic_geo_coco(n_images = 300, anns_per_image = 20, n_categories = 8, missing_gsd = 0.1, seed = 0):
+    '''
+    PURPOSE: Make a geo-coco dataset with per-image GSDs, some images without
+             a GSD, skewed category frequencies, boxes touching the image
+             edges, and annotations not ordered by image
+    IN:
+     - n_images: int, number of images
+     - anns_per_image: float, average number of annotations per image
+     - n_categories: int, number of categories
+     - missing_gsd: float, fraction of images without a GSD
+     - seed: int, seed for the generator
+    OUT:
+     - content: dict, coco contents
+    '''
+    rng = np.random.default_rng(seed)
+    size = 1024
+    images = []
+    for n in range(n_images):
+        im = {'id': n + 1, 'file_name': f'{n + 1:06d}.png', 'width': size, 'height': size}
+        if rng.random() >= missing_gsd:
+            im['acquisition_data'] = {'GSD': [float(rng.choice([0.3, 0.5, 0.8, 1.2, 2.0]))]}
+        images.append(im)
+    # every category needs sizes from an image with a GSD
+    with_gsd = [i['id'] for i in images if 'acquisition_data' in i]
+
+    cats = [{'id': c + 1, 'name': f'category {c + 1}', 'supercategory': 'object'} for c in range(n_categories)]
+    weights = 1 / np.arange(1, n_categories + 1)
+    weights /= weights.sum()
+
+    annotations = []
+    for c in range(n_categories):
+        annotations.append((with_gsd[c % len(with_gsd)], c + 1))
+    for im in images:
+        for c in rng.choice(n_categories, size = rng.poisson(anns_per_image), p = weights):
+            annotations.append((im['id'], int(c) + 1))
+    rng.shuffle(annotations)
+
+    anns = []
+    for n, (im_id, cat_id) in enumerate(annotations):
+        w, h = (int(v) for v in rng.integers(4, 120, size = 2))
+        x, y = (int(v) for v in rng.integers(-w // 2, size - w // 2, size = 2))
+        x, y = max(x, 0), max(y, 0)
+        anns.append({'id': n + 1, 'image_id': im_id, 'category_id': cat_id, 'bbox': [x, y, w, h],
+                     'area': w * h, 'iscrowd': 0})
+
+    return {'info': {'description': 'synthetic geo-coco'}, 'licenses': [], 'images': images,
+            'categories': cats, 'annotations': anns}
+
+
+class Harness:
+    '''
+    PURPOSE: Run every engine on one synthetic dataset and record pass or
+             fail for each check
+    IN:
+     - content: dict, coco contents from synthetic_geo_coco
+     - work_dir: str, directory for the files the engines write
+     - seed: int, seed for the engines
+    '''
+    def __init__(self, content, work_dir, seed = 0):
+        self.work_dir = work_dir
+        self.seed = seed
+        self.text = json.dumps(content)
+        self.results = []
+
+        self.data_dir = os.path.join(work_dir, 'data') + '/'
+        self.img_dir = self.data_dir + 'images/'
+        os.makedirs(self.img_dir)
+        self.ann_fp = self.data_dir + 'train.json'
+        self.write(self.ann_fp, content)
+
+    def fresh(self):
+        # the original scripts loaded their own copy of the file each time
+        return json.loads(self.text)
+
+    def write(self, fp, content, **kwargs):
+        with open(fp, 'w') as f:
+            json.dump(content, f, default = materialize, **kwargs)
+
+    def read(self, fp):
+        with open(fp, 'r') as f:
+            return f.read()
+
+    def check(self, name, ok, detail = ''):
+        self.results.append((name, bool(ok), detail))
+        print(f' {"PASS" if ok else "FAIL"} {name}' + (f': {detail}' if detail else ''))
+
+    def dumps(self, content, **kwargs):
+        return json.dumps(content, default = materialize, **kwargs)
+
+    def check_invariants(self, name, content, center_key):
+        ''' non-negative centers, every input annotation exactly once, and
+            every category used is defined '''
+        anns = content['annotations']
+        centers = np.array([a[center_key] for a in anns], dtype = float).reshape(-1, 2)
+        self.check(f'{name}: non-negative centers', (centers >= 0).all())
+        ids = sorted(a['id'] for a in anns)
+        self.check(f'{name}: one output per annotation', ids == sorted(a['id'] for a in self.fresh()['annotations']))
+        defined = set(c['id'] for c in content['categories'])
+        self.check(f'{name}: category coverage', set(a['category_id'] for a in anns) <= defined)
+
+    def run_centerpoints(self):
+        random.seed(self.seed)
+        ref = self.dumps(ref_centerpoints(self.fresh(), 5))
+
+        random.seed(self.seed)
+        content = human_error.convert_anns_centerpoint_content(self.fresh(), 5)
+        self.check('centerpoints: in-memory engine', self.dumps(content) == ref)
+        self.check_invariants('centerpoints', content, 'centerpoint')
+
+        random.seed(self.seed)
+        fp = human_error.convert_anns_centerpoint(self.ann_fp, max_shift = 5)
+        self.check('centerpoints: file engine', self.read(fp) == ref)
+
+    def run_estimates_and_squares(self):
+        ref_est = ref_estimates(self.fresh())
+        est = human_error.estimate_category_size_content(self.fresh())
+        self.check('estimates: category sizes', self.dumps(est) == self.dumps(ref_est))
+
+        avg_gsd = ref_average_gsd(self.fresh())
+        self.check('estimates: average GSD', human_error.get_average_image_gsd_content(self.fresh()) == avg_gsd)
+
+        random.seed(self.seed)
+        cp = ref_centerpoints(self.fresh(), 5)
+        cp['categories'] = ref_with_sizes(cp['categories'], ref_est)
+        for a in cp['annotations']:
+            a['object_center'] = a['centerpoint']
+        cp_text = json.dumps(cp)
+        ref = self.dumps(ref_squares(json.loads(cp_text), avg_gsd))
+
+        sq = human_error.average_bboxes_from_centerpoints_content(json.loads(cp_text), avg_gsd)
+        self.check('squares: in-memory engine', self.dumps(sq) == ref)
+        sq = geo_error.average_bboxes_from_centerpoints_content(json.loads(cp_text), avg_gsd)
+        self.check('squares: geo in-memory engine', self.dumps(sq) == self.dumps(ref_squares(json.loads(cp_text), avg_gsd, 'object_center')))
+
+        cp_fp = self.data_dir + 'sq_in.json'
+        with open(cp_fp, 'w') as f:
+            f.write(cp_text)
+        fp = human_error.average_bboxes_from_centerpoints(cp_fp, avg_img_gsd = avg_gsd)
+        self.check('squares: file engine', self.read(fp) == ref)
+
+    def run_geo_shift(self):
+        avg_gsd = ref_average_gsd(self.fresh())
+        random.seed(self.seed)
+        ref_content = ref_geo_shift(self.fresh(), avg_gsd, 10, 30, True)
+        ref = self.dumps(ref_content)
+
+        random.seed(self.seed)
+        content = geo_error.convert_anns_centerpoint_meters_content(self.fresh(), avg_gsd, 10, 30, True)
+        self.check('geo shift: in-memory engine', self.dumps(content) == ref)
+        self.check_invariants('geo shift', content, 'object_center')
+        self.check_one_shift_per_image('geo shift', content)
+
+        random.seed(self.seed)
+        fp = geo_error.convert_anns_centerpoint_meters(self.ann_fp, avg_gsd, 10, 30, True)
+        self.check('geo shift: file engine', self.read(fp) == ref)
+
+        # the out of core engine writes images in partition order
+        random.seed(self.seed)
+        fp = geo_error.convert_anns_centerpoint_meters(self.ann_fp, avg_gsd, 10, 30, True, max_memory_mb = 1)
+        with open(fp, 'r') as f:
+            bounded = json.load(f)
+        same_anns = sorted(map(json.dumps, bounded.pop('annotations'))) == sorted(map(json.dumps, ref_content.pop('annotations')))
+        self.check('geo shift: out of core engine', same_anns and bounded == ref_content)
+
+    def check_one_shift_per_image(self, name, content):
+        ''' annotations on an image all move the same way, ignoring points
+            clipped at zero '''
+        offsets = {}
+        ok = True
+        for a in content['annotations']:
+            x1, y1, w, h = a['bbox']
+            x, y = a['object_center']
+            if x == 0 or y == 0:
+                continue
+            offset = (x - x1 - int(w/2), y - y1 - int(h/2))
+            ok = ok and offsets.setdefault(a['image_id'], offset) == offset
+        self.check(f'{name}: one shift per image', ok)
+        return offsets
+
+    def run_sampled_shift(self):
+        content = self.fresh()
+        avg_gsd = ref_average_gsd(content)
+        gsd_lookup = human_error.image_gsd_lookup(content)
+        anns = content['annotations']
+        draws = image_shift_draws(content['images'], gsd_lookup, avg_gsd, shift_meters = 10, random_amount = True,
+                                  seed = self.seed, stratify = ['gsd'], gsd_buckets = 4)
+        again = image_shift_draws(content['images'], gsd_lookup, avg_gsd, shift_meters = 10, random_amount = True,
+                                  seed = self.seed, stratify = ['gsd'], gsd_buckets = 4)
+        self.check('sampled shift: repeatable', all(np.array_equal(draws[k], again[k]) for k in ['order', 'shift', 'vertical', 'horizontal']))
+
+        selections = []
+        for p in [10, 30, 60]:
+            shifts, regular = geo_error.plan_image_shifts(content['images'], gsd_lookup, avg_gsd, 10, p, True, draws = draws)
+            selections.append(shifts)
+            self.check(f'sampled shift {p}%: every image once',
+                       sorted(list(shifts) + [i['id'] for i in regular]) == sorted(i['id'] for i in content['images']))
+        nested = all(set(a.items()) <= set(b.items()) for a, b in zip(selections, selections[1:]))
+        self.check('sampled shift: nested selections with shared shifts', nested)
+
+        # each GSD bucket gets its share of the selection, to within one image
+        gsds = np.array([gsd_lookup.get(i['id']) or np.nan for i in content['images']], dtype = float)
+        strata = gsd_strata(gsds, 4)
+        n = len(strata)
+        worst = 0
+        for k in [n // 10, n // 3, n // 2]:
+            taken = np.bincount(strata[draws['order'][:k]], minlength = strata.max() + 1)
+            expected = np.bincount(strata) * k / n
+            worst = max(worst, np.abs(taken - expected).max())
+        self.check('sampled shift: stratified shares', worst <= 1.5, f'largest deviation {worst:.2f} images')
+
+        new = geo_error.convert_anns_centerpoint_meters_content(content, avg_gsd, 10, 30, True, draws = draws)
+        self.check_invariants('sampled shift', new, 'object_center')
+        self.check_one_shift_per_image('sampled shift', new)
+
+    def write_images(self):
+        # image files to copy, only their sizes matter
+        for i in self.fresh()['images']:
+            fp = self.img_dir + i['file_name']
+            if not os.path.exists(fp):
+                with open(fp, 'wb') as f:
+                    f.write(b'\x89PNG' + bytes(i['id'] % 97))
+
+    def run_single_class(self):
+        content = self.fresh()
+        self.write_images()
+        cat_id = content['categories'][1]['id']
+
+        ref_1c = ref_single_cat(self.fresh(), cat_id)
+        new_1c = full_scene.single_cat_content(cat_id, self.fresh())
+        self.check('single class: in-memory engine', self.dumps(new_1c) == self.dumps(ref_1c))
+
+        gt_fp, ims_fp = full_scene.single_cat_dataset(cat_id, self.ann_fp, self.img_dir)
+        self.check('single class: file engine', self.read(gt_fp) == json.dumps(ref_1c, indent = 3))
+        self.check('single class: images copied', sorted(os.listdir(ims_fp)) == sorted(i['file_name'] for i in ref_1c['images']))
+        self.check('single class: one category', set(a['category_id'] for a in new_1c['annotations']) == {cat_id})
+
+        text_1c = json.dumps(ref_1c, indent = 3)
+        random.seed(self.seed)
+        ref_mc = ref_full_scene(self.fresh(), json.loads(text_1c))
+
+        random.seed(self.seed)
+        ims_options = json.loads(text_1c)['images']
+        full_scene.full_scene_order(ims_options)
+        counts = {k: len(v) for k, v in full_scene.anns_by_image(self.fresh()).items()}
+        ims_mc = full_scene.select_full_scene_images(ims_options, counts, len(ref_1c['annotations']))
+        self.check('full scene: image selection', [i['id'] for i in ims_mc] == [i['id'] for i in ref_mc['images']])
+        self.check('full scene: images from single class', set(i['id'] for i in ims_mc) <= set(i['id'] for i in ref_1c['images']))
+        self.check('full scene: enough annotations', len(ref_mc['annotations']) >= len(ref_1c['annotations']))
+
+    def run_full_scene_main(self):
+        '''
+        The whole of full_scene_vs_single_class.main, in memory, out of core
+        and resumed after an interruption, against the reference datasets
+        '''
+        self.write_images()
+        cat_id = self.fresh()['categories'][1]['id']
+        ref_1c = ref_single_cat(self.fresh(), cat_id)
+        text_1c = json.dumps(ref_1c, indent = 3)
+        random.seed(self.seed)
+        ref_mc = ref_full_scene(self.fresh(), json.loads(text_1c))
+        text_mc = json.dumps(ref_mc, indent = 3)
+
+        name = ref_1c['categories'][0]['name'].replace(' ', '-')
+        gt_1c = full_scene.single_cat_exp_dir(self.ann_fp, name) + os.path.basename(self.ann_fp)
+        gt_mc = full_scene.full_scene_exp_dir(gt_1c) + os.path.basename(self.ann_fp)
+        ims_mc = os.path.dirname(gt_mc) + '/images/'
+
+        def matches(label):
+            same_ims = sorted(os.listdir(ims_mc)) == sorted(i['file_name'] for i in ref_mc['images'])
+            self.check(f'full scene main: {label}', self.read(gt_1c) == text_1c and self.read(gt_mc) == text_mc and same_ims)
+
+        random.seed(self.seed)
+        full_scene.main(cat_id, self.ann_fp, self.img_dir)
+        matches('in-memory')
+
+        if image_partitions.ijson == None:
+            print(' SKIP full scene main: out of core, needs ijson installed')
+        else:
+            random.seed(self.seed)
+            full_scene.main(cat_id, self.ann_fp, self.img_dir, max_memory_mb = 1)
+            matches('out of core')
+
+        # interrupt: lose the full scene annotations and some images, and
+        # leave a stray file and a subdirectory behind
+        os.remove(gt_mc)
+        for name in sorted(os.listdir(ims_mc))[:3]:
+            os.remove(ims_mc + name)
+        with open(ims_mc + 'stray.png', 'wb') as f:
+            f.write(b'stray')
+        os.makedirs(ims_mc + 'subdir', exist_ok = True)
+        # a different random state, the earlier selection comes from the manifest
+        random.seed(self.seed + 1)
+        full_scene.main(cat_id, self.ann_fp, self.img_dir, resume = True)
+        shutil.rmtree(ims_mc + 'subdir')
+        matches('resumed')
+
+    def run_splits(self):
+        content = self.fresh()
+        split_fps = []
+        for n in range(3):
+            part = dict(content, images = content['images'][n::3])
+            on_part = set(i['id'] for i in part['images'])
+            part['annotations'] = [a for a in content['annotations'] if a['image_id'] in on_part]
+            fp = self.data_dir + f'split{n}.json'
+            self.write(fp, part)
+            split_fps.append(fp)
+
+        _, outputs = human_error.process_splits(split_fps, max_shift = 5, workers = 3, seed = self.seed)
+
+        reference = json.loads(self.read(split_fps[0]))
+        cats = ref_with_sizes(reference['categories'], ref_estimates(reference))
+        avg_gsd = ref_average_gsd(reference)
+        ok = True
+        for n, fp in enumerate(split_fps):
+            random.seed(self.seed + n)
+            split = json.loads(self.read(fp))
+            split['categories'] = cats
+            cp = ref_centerpoints(split, 5)
+            cp_text = json.dumps(cp)
+            sq = ref_squares(json.loads(cp_text), avg_gsd)
+            cp_fp, sq_fp = outputs[fp]
+            ok = ok and self.read(cp_fp) == cp_text and self.read(sq_fp) == json.dumps(sq)
+        self.check('splits: parallel engine', ok)
+
+    def run_daemon(self):
+        socket_path = os.path.join(self.work_dir, 'daemon.sock')
+        server = CocoDaemon(socket_path, max_cache_mb = 1024)
+        thread = threading.Thread(target = server.serve_forever, daemon = True)
+        thread.start()
+        try:
+            out_fp = self.data_dir + 'daemon_out.json'
+            request = {'ann_fp': self.ann_fp, 'seed': self.seed, 'out_fp': out_fp,
+                       'ops': [{'op': 'centerpoints', 'max_shift': 5}, {'op': 'squares'}]}
+            header = send_request(socket_path, request)
+
+            random.seed(self.seed)
+            cp = ref_centerpoints(self.fresh(), 5)
+            cp['categories'] = ref_with_sizes(cp['categories'], ref_estimates(self.fresh()))
+            ref = json.dumps(ref_squares(cp, ref_average_gsd(self.fresh())))
+            self.check('daemon: centerpoints and squares', header['status'] == 'ok' and self.read(out_fp) == ref)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def run_multi_annotator(self, n_boxes = 20000, max_shift = 5):
+        '''
+        The numpy engine can't match the random module draw for draw, so the
+        distribution of its offsets is compared with the reference's
+        '''
+        rng = np.random.default_rng(self.seed)
+        # far enough from the edges that nothing is clipped
+        bboxes = np.c_[rng.integers(50, 900, (n_boxes, 2)), rng.integers(4, 120, (n_boxes, 2))]
+        centers = bboxes[:, :2] + bboxes[:, 2:] // 2
+
+        points = human_error.annotator_centerpoints(bboxes, n_annotators = 5, max_shift = max_shift, seed = self.seed)
+        fast = (points - centers[:, None, :]).reshape(-1)
+
+        random.seed(self.seed)
+        ref = np.array([ref_random_shift_point(list(c), max_shift) for c in centers.tolist()
+                        for _ in range(5)]).reshape(n_boxes, 5, 2)
+        ref = (ref - centers[:, None, :]).reshape(-1)
+
+        values = np.arange(-max_shift, max_shift + 1)
+        p_fast = np.array([(fast == v).mean() for v in values])
+        p_ref = np.array([(ref == v).mean() for v in values])
+        tv = 0.5 * np.abs(p_fast - p_ref).sum()
+        self.check('multi annotator: offset distribution', tv < 0.01 and set(np.unique(fast)) <= set(values),
+                   f'total variation {tv:.4f}')
+        # annotators are independent of each other
+        corr = np.corrcoef(points[:, 0, 0] - centers[:, 0], points[:, 1, 0] - centers[:, 0])[0, 1]
+        self.check('multi annotator: independent annotators', abs(corr) < 0.03, f'correlation {corr:.4f}')
+
+    def run_multi_annotator_files(self, n_annotators = 3, max_shift = 5):
+        '''
+        The files of convert_anns_centerpoint_multi: the consensus and
+        per-annotator annotations, against the saved points, and the square
+        boxes made from the consensus
+        '''
+        content = self.fresh()
+        avg_gsd = ref_average_gsd(content)
+        content['categories'] = ref_with_sizes(content['categories'], ref_estimates(self.fresh()))
+        in_fp = self.data_dir + 'multi.json'
+        self.write(in_fp, content)
+        text = json.dumps(content)
+
+        for consensus in ['mean', 'median']:
+            fp, points = human_error.convert_anns_centerpoint_multi(in_fp, n_annotators = n_annotators, max_shift = max_shift,
+                                                                     consensus = consensus, write_variants = True, seed = self.seed)
+            base = fp[:-len(f'_{consensus}.json')]
+            saved = np.load(base + '.npy')
+            self.check(f'multi annotator {consensus}: saved points', np.array_equal(saved, points))
+
+            agreed = []
+            for pts in saved.tolist():
+                xs, ys = sorted(p[0] for p in pts), sorted(p[1] for p in pts)
+                if consensus == 'mean':
+                    agreed.append([sum(xs) / len(xs), sum(ys) / len(ys)])
+                else:
+                    agreed.append([float(xs[len(xs) // 2]), float(ys[len(ys) // 2])])
+            ref = ref_with_points(json.loads(text), agreed)
+            self.check(f'multi annotator {consensus}: consensus file', self.read(fp) == json.dumps(ref))
+
+            variants = all(self.read(base + f'_a{k}.json') == json.dumps(ref_with_points(json.loads(text), saved[:, k].tolist()))
+                           for k in range(n_annotators))
+            self.check(f'multi annotator {consensus}: annotator files', variants)
+
+            sq_fp = human_error.average_bboxes_from_centerpoints(fp, avg_img_gsd = avg_gsd)
+            self.check(f'multi annotator {consensus}: squares from consensus', self.read(sq_fp) == json.dumps(ref_squares(ref, avg_gsd)))
+
+    def run_tiling(self):
+        rng = np.random.default_rng(self.seed)
+        width, height, tile_size, overlap = 1000, 700, 128, 32
+        starts_x, starts_y = tile_starts(width, tile_size, overlap), tile_starts(height, tile_size, overlap)
+        bboxes = np.c_[rng.uniform(0, width, 500), rng.uniform(0, height, 500), rng.uniform(0, 200, 500), rng.uniform(0, 200, 500)]
+        ann_index, tile_x, tile_y, _ = assign_to_tiles(bboxes, starts_x, starts_y, tile_size, 0.0)
+
+        expected = set()
+        for n, (x, y, w, h) in enumerate(bboxes):
+            for i, x0 in enumerate(starts_x):
+                for j, y0 in enumerate(starts_y):
+                    if x0 < x + w and x0 + tile_size > x and y0 < y + h and y0 + tile_size > y:
+                        expected.add((n, i, j))
+        self.check('tiling: tile assignment', set(zip(ann_index.tolist(), tile_x.tolist(), tile_y.tolist())) == expected)
+
+    def run(self, checks):
+        for name in checks:
+            start = time.time()
+            getattr(self, f'run_{name}')()
+            print(f'   ({name} took {time.time() - start:.1f}s)')
+        return all(ok for _, ok, _ in self.results)
+
+
+CHECKS = ['centerpoints', 'estimates_and_squares', 'geo_shift', 'sampled_shift', 'single_class',
+          'full_scene_main', 'splits', 'daemon', 'multi_annotator', 'multi_annotator_files', 'tiling']
+
+
+if __name__ == "__main__":
+
+    # Initialize parser
+    parser = argparse.ArgumentParser()
+    # Adding optional argument
+    parser.add_argument("-n_images", "--n_images", help = "int, number of synthetic images", required = False, default = 300)
+    parser.add_argument("-anns_per_image", "--anns_per_image", help = "float, average annotations per image", required = False, default = 20)
+    parser.add_argument("-n_categories", "--n_categories", help = "int, number of synthetic categories", required = False, default = 8)
+    parser.add_argument("-seed", "--seed", help = "int, seed for the data and the engines", required = False, default = 0)
+    parser.add_argument("-checks", "--checks", nargs = '+', help = "Which checks to run, all by default", choices = CHECKS, required = False, default = CHECKS)
+    parser.add_argument("-keep", "--keep", help = "Keep the working directory of generated files", action = "store_true")
+
+    # Read arguments from command line
+    args = parser.parse_args()
+
+    content = synthetic_geo_coco(n_images = int(args.n_images), anns_per_image = float(args.anns_per_image),
+                                 n_categories = int(args.n_categories), seed = int(args.seed))
+    work_dir = tempfile.mkdtemp(prefix = 'coco_equivalence_')
+    print(f'Synthetic dataset: {len(content["images"])} images, {len(content["annotations"])} annotations, in {work_dir}')
+
+    try:
+        passed = Harness(content, work_dir, seed = int(args.seed)).run(args.checks)
+    finally:
+        if not args.keep:
+            shutil.rmtree(work_dir)
+
+    print('All checks passed' if passed else 'Some checks FAILED')
+    sys.exit(0 if passed else 1)
@@ -0,0 +1,396 @@
+import json
+import os
+import sys
+from tqdm import tqdm
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+from image_metadata import read_image_header
+
+try:
+    import rasterio
+    from rasterio.windows import Window
+except ImportError:
+    rasterio = None
+
+try:
+    import tifffile
+except ImportError:
+    tifffile = None
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# coco annotation keys holding a single [x,y] point
+POINT_KEYS = ['centerpoint', 'object_center']
+
+
+def tile_starts(length, tile_size, overlap):
+    '''
+    PURPOSE: Tile origins along one axis, stepping by tile_size - overlap, with
+             the last tile moved back to end on the image edge
+    IN:
+     - length: int, image width or height
+     - tile_size: int, tile width/height in pixels
+     - overlap: int, pixels shared by neighbouring tiles
+    OUT:
+     - starts: sorted numpy int array of tile origins
+    '''
+    if length <= tile_size:
+        return np.array([0])
+    stride = tile_size - overlap
+    starts = list(range(0, length - tile_size + 1, stride))
+    if starts[-1] + tile_size < length:
+        starts.append(length - tile_size)
+    return np.array(starts)
+
+def assign_to_tiles(bboxes, starts_x, starts_y, tile_size, min_visibility = 0.5, width = None, height = None):
+    '''
+    PURPOSE: Find every tile each bbox falls on and clip it to that tile. The
+             overlapping tile range for each box comes from a binary search
+             of the sorted tile origins, so this is O(n log n) per image
+    IN:
+     - bboxes: numpy array, n x 4 coco bboxes [x1, y1, w, h]
+     - starts_x, starts_y: sorted numpy arrays from tile_starts
+     - tile_size: int, tile width/height in pixels
+     - min_visibility: float, smallest fraction of a box's area which must be
+                       on a tile for it to be kept there
+     - width, height: int, optional, image size, tiles are cut short at its edge
+    OUT:
+     - ann_index: numpy int array, which bbox each kept pair is
+     - tile_x, tile_y: numpy int arrays, tile column/row of each pair
+     - clipped: numpy array, pair x 4 bboxes relative to their tile
+    '''
+    bboxes = np.asarray(bboxes, dtype = float).reshape(-1, 4)
+    x1, y1 = bboxes[:, 0], bboxes[:, 1]
+    x2, y2 = x1 + bboxes[:, 2], y1 + bboxes[:, 3]
+
+    # tiles starting in (x1 - tile_size, x2) overlap the box
+    col_lo = np.searchsorted(starts_x, x1 - tile_size, side = 'right')
+    col_hi = np.searchsorted(starts_x, x2, side = 'left')
+    row_lo = np.searchsorted(starts_y, y1 - tile_size, side = 'right')
+    row_hi = np.searchsorted(starts_y, y2, side = 'left')
+
+    # expand each box into its (column, row) candidates
+    n_cols = np.maximum(col_hi - col_lo, 0)
+    n_rows = np.maximum(row_hi - row_lo, 0)
+    n_pairs = n_cols * n_rows
+    ann_index = np.repeat(np.arange(len(bboxes)), n_pairs)
+    offset = np.arange(n_pairs.sum()) - np.repeat(np.cumsum(n_pairs) - n_pairs, n_pairs)
+    tile_x = col_lo[ann_index] + offset // np.maximum(n_rows[ann_index], 1)
+    tile_y = row_lo[ann_index] + offset % np.maximum(n_rows[ann_index], 1)
+
+    # clip each pair to its tile
+    tx, ty = starts_x[tile_x], starts_y[tile_y]
+    cx1 = np.maximum(x1[ann_index], tx) - tx
+    cy1 = np.maximum(y1[ann_index], ty) - ty
+    tx2, ty2 = tx + tile_size, ty + tile_size
+    if width != None:
+        tx2 = np.minimum(tx2, width)
+    if height != None:
+        ty2 = np.minimum(ty2, height)
+    cx2 = np.minimum(x2[ann_index], tx2) - tx
+    cy2 = np.minimum(y2[ann_index], ty2) - ty
+    clipped = np.stack([cx1, cy1, cx2 - cx1, cy2 - cy1], axis = 1)
+
+    area = bboxes[ann_index, 2] * bboxes[ann_index, 3]
+    clipped_area = clipped[:, 2] * clipped[:, 3]
+    visible = np.where(area > 0, clipped_area / np.where(area > 0, area, 1), 1.0)
+    keep = (clipped[:, 2] >= 0) & (clipped[:, 3] >= 0) & (visible >= min_visibility)
+
+    return ann_index[keep], tile_x[keep], tile_y[keep], clipped[keep]
+
+def _chip_annotation(a, bbox, x0, y0, w, h):
+    '''
+    PURPOSE: Move an annotation onto a tile. Points and polygon vertices are
+             shifted and clamped to the tile, which is an approximation of
+             true polygon clipping
+    '''
+    new_a = dict(a)
+    new_a['bbox'] = [float(v) for v in bbox]
+    if 'area' in a:
+        new_a['area'] = float(bbox[2] * bbox[3])
+    for key in POINT_KEYS:
+        if key in a:
+            x, y = a[key]
+            new_a[key] = [min(max(x - x0, 0), w), min(max(y - y0, 0), h)]
+    if isinstance(a.get('segmentation'), list):
+        new_a['segmentation'] = [[min(max(v - (x0 if n % 2 == 0 else y0), 0), w if n % 2 == 0 else h)
+                                  for n, v in enumerate(poly)] for poly in a['segmentation']]
+    elif 'segmentation' in a:
+        # run length encodings can't be shifted, drop them
+        new_a.pop('segmentation')
+    return new_a
+
+def _image_size(im, src):
+    '''
+    OUT: (width, height) from the image record, or else the image header
+    '''
+    if im.get('width') and im.get('height'):
+        return im['width'], im['height']
+    meta = read_image_header(src) or {}
+    if meta.get('width') and meta.get('height'):
+        return meta['width'], meta['height']
+    if Image != None:
+        # only the header is read here, so Pillow's size limit doesn't apply
+        Image.MAX_IMAGE_PIXELS = None
+        with Image.open(src) as pil_im:
+            return pil_im.size
+    raise ValueError(f'Could not find the size of {src}')
+
+def _tiff_memmap(src, width, height):
+    '''
+    PURPOSE: Memory map an uncompressed, contiguous tiff so tiles can be
+             sliced from it without reading the rest of the scene
+    OUT:
+     - array: numpy memmap as height x width (x bands), or None where the
+              file can't be memory mapped
+    '''
+    try:
+        array = tifffile.memmap(src, mode = 'r')
+    except (ValueError, TypeError, OSError):
+        return None
+    if array.shape[:2] == (height, width):
+        return array
+    # bands stored as separate planes
+    if array.ndim == 3 and array.shape[1:] == (height, width):
+        return array.transpose(1, 2, 0)
+    return None
+
+def chip_stem(file_name):
+    '''
+    IN:
+     - file_name: str, coco image file name, relative to the image directory
+    OUT:
+     - stem, ext: str, the chip file names are stem_x0_y0ext, relative to the
+                  chip directory. Subdirectories of the file name are kept,
+                  so scenes with the same name in different ones don't share
+                  chips, unless they'd lead outside the chip directory
+    '''
+    rel = os.path.normpath(file_name)
+    if os.path.isabs(rel) or rel.split(os.sep)[0] == os.pardir:
+        rel = os.path.basename(rel)
+    return os.path.splitext(rel)
+
+def check_chip_collisions(images):
+    '''
+    PURPOSE: Fail before chipping if two images would write the same chips.
+             Chip names end in two numbers, so they only collide when the 
+             stems and extensions do
+    IN:
+     - images: list of coco image dicts
+    '''
+    seen = {}
+    for im in images:
+        key = chip_stem(im['file_name'])
+        if key in seen:
+            raise ValueError(f'Images {seen[key]} and {im["id"]} would both write the chips {key[0]}_*{key[1]}')
+        seen[key] = im['id']
+
+def _write_chips(src, dst_dir, stem, ext, windows, width, height, max_decode_pixels = None):
+    '''
+    PURPOSE: Cut and save the tiles of one image, reading only each tile's
+             window where a windowed reader exists: rasterio for tiffs
+             (keeping their georeferencing), else a tifffile memory map for
+             uncompressed tiffs. Anything else, including compressed tiffs
+             without rasterio, is decoded whole by Pillow
+    IN:
+     - src: str, source image path
+     - dst_dir: str, directory for the chips
+     - stem, ext: str, chip file names are stem_x0_y0ext, see chip_stem
+     - windows: list of (x0, y0, w, h)
+     - width, height: int, image size
+     - max_decode_pixels: int, optional, see chip_dataset
+    OUT:
+     - names: list of chip file names relative to dst_dir, one per window
+    '''
+    names = [f'{stem}_{x0}_{y0}{ext}' for x0, y0, _, _ in windows]
+    os.makedirs(os.path.dirname(os.path.join(dst_dir, names[0])), exist_ok = True)
+    is_tiff = ext.lower() in ('.tif', '.tiff')
+
+    if rasterio != None and is_tiff:
+        with rasterio.open(src) as ds:
+            profile = ds.profile.copy()
+            for name, (x0, y0, w, h) in zip(names, windows):
+                window = Window(x0, y0, w, h)
+                profile.update(width = w, height = h, transform = ds.window_transform(window))
+                # tiling options of the source may not fit a small chip
+                profile.pop('blockxsize', None)
+                profile.pop('blockysize', None)
+                profile.pop('tiled', None)
+                with rasterio.open(os.path.join(dst_dir, name), 'w', **profile) as out:
+                    out.write(ds.read(window = window))
+        return names
+
+    array = _tiff_memmap(src, width, height) if tifffile != None and is_tiff else None
+    if array is not None:
+        for name, (x0, y0, w, h) in zip(names, windows):
+            chip = np.ascontiguousarray(array[y0:y0 + h, x0:x0 + w])
+            rgb = chip.ndim == 3 and chip.shape[2] in (3, 4)
+            tifffile.imwrite(os.path.join(dst_dir, name), chip, photometric = 'rgb' if rgb else 'minisblack')
+        return names
+
+    if Image == None:
+        raise ImportError('Chipping needs rasterio or tifffile (for tiffs) or Pillow installed')
+    # Pillow decodes the whole scene, so the limit is checked here and
+    # Pillow's own, which rejects large scenes, is lifted
+    if max_decode_pixels != None and width * height > max_decode_pixels:
+        raise ValueError(f'{src} is {width} x {height} pixels, over max_decode_pixels ({max_decode_pixels}), and would be '
+                         'decoded whole. Windowed reads need rasterio, or tifffile for uncompressed tiffs')
+    Image.MAX_IMAGE_PIXELS = None
+    with Image.open(src) as pil_im:
+        for name, (x0, y0, w, h) in zip(names, windows):
+            pil_im.crop((x0, y0, x0 + w, y0 + h)).save(os.path.join(dst_dir, name))
+    return names
+
+def chip_image(im, anns, img_dir, dst_dir, tile_size = 1024, overlap = 128, min_visibility = 0.5, keep_empty = False,
+               max_decode_pixels = None):
+    '''
+    PURPOSE: Cut one image into overlapping tiles and move its annotations
+             onto them
+    IN:
+     - im: dict, coco image record
+     - anns: list of the annotations on this image
+     - img_dir: str, directory holding the source images
+     - dst_dir: str, directory for the chips
+     - tile_size, overlap, min_visibility: see chip_dataset
+     - keep_empty: boolean, whether to keep tiles without annotations
+     - max_decode_pixels: int, optional, see chip_dataset
+    OUT:
+     - chips: list of (chip image record, list of chip annotations), the ids
+              are left for chip_dataset to assign
+    '''
+    src = os.path.join(img_dir, im['file_name'])
+    width, height = _image_size(im, src)
+    starts_x = tile_starts(width, tile_size, overlap)
+    starts_y = tile_starts(height, tile_size, overlap)
+
+    bboxes = np.array([a['bbox'] for a in anns], dtype = float).reshape(-1, 4)
+    ann_index, tile_x, tile_y, clipped = assign_to_tiles(bboxes, starts_x, starts_y, tile_size,
+                                                         min_visibility, width, height)
+
+    tiles = {}
+    for n, tx, ty, bbox in zip(ann_index, tile_x, tile_y, clipped):
+        tiles.setdefault((tx, ty), []).append((n, bbox))
+    if keep_empty:
+        for tx in range(len(starts_x)):
+            for ty in range(len(starts_y)):
+                tiles.setdefault((tx, ty), [])
+
+    keys = sorted(tiles)
+    windows = []
+    for tx, ty in keys:
+        x0, y0 = int(starts_x[tx]), int(starts_y[ty])
+        windows.append((x0, y0, min(tile_size, width - x0), min(tile_size, height - y0)))
+
+    stem, ext = chip_stem(im['file_name'])
+    names = _write_chips(src, dst_dir, stem, ext, windows, width, height, max_decode_pixels) if windows else []
+
+    chips = []
+    for key, name, (x0, y0, w, h) in zip(keys, names, windows):
+        chip_im = dict(im)
+        chip_im.update(file_name = name, width = w, height = h,
+                       source_image_id = im['id'], tile_offset = [x0, y0])
+        chip_anns = [_chip_annotation(anns[n], bbox, x0, y0, w, h) for n, bbox in tiles[key]]
+        chips.append((chip_im, chip_anns))
+    return chips
+
+def _chip_task(args):
+    return chip_image(*args)
+
+def chip_dataset(anns_path, img_dir, out_dir, tile_size = 1024, overlap = 128, min_visibility = 0.5,
+                 workers = None, keep_empty = False, max_decode_pixels = None):
+    '''
+    PURPOSE: Cut every scene of a coco dataset into overlapping tiles, in
+             parallel across images, and write a new coco file for the tiles.
+             Each tile keeps its scene's acquisition_data, so per-tile GSD is
+             carried over, and records its source image and offset
+    IN:
+     - anns_path: str, path to coco annotations
+     - img_dir: str, directory holding the images
+     - out_dir: str, directory for the new dataset, chips go in out_dir/images/
+                under the subdirectories of their scenes' file names
+     - tile_size: int, tile width/height in pixels
+     - overlap: int, pixels shared by neighbouring tiles
+     - min_visibility: float, smallest fraction of a box's area which must be
+                       on a tile for the annotation to be kept there
+     - workers: int, optional, number of worker processes
+     - keep_empty: boolean, whether to keep tiles without annotations
+     - max_decode_pixels: int, optional, largest image Pillow may decode
+                          whole, for images without a windowed reader. None
+                          lifts Pillow's limit, as scenes are expected to be
+                          large; set it to fail on images too big for memory
+    OUT:
+     - new_anns_path: str, path to the tiled annotations
+    '''
+    if overlap >= tile_size:
+        raise ValueError('The overlap must be smaller than the tile size')
+
+    with open(anns_path, 'r') as f:
+        content = json.load(f)
+    check_chip_collisions(content['images'])
+
+    dst_dir = os.path.join(out_dir, 'images')
+    os.makedirs(dst_dir, exist_ok = True)
+
+    image_anns = {}
+    for a in content['annotations']:
+        image_anns.setdefault(a['image_id'], []).append(a)
+
+    tasks = [(im, image_anns.get(im['id'], []), img_dir, dst_dir, tile_size, overlap, min_visibility, keep_empty,
+              max_decode_pixels)
+             for im in content['images']]
+
+    new_ims = []
+    new_anns = []
+    with ProcessPoolExecutor(max_workers = workers) as pool:
+        for chips in tqdm(pool.map(_chip_task, tasks, chunksize = 4), total = len(tasks), desc = 'Chipping Images'):
+            for chip_im, chip_anns in chips:
+                chip_im['id'] = len(new_ims) + 1
+                new_ims.append(chip_im)
+                for a in chip_anns:
+                    a['id'] = len(new_anns) + 1
+                    a['image_id'] = chip_im['id']
+                    new_anns.append(a)
+
+    content['images'] = new_ims
+    content['annotations'] = new_anns
+
+    new_anns_path = os.path.join(out_dir, os.path.basename(anns_path).split('.')[0] + f'_chips_{tile_size}.json')
+    if os.path.exists(new_anns_path):
+        os.remove(new_anns_path)
+    with open(new_anns_path, 'w') as f:
+        json.dump(content, f)
+
+    return new_anns_path
+
+
+if __name__ == "__main__":
+
+    # Initialize parser
+    parser = argparse.ArgumentParser()
+    # Adding optional argument
+    parser.add_argument("-ann_fp", "--ann_fp", help = "str, File path to coco annotations")
+    parser.add_argument("-img_fp", "--img_fp", help = "str, File path to images for the annotations")
+    parser.add_argument("-out_dir", "--out_dir", help = "str, Directory for the tiled dataset")
+    parser.add_argument("-tile_size", "--tile_size", help = "int, tile width/height in pixels", required = False, default = 1024)
+    parser.add_argument("-overlap", "--overlap", help = "int, pixels shared by neighbouring tiles", required = False, default = 128)
+    parser.add_argument("-min_visibility", "--min_visibility", help = "float, smallest fraction of a box which must be on a tile to keep it there", required = False, default = 0.5)
+    parser.add_argument("-workers", "--workers", help = "int, number of worker processes", required = False)
+    parser.add_argument("-keep_empty", "--keep_empty", help = "Keep tiles without annotations", action = "store_true")
+    parser.add_argument("-max_decode_pixels", "--max_decode_pixels", help = "int, largest image Pillow may decode whole where there is no windowed reader, no limit by default", required = False)
+
+    # Read arguments from command line
+    args = parser.parse_args()
+
+    try:
+        new_anns_path = chip_dataset(args.ann_fp, args.img_fp, args.out_dir, tile_size = int(args.tile_size),
+                                     overlap = int(args.overlap), min_visibility = float(args.min_visibility),
+                                     workers = int(args.workers) if args.workers else None, keep_empty = args.keep_empty,
+                                     max_decode_pixels = int(args.max_decode_pixels) if args.max_decode_pixels else None)
+    except ValueError as e:
+        print(f'ERROR: {e}')
+        sys.exit(1)
+    print(f'Tiled dataset written to {new_anns_path}')
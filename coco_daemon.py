@@ -0,0 +1,354 @@
+import json
+import os
+import sys
+import random
+import socket
+import socketserver
+import threading
+from contextlib import contextmanager
+from collections import OrderedDict
+import argparse
+from annotation_views import materialize
+import bboxes_to_centerpoints_human_error as human_error
+import bboxes_to_centerpoints_geo_error as geo_error
+import full_scene_vs_single_class as full_scene
+
+# parsed json takes several times its size on disk in memory
+MEMORY_FACTOR = 6
+# bytes of encoded json gathered before each write to the socket
+STREAM_CHUNK = 1 << 20
+
+
+class CachedDataset:
+    '''
+    PURPOSE: A parsed coco file along with the indexes the transforms need,
+             built once and reused by every request against that file
+    IN:
+     - ann_fp: str, path to coco annotation file
+    '''
+    def __init__(self, ann_fp):
+        stat = os.stat(ann_fp)
+        self.ann_fp = ann_fp
+        self.key = (stat.st_mtime_ns, stat.st_size)
+        self.cost = stat.st_size * MEMORY_FACTOR
+
+        with open(ann_fp, 'r') as f:
+            self.content = json.load(f)
+
+        self.gsd_lookup = human_error.image_gsd_lookup(self.content)
+        self.image_anns = geo_error.anns_by_image(self.content)
+        self._avg_gsd = None
+        self._estimates = None
+
+    def avg_gsd(self):
+        if self._avg_gsd == None:
+            self._avg_gsd = human_error.get_average_image_gsd_content(self.content)
+        return self._avg_gsd
+
+    def estimates(self):
+        if self._estimates == None:
+            self._estimates = human_error.estimate_category_size_content(self.content, self.gsd_lookup)
+        return self._estimates
+
+
+class DatasetCache:
+    '''
+    PURPOSE: Least recently used cache of CachedDatasets, bounded by their
+             estimated memory use. Files that change on disk are reloaded.
+             Files are parsed outside the cache-wide lock, under a lock per
+             path, so a cold load doesn't hold up requests for other files
+             and concurrent requests for one file parse it once
+    IN:
+     - max_bytes: int, memory budget for cached datasets
+    '''
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.datasets = OrderedDict()
+        self.lock = threading.Lock()
+        self.path_locks = {}
+
+    def _cached(self, ann_fp, key):
+        # call holding self.lock
+        dataset = self.datasets.get(ann_fp)
+        if dataset != None and dataset.key == key:
+            self.datasets.move_to_end(ann_fp)
+            return dataset
+        return None
+
+    def get(self, ann_fp):
+        ann_fp = os.path.abspath(ann_fp)
+        stat = os.stat(ann_fp)
+        key = (stat.st_mtime_ns, stat.st_size)
+        with self.lock:
+            dataset = self._cached(ann_fp, key)
+            if dataset != None:
+                return dataset
+            path_lock = self.path_locks.setdefault(ann_fp, threading.Lock())
+
+        with path_lock:
+            # another request may have loaded it while this one waited
+            with self.lock:
+                dataset = self._cached(ann_fp, key)
+            if dataset != None:
+                return dataset
+            dataset = CachedDataset(ann_fp)
+
+        with self.lock:
+            self.datasets[ann_fp] = dataset
+            self.datasets.move_to_end(ann_fp)
+
+            # evict the least recently used, always keeping the newest
+            while len(self.datasets) > 1 and self.used() > self.max_bytes:
+                self.datasets.popitem(last = False)
+            return dataset
+
+    def evict(self, ann_fp = None):
+        with self.lock:
+            if ann_fp == None:
+                self.datasets.clear()
+            else:
+                self.datasets.pop(os.path.abspath(ann_fp), None)
+
+    def used(self):
+        return sum(d.cost for d in self.datasets.values())
+
+    def stats(self):
+        with self.lock:
+            return {'datasets': list(self.datasets.keys()),
+                    'used_mb': round(self.used() / 1e6, 1),
+                    'max_mb': round(self.max_bytes / 1e6, 1)}
+
+
+def apply_op(content, op, dataset):
+    '''
+    PURPOSE: Run one transform on in-memory contents
+    IN:
+     - content: dict, coco contents, the cached dataset or a previous op's output
+     - op: dict, 'op' is one of 'centerpoints', 'geo_shift', 'squares' or
+           'single_class', the rest are that transform's parameters
+     - dataset: CachedDataset, the file the request started from
+    OUT:
+     - new_content: dict, transformed coco contents
+    '''
+    name = op['op']
+    original = content is dataset.content
+
+    if name == 'centerpoints':
+        return human_error.convert_anns_centerpoint_content(content, max_shift = int(op.get('max_shift', 5)))
+
+    elif name == 'geo_shift':
+        avg_gsd = float(op['avg_gsd']) if op.get('avg_gsd') else dataset.avg_gsd()
+        return geo_error.convert_anns_centerpoint_meters_content(
+            content, avg_gsd, shift_meters = int(op.get('shift_meters', 5)),
+            percentage_shift = int(op.get('shift_percent', 100)),
+            random_amount = op.get('random_amount', True), gsd_lookup = dataset.gsd_lookup,
+            image_anns = dataset.image_anns if original else None)
+
+    elif name == 'squares':
+        avg_gsd = float(op['avg_gsd']) if op.get('avg_gsd') else dataset.avg_gsd()
+        # use the sizes estimated from the cached file where the categories
+        # don't have them yet
+        if any('average_size' not in c for c in content['categories']):
+            content = dict(content)
+            content['categories'] = human_error.categories_with_sizes(content['categories'], dataset.estimates())
+        if op.get('center_key', 'centerpoint') == 'object_center':
+            return geo_error.average_bboxes_from_centerpoints_content(content, avg_gsd, gsd_lookup = dataset.gsd_lookup)
+        return human_error.average_bboxes_from_centerpoints_content(content, avg_gsd, gsd_lookup = dataset.gsd_lookup)
+
+    elif name == 'single_class':
+        new_content = full_scene.single_cat_content(int(op['cat_id']), content)
+        if new_content == None:
+            raise ValueError(f'There are no annotations of category {op["cat_id"]} in the dataset')
+        return new_content
+
+    raise ValueError(f'Unknown op: {name}')
+
+
+class SeedLock:
+    '''
+    PURPOSE: Transforms draw from the shared random module. Unseeded requests
+             hold the lock shared and run alongside each other, while a
+             seeded request holds it alone, so no other request draws from
+             the random module between its seed and its last draw. Waiting
+             seeded requests go ahead of newly arriving unseeded ones
+    '''
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.running = 0
+        self.seeded = False
+        self.seeded_waiting = 0
+
+    @contextmanager
+    def shared(self):
+        with self.condition:
+            while self.seeded or self.seeded_waiting:
+                self.condition.wait()
+            self.running += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.running -= 1
+                self.condition.notify_all()
+
+    @contextmanager
+    def exclusive(self):
+        with self.condition:
+            self.seeded_waiting += 1
+            while self.seeded or self.running:
+                self.condition.wait()
+            self.seeded_waiting -= 1
+            self.seeded = True
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.seeded = False
+                self.condition.notify_all()
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    '''
+    PURPOSE: Handle one request per connection. The request is a single line
+             of json, the response is a line of json, followed by the
+             resulting coco json when no out_fp was given. Encoded json is
+             gathered into large chunks, as each small write to the socket
+             is a separate send
+    '''
+    wbufsize = STREAM_CHUNK
+
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline())
+            header, content = self.server.run(request)
+        except Exception as e:
+            header, content = {'status': 'error', 'message': f'{type(e).__name__}: {e}'}, None
+
+        self.wfile.write((json.dumps(header) + '\n').encode())
+        if content != None:
+            encoder = json.JSONEncoder(default = materialize)
+            chunks = []
+            size = 0
+            for chunk in encoder.iterencode(content):
+                chunks.append(chunk)
+                size += len(chunk)
+                if size >= STREAM_CHUNK:
+                    self.wfile.write(''.join(chunks).encode())
+                    chunks = []
+                    size = 0
+            self.wfile.write(''.join(chunks).encode())
+
+
+class CocoDaemon(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    '''
+    PURPOSE: Long running server which keeps parsed, indexed coco files in
+             memory and runs transform requests against them
+    IN:
+     - socket_path: str, path of the unix socket to listen on
+     - max_cache_mb: int, memory budget for cached datasets
+    '''
+    daemon_threads = True
+
+    def __init__(self, socket_path, max_cache_mb = 4096):
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        self.cache = DatasetCache(max_cache_mb * 1e6)
+        # transforms draw from the shared random module, so seeded requests
+        # must not interleave with any other
+        self.transform_lock = SeedLock()
+        super().__init__(socket_path, RequestHandler)
+
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+
+    def run(self, request):
+        control = request.get('control')
+        if control == 'stats':
+            return dict(status = 'ok', **self.cache.stats()), None
+        elif control == 'evict':
+            self.cache.evict(request.get('ann_fp'))
+            return {'status': 'ok'}, None
+        elif control == 'shutdown':
+            threading.Thread(target = self.shutdown).start()
+            return {'status': 'ok'}, None
+
+        dataset = self.cache.get(request['ann_fp'])
+        content = dataset.content
+        seeded = request.get('seed') != None
+        with self.transform_lock.exclusive() if seeded else self.transform_lock.shared():
+            if seeded:
+                random.seed(request['seed'])
+            for op in request.get('ops', []):
+                content = apply_op(content, op, dataset)
+
+        header = {'status': 'ok', 'images': len(content['images']), 'annotations': len(content['annotations'])}
+        out_fp = request.get('out_fp')
+        if out_fp:
+            if os.path.exists(out_fp):
+                os.remove(out_fp)
+            with open(out_fp, 'w') as f:
+                json.dump(content, f, default = materialize)
+            header['out_fp'] = out_fp
+            return header, None
+        return header, content
+
+
+def send_request(socket_path, request, out = None):
+    '''
+    PURPOSE: Send a request to a running CocoDaemon
+    IN:
+     - socket_path: str, path of the daemon's unix socket
+     - request: dict, the request, see CocoDaemon.run and apply_op
+     - out: file, optional, where to stream returned coco json
+    OUT:
+     - header: dict, the daemon's response header
+    '''
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        sock.sendall((json.dumps(request) + '\n').encode())
+        with sock.makefile('rb') as f:
+            header = json.loads(f.readline())
+            while True:
+                chunk = f.read(1 << 20)
+                if not chunk:
+                    break
+                if out != None:
+                    out.write(chunk)
+    return header
+
+
+if __name__ == "__main__":
+
+    # Initialize parser
+    parser = argparse.ArgumentParser()
+    # Adding optional argument
+    parser.add_argument("-mode", "--mode", help = "'serve' to run the daemon, 'send' to send it a request", choices = ['serve', 'send'])
+    parser.add_argument("-socket", "--socket", help = "str, path of the unix socket", default = '/tmp/coco_daemon.sock')
+    parser.add_argument("-max_cache_mb", "--max_cache_mb", help = "int, memory budget for cached datasets", default = 4096)
+    parser.add_argument("-ann_fp", "--ann_fp", help = "str, File path to coco annotations to transform", required = False)
+    parser.add_argument("-ops", "--ops", help = "json list of transforms, e.g. '[{\"op\": \"centerpoints\", \"max_shift\": 5}, {\"op\": \"squares\"}]'", required = False, default = '[]')
+    parser.add_argument("-seed", "--seed", help = "int, seed for the random shifts", required = False)
+    parser.add_argument("-out_fp", "--out_fp", help = "str, where the daemon should write the result, otherwise it is streamed to stdout", required = False)
+    parser.add_argument("-control", "--control", help = "'stats', 'evict' or 'shutdown'", required = False)
+
+    # Read arguments from command line
+    args = parser.parse_args()
+
+    if args.mode == 'serve':
+        with CocoDaemon(args.socket, max_cache_mb = int(args.max_cache_mb)) as server:
+            print(f'Serving on {args.socket}')
+            server.serve_forever()
+    else:
+        request = {'ann_fp': args.ann_fp, 'ops': json.loads(args.ops)}
+        if args.control:
+            request['control'] = args.control
+        if args.seed != None:
+            request['seed'] = int(args.seed)
+        if args.out_fp:
+            request['out_fp'] = os.path.abspath(args.out_fp)
+        header = send_request(args.socket, request, out = sys.stdout.buffer)
+        print(json.dumps(header), file = sys.stderr)
+        if header['status'] != 'ok':
+            sys.exit(1)
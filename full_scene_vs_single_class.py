@@ -1,9 +1,15 @@
 import os
 import shutil
+import hashlib
 import json
 from tqdm import tqdm
 import random
 import argparse
+import sys
+import time
+from validate_coco import validate_coco
+from run_planner import plan_full_scene, print_plan, record_throughput
+from image_partitions import ImagePartitioner, iter_coco_annotations, load_coco_head, require_ijson
 
 def anns_on_image(im_id, contents):
     '''
@@ -25,15 +31,231 @@ def anns_on_image(im_id, contents):
     
     return on_image
 
-def single_cat_dataset(cat_id, coco_gt_fp, image_fp, new_exp_dir = False):
+def anns_by_image(contents):
+    '''
+    IN: 
+        - contents: coco gt json contents
+    OUT:
+        - image_anns: dict, image id to the list of annotations on that image,
+                      built in one pass instead of calling anns_on_image per image
+    '''
+    image_anns = {}
+    for a in contents['annotations']:
+        image_anns.setdefault(a['image_id'], []).append(a)
+    return image_anns
+
+def single_cat_dataset(cat_id, coco_gt_fp, image_fp, new_exp_dir = False, resume = False, verify = 'size', timings = None,
+                       stream = False):
   '''
   Creates a new coco experiment folder with only the annotations and images 
   relevant to a specific category/class. If no new directory is passed,
-  one will be generated.
+  one will be generated. With resume, work already done by an earlier 
+  (possibly interrupted) run is kept instead of starting over, see 
+  materialize_dataset. With stream, the annotations are streamed with ijson
+  and only those of the category are kept, instead of loading the file whole.
   '''
-  with open(coco_gt_fp, 'r') as f:
-      content = json.load(f)
+  if stream:
+      content = load_coco_head(coco_gt_fp)
+      content['annotations'] = [a for a in iter_coco_annotations(coco_gt_fp) if a['category_id'] == cat_id]
+  else:
+      with open(coco_gt_fp, 'r') as f:
+          content = json.load(f)
+  
+  content = single_cat_content(cat_id, content)
+
+  ### Exit the process if there aren't 
+  if content == None:
+      print('There are no annotations of this type in the dataset. Try another category.')
+      return
+  
+  cat_name = content['categories'][0]['name'].replace(' ', '-')
+
+  ### create the updated experimental folder
+  if not new_exp_dir:
+      new_exp_dir = single_cat_exp_dir(coco_gt_fp, cat_name)
+  if not os.path.exists(new_exp_dir):
+      os.mkdir(new_exp_dir)
+  new_gt_fp = new_exp_dir + coco_gt_fp.split('/')[-1]
+  new_image_fp = new_exp_dir + 'images/'
+
+  ### copy the images which still have annotations and write the annotations
+  materialize_dataset(content, image_fp, new_exp_dir, new_gt_fp, resume = resume, verify = verify, timings = timings)
   
+  return new_gt_fp, new_image_fp
+
+def _file_sha256(fp):
+  '''
+  Returns the sha256 hex digest of a file, read in chunks.
+  '''
+  digest = hashlib.sha256()
+  with open(fp, 'rb') as f:
+    for chunk in iter(lambda: f.read(1 << 20), b''):
+      digest.update(chunk)
+  return digest.hexdigest()
+
+class _HashingWriter:
+  '''
+  A binary file wrapper json.dump can write text to, which keeps the size and
+  sha256 of what was written, so neither needs the whole text in memory.
+  '''
+  def __init__(self, f, chunk = 1 << 20):
+    self.f = f
+    self.chunk = chunk
+    self.digest = hashlib.sha256()
+    self.size = 0
+    self.pending = []
+    self.pending_len = 0
+
+  def write(self, text):
+    self.pending.append(text)
+    self.pending_len += len(text)
+    if self.pending_len >= self.chunk:
+      self.flush()
+
+  def flush(self):
+    data = ''.join(self.pending).encode()
+    self.digest.update(data)
+    self.size += len(data)
+    self.f.write(data)
+    self.pending = []
+    self.pending_len = 0
+
+def load_journal(journal_fp):
+  '''
+  Reads the journal of completed items written by materialize_dataset, keyed
+  by destination path. A line cut short by a crash is ignored.
+  '''
+  done = {}
+  if not os.path.exists(journal_fp):
+    return done
+  with open(journal_fp, 'r') as f:
+    for line in f:
+      try:
+        entry = json.loads(line)
+      except ValueError:
+        continue
+      done[entry['dst']] = entry
+  return done
+
+def _is_done(entry, item, verify):
+  '''
+  Checks a journal entry against a planned item and the file on disk.
+  '''
+  if entry == None or not os.path.exists(item['dst']):
+    return False
+  if any(entry.get(k) != item[k] for k in ['src', 'size', 'mtime_ns']):
+    return False
+  if os.path.getsize(item['dst']) != item['size']:
+    return False
+  if verify == 'checksum':
+    return entry.get('sha256') != None and _file_sha256(item['dst']) == entry['sha256']
+  return True
+
+def add_timing(timings, name, amount, seconds):
+  '''
+  Adds a measurement to a timings dict of name to [amount, seconds], when one
+  is being kept. The script records them as throughput for -plan once done.
+  '''
+  if timings != None:
+    t = timings.setdefault(name, [0, 0.0])
+    t[0] += amount
+    t[1] += seconds
+
+def materialize_dataset(content, image_fp, exp_dir, gt_fp, resume = False, verify = 'size', indent = 3, timings = None):
+  '''
+  Copies the images of a coco dataset into exp_dir/images/ and writes its
+  annotations to gt_fp. The planned copies are written to a manifest, and each
+  finished item is recorded in a journal, so with resume an interrupted run
+  picks up where it stopped and a rerun with unchanged inputs only checks 
+  what is already there. Finished files are checked by size, or by sha256 
+  with verify = 'checksum'. Files are written under a temporary name and 
+  renamed once complete. Without resume, existing output is removed first.
+  Copy and json write times are added to timings, see add_timing.
+  '''
+  new_image_fp = exp_dir + 'images/'
+  manifest_fp = exp_dir + 'manifest.json'
+  journal_fp = exp_dir + 'journal.jsonl'
+
+  if not resume:
+    # ensure annotation file and image directory don't already exist
+    for fp in [gt_fp, manifest_fp, journal_fp]:
+      if os.path.exists(fp):
+        os.remove(fp)
+    if os.path.exists(new_image_fp):
+      shutil.rmtree(new_image_fp)
+  if not os.path.exists(new_image_fp):
+    os.mkdir(new_image_fp)
+
+  ### plan the copies
+  copies = []
+  for i in content['images']:
+    src = image_fp + i['file_name']
+    stat = os.stat(src)
+    copies.append({'src': src, 'dst': new_image_fp + i['file_name'], 
+                   'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns})
+
+  manifest = {'image_ids': [i['id'] for i in content['images']], 'copies': copies, 'annotations': {'dst': gt_fp}}
+  with open(manifest_fp + '.part', 'w') as f:
+    json.dump(manifest, f)
+  os.replace(manifest_fp + '.part', manifest_fp)
+
+  ### drop any file in the image folder which isn't part of this plan. File
+  ### names may hold subdirectories, which are left in place
+  planned = set(os.path.normpath(c['dst']) for c in copies)
+  for root, _, names in os.walk(new_image_fp):
+    for name in names:
+      fp = os.path.join(root, name)
+      if os.path.normpath(fp) not in planned:
+        os.remove(fp)
+
+  done = load_journal(journal_fp)
+  copied = 0
+  start = time.time()
+  with open(journal_fp, 'a') as journal:
+    for item in tqdm(copies, desc = 'Processing Images'):
+      if _is_done(done.get(item['dst']), item, verify):
+        continue
+      copied += item['size']
+      os.makedirs(os.path.dirname(item['dst']), exist_ok = True)
+      shutil.copy2(item['src'], item['dst'] + '.part')
+      os.replace(item['dst'] + '.part', item['dst'])
+      entry = dict(item)
+      if verify == 'checksum':
+        entry['sha256'] = _file_sha256(item['dst'])
+      journal.write(json.dumps(entry) + '\n')
+      journal.flush()
+    add_timing(timings, 'copy_bytes_per_s', copied, time.time() - start)
+
+    ### annotations last, so a finished annotation file means a finished dataset.
+    ### They're streamed to disk and hashed as they go, and replace the 
+    ### existing file only if they differ from it
+    start = time.time()
+    with open(gt_fp + '.part', 'wb') as f:
+      writer = _HashingWriter(f)
+      json.dump(content, writer, indent = indent)
+      writer.flush()
+    add_timing(timings, 'json_write_bytes_per_s', writer.size, time.time() - start)
+    ann_item = {'src': None, 'dst': gt_fp, 'size': writer.size, 'mtime_ns': None,
+                'sha256': writer.digest.hexdigest()}
+    manifest['annotations'] = ann_item
+
+    entry = done.get(gt_fp)
+    if _is_done(entry, ann_item, 'size') and entry.get('sha256') == ann_item['sha256']:
+      os.remove(gt_fp + '.part')
+    else:
+      os.replace(gt_fp + '.part', gt_fp)
+      journal.write(json.dumps(ann_item) + '\n')
+    journal.flush()
+    os.fsync(journal.fileno())
+
+  return manifest
+
+def single_cat_content(cat_id, content):
+  '''
+  Keeps only the annotations of one category, that category, and the images 
+  those annotations are on, without touching the input contents. Returns None
+  if there are no annotations of the category.
+  '''
   anns = content['annotations']
   ims = content['images']
   cats = content['categories']
@@ -44,104 +266,133 @@ def single_cat_dataset(cat_id, coco_gt_fp, image_fp, new_exp_dir = False):
     if a['category_id'] == cat_id:
       new_anns.append(a)
   
-  ### Exit the process if there aren't 
   if len(new_anns) < 1:
-      print('There are no annotations of this type in the dataset. Try another category.')
-      return
-  
-  content['annotations'] = new_anns
+      return None
 
   ### update the categories section
   for c in cats:
     if c['id'] == cat_id:
-        cat_name = c['name'].replace(' ', '-')
         new_cats = [c]
-  content['categories'] = new_cats
-
-  ### create the updated experimental folder
-  if not new_exp_dir:
-      new_exp_dir = '/'.join(coco_gt_fp.split('/')[:-2]) + '/'+ f'{cat_name}_' + coco_gt_fp.split('/')[-2] + '/'
-  # If the folder exists, delete it and everything in it
-  if not os.path.exists(new_exp_dir):
-      os.mkdir(new_exp_dir)
-  new_gt_fp = new_exp_dir + coco_gt_fp.split('/')[-1]
-  new_image_fp = new_exp_dir + 'images/'
-  # ensure annotation file and image directory don't already exist
-  if os.path.exists(new_gt_fp):
-    os.remove(new_gt_fp)
-  if os.path.exists(new_image_fp):
-    shutil.rmtree(new_image_fp)
-  os.mkdir(new_image_fp)
 
   ### ensure only images with annotations remain in the dataset
-  new_ims = []
-  for i in tqdm(ims, desc = 'Processing Images'):
-      anns_on_im = anns_on_image(i['id'], content)
-      if len(anns_on_im) > 0:
-          new_ims.append(i)
-          im_name = i['file_name']
-          src = image_fp + im_name
-          dst = new_image_fp + im_name
-          shutil.copy2(src, dst)
-  content['images'] = new_ims
-
-  with open(new_gt_fp, 'w') as f:
-    json.dump(content, f, indent = 3)
-  
-  return new_gt_fp, new_image_fp
+  on_cat = set(a['image_id'] for a in new_anns)
+  new_ims = [i for i in ims if i['id'] in on_cat]
 
-def main(cat_id, ann_fp, img_fp):
-    
+  new_content = dict(content)
+  new_content['annotations'] = new_anns
+  new_content['categories'] = new_cats
+  new_content['images'] = new_ims
+  return new_content
 
+def single_cat_exp_dir(coco_gt_fp, cat_name):
+  '''
+  Returns the single class experiment folder made next to the folder holding
+  coco_gt_fp.
+  '''
+  return '/'.join(coco_gt_fp.split('/')[:-2]) + '/'+ f'{cat_name}_' + coco_gt_fp.split('/')[-2] + '/'
 
-  print('Generating Single Class Dataset')
-  anns_1c, ims_1c = single_cat_dataset(cat_id, ann_fp, img_fp)
+def full_scene_exp_dir(anns_1c):
+  '''
+  Returns the full scene experiment folder made next to the single class one.
+  '''
+  return '/'.join(anns_1c.split('/')[:-2]) + '/'+ 'Full-Scene_' + anns_1c.split('/')[-2] + '/'
+
+def full_scene_order(ims_options, seed = None, manifest_fp = None):
+  '''
+  Shuffles the candidate full scene images in place. When resuming without a
+  seed (a manifest_fp is given), the previous run's images are tried first so
+  the same selection comes out again.
+  '''
+  if seed != None:
+    random.Random(seed).shuffle(ims_options)
+  else:
+    random.shuffle(ims_options)
+
+  if manifest_fp != None and seed == None and os.path.exists(manifest_fp):
+    with open(manifest_fp, 'r') as f:
+      previous = json.load(f)['image_ids']
+    rank = {im_id: n for n, im_id in enumerate(previous)}
+    ims_options.sort(key = lambda i: rank.get(i['id'], len(rank)))
+  return ims_options
+
+def select_full_scene_images(ims_options, ann_counts, target_anns):
+  '''
+  Takes images in order until they hold at least target_anns annotations of
+  any category, ann_counts being the number of annotations on each image.
+  '''
+  n_anns_mc = 0
+  ims_mc = []
+  im_index = 0
+  while n_anns_mc < target_anns:
+
+      add_im = ims_options[im_index]
+      ims_mc.append(add_im)
+      n_anns_mc += ann_counts.get(add_im['id'], 0)
+      im_index += 1
+  return ims_mc
 
-  ### open the existing files ###
-  with open(ann_fp, 'r') as f:
-    content = json.load(f)
+def main(cat_id, ann_fp, img_fp, resume = False, seed = None, verify = 'size', max_memory_mb = None, timings = None):
+  '''
+  Creates the single class dataset and a comparable full scene dataset. With
+  resume, an interrupted or repeated run reuses the images already copied and
+  the previous run's full scene image selection, see materialize_dataset. 
+  A seed makes the full scene image selection repeatable. With max_memory_mb,
+  the full annotation file is never loaded whole, which needs ijson 
+  installed: the single class annotations are filtered from a stream, and 
+  the full scene ones are grouped by image out of core.
+  Read, write and copy times are added to timings, see add_timing.
+  '''
+  if max_memory_mb:
+    require_ijson()
+
+  print('Generating Single Class Dataset')
+  anns_1c, ims_1c = single_cat_dataset(cat_id, ann_fp, img_fp, resume = resume, verify = verify, timings = timings,
+                                       stream = bool(max_memory_mb))
 
   with open(anns_1c, 'r') as f:
     content_1c = json.load(f)
 
-  # shuffle the images used in the single class experiment
-  ims_options = content_1c['images']
-  random.shuffle(ims_options)
-
   # the number of annotations we would like to have in our full scene dataset
   target_anns = len(content_1c['annotations'])
   
   ### Make the new experimental directory
-  exp_dir_mc = '/'.join(anns_1c.split('/')[:-2]) + '/'+ 'Full-Scene_' + anns_1c.split('/')[-2] + '/'
+  exp_dir_mc = full_scene_exp_dir(anns_1c)
   if not os.path.exists(exp_dir_mc):
     os.mkdir(exp_dir_mc)
 
-  ims_mc_fp = exp_dir_mc + 'images/'
   gt_mc_fp = exp_dir_mc + anns_1c.split('/')[-1]
-  if os.path.exists(gt_mc_fp):
-    os.remove(gt_mc_fp)
-  if os.path.exists(ims_mc_fp):
-    shutil.rmtree(ims_mc_fp)
-  os.mkdir(ims_mc_fp)
+
+  # shuffle the images used in the single class experiment
+  ims_options = content_1c['images']
+  full_scene_order(ims_options, seed, exp_dir_mc + 'manifest.json' if resume else None)
+
+  ### group the full annotation file by image ###
+  if max_memory_mb:
+    content = load_coco_head(ann_fp)
+    parts = ImagePartitioner(max_memory_mb, expected_bytes = os.path.getsize(ann_fp))
+    parts.add_all(iter_coco_annotations(ann_fp))
+    ann_counts = parts.counts
+  else:
+    start = time.time()
+    with open(ann_fp, 'r') as f:
+      content = json.load(f)
+    add_timing(timings, 'json_read_bytes_per_s', os.path.getsize(ann_fp), time.time() - start)
+    image_anns = anns_by_image(content)
+    ann_counts = {k: len(v) for k, v in image_anns.items()}
 
   ### Create multiclass annotation and image contents ###
   # loop at random through images with at least one of the target class and get 
   # all the catgeories on them
-  anns_mc = []
-  ims_mc = []
-  im_index = 0
   print('Generating Comparable Full Scene Dataset')
-  while len(anns_mc) < target_anns:
+  ims_mc = select_full_scene_images(ims_options, ann_counts, target_anns)
 
-      add_im = ims_options[im_index]
-      im_src = ims_1c + add_im['file_name']
-      im_dst = ims_mc_fp + add_im['file_name']
-      shutil.copy2(im_src, im_dst)
-      ims_mc.append(add_im)
-      im_id = add_im['id']
-      anns_add = anns_on_image(im_id, content)
-      anns_mc.extend(anns_add)
-      im_index += 1
+  if max_memory_mb:
+    with parts:
+      image_anns = dict(parts.iter_groups(set(i['id'] for i in ims_mc)))
+
+  anns_mc = []
+  for i in ims_mc:
+      anns_mc.extend(image_anns.get(i['id'], []))
 
   print(f'\nAnnotations in the single class dataset: {target_anns}')
   print('Annotations in the full scene comparison dataset: ',len(anns_mc))
@@ -151,8 +402,7 @@ def main(cat_id, ann_fp, img_fp):
   content['annotations'] = anns_mc
   content['images'] = ims_mc
 
-  with open(gt_mc_fp, 'w') as f:
-    json.dump(content, f, indent=3)
+  materialize_dataset(content, ims_1c, exp_dir_mc, gt_mc_fp, resume = resume, verify = verify, timings = timings)
   return 
 
 if __name__ == "__main__":
@@ -163,8 +413,40 @@ if __name__ == "__main__":
     parser.add_argument("-cat_id", "--cat_id", help = "int, COCO category id of the class you would like to focus on for this experiment")
     parser.add_argument("-ann_fp", "--ann_fp", help = "str, File path to coco annotations")
     parser.add_argument("-img_fp", "--img_fp", help = "str, File path to images for the annotations", required = False)
+    parser.add_argument("-resume", "--resume", help = "Keep the work of an earlier, possibly interrupted, run instead of starting over", action = "store_true")
+    parser.add_argument("-verify", "--verify", help = "How finished files are checked when resuming, 'size' or 'checksum'", choices = ['size', 'checksum'], default = 'size')
+    parser.add_argument("-seed", "--seed", help = "int, seed for the full scene image selection", required = False)
+    parser.add_argument("-max_memory_mb", "--max_memory_mb", help = "int, group annotations by image out of core within roughly this much memory", required = False)
+    parser.add_argument("-plan", "--plan", help = "Report what the run would copy and write, and whether it fits on disk, without doing it", action = "store_true")
     
     # Read arguments from command line
     args = parser.parse_args()
     
-    main(cat_id = int(args.cat_id), ann_fp = args.ann_fp, img_fp = args.img_fp)
\ No newline at end of file
+    # image paths are built as img_fp + file_name from here on
+    img_fp = os.path.join(args.img_fp, '') if args.img_fp else args.img_fp
+    
+    # with max_memory_mb the file is streamed rather than loaded, from here on
+    max_memory_mb = int(args.max_memory_mb) if args.max_memory_mb else None
+    if max_memory_mb:
+        require_ijson()
+    
+    # check the file and images before anything is copied
+    report = validate_coco(args.ann_fp, img_dir = img_fp, cat_id = int(args.cat_id), stream = bool(max_memory_mb))
+    if report['errors']:
+        sys.exit(1)
+    
+    if args.plan:
+        plan = plan_full_scene(int(args.cat_id), args.ann_fp, img_fp, 
+                               seed = int(args.seed) if args.seed else None, resume = args.resume,
+                               max_memory_mb = max_memory_mb)
+        print_plan(plan)
+        sys.exit(0 if plan['fits'] else 1)
+    
+    timings = {}
+    main(cat_id = int(args.cat_id), ann_fp = args.ann_fp, img_fp = img_fp, resume = args.resume, 
+         seed = int(args.seed) if args.seed else None, verify = args.verify,
+         max_memory_mb = max_memory_mb, timings = timings)
+    
+    # measured throughput for later -plan runs
+    for name, (amount, seconds) in timings.items():
+        record_throughput(name, amount, seconds)
\ No newline at end of file
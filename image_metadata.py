@@ -0,0 +1,353 @@
+import os
+import struct
+import sqlite3
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from tqdm import tqdm
+import argparse
+
+# GeoTIFF tags and keys
+MODEL_PIXEL_SCALE_TAG = 33550
+GEO_KEY_DIRECTORY_TAG = 34735
+GT_MODEL_TYPE_KEY = 1024
+PROJECTED_CS_TYPE_KEY = 3072
+PROJ_LINEAR_UNITS_KEY = 3076
+MODEL_TYPE_PROJECTED = 1
+LINEAR_UNIT_METER = 9001
+# EPSG projected systems known to be in meters when a file leaves out its
+# linear units: UTM zones on WGS 84, NAD83 and ETRS89
+METRIC_EPSG_RANGES = [(32601, 32660), (32701, 32760), (26901, 26923), (25828, 25838)]
+
+# tiff field types: (struct code, size in bytes)
+TIFF_TYPES = {1: ('B', 1), 3: ('H', 2), 4: ('I', 4), 6: ('b', 1), 8: ('h', 2),
+              9: ('i', 4), 11: ('f', 4), 12: ('d', 8), 16: ('Q', 8), 17: ('q', 8)}
+
+# the index is kept in the user's cache rather than next to the images, as
+# image directories are often read-only mounts
+CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'), 'coco_scripts')
+DB_NAME = 'image_metadata.sqlite'
+
+
+def _png_header(f):
+    '''
+    IN: f: binary file positioned at the start
+    OUT: dict with width and height, or None
+    '''
+    data = f.read(24)
+    if len(data) < 24 or data[12:16] != b'IHDR':
+        return None
+    width, height = struct.unpack('>II', data[16:24])
+    return {'width': width, 'height': height}
+
+def _jpeg_header(f):
+    '''
+    IN: f: binary file positioned at the start
+    OUT: dict with width and height read from the first SOF marker, or None
+    '''
+    f.read(2)
+    while True:
+        marker = f.read(2)
+        if len(marker) < 2 or marker[0] != 0xFF:
+            return None
+        code = marker[1]
+        # standalone markers have no length
+        if code == 0x01 or 0xD0 <= code <= 0xD7:
+            continue
+        length = struct.unpack('>H', f.read(2))[0]
+        if 0xC0 <= code <= 0xCF and code not in (0xC4, 0xC8, 0xCC):
+            _, height, width = struct.unpack('>BHH', f.read(5))
+            return {'width': width, 'height': height}
+        f.seek(length - 2, os.SEEK_CUR)
+
+def _tiff_values(f, endian, field_type, count, value_bytes, big):
+    '''
+    PURPOSE: Read the values of one tiff IFD entry, inline or at an offset
+    '''
+    if field_type not in TIFF_TYPES:
+        return None
+    code, size = TIFF_TYPES[field_type]
+    total = size * count
+    inline = 8 if big else 4
+    if total > inline:
+        offset = struct.unpack(endian + ('Q' if big else 'I'), value_bytes)[0]
+        f.seek(offset)
+        data = f.read(total)
+    else:
+        data = value_bytes[:total]
+    return list(struct.unpack(endian + code * count, data))
+
+def _tiff_header(f):
+    '''
+    IN: f: binary file positioned at the start
+    OUT: dict with width, height and, for GeoTIFFs, pixel scale and a GSD in
+         meters when the file is in a projected coordinate system known to
+         be metric
+    '''
+    head = f.read(16)
+    endian = '<' if head[:2] == b'II' else '>'
+    magic = struct.unpack(endian + 'H', head[2:4])[0]
+    big = magic == 43
+    if big:
+        ifd_offset = struct.unpack(endian + 'Q', head[8:16])[0]
+        count_fmt, entry_fmt, entry_size = 'Q', 'HHQ8s', 20
+    else:
+        ifd_offset = struct.unpack(endian + 'I', head[4:8])[0]
+        count_fmt, entry_fmt, entry_size = 'H', 'HHI4s', 12
+
+    f.seek(ifd_offset)
+    n_entries = struct.unpack(endian + count_fmt, f.read(struct.calcsize(count_fmt)))[0]
+    entries = f.read(n_entries * entry_size)
+
+    tags = {}
+    for n in range(n_entries):
+        tag, field_type, count, value_bytes = struct.unpack(endian + entry_fmt, entries[n * entry_size:(n + 1) * entry_size])
+        if tag in (256, 257, MODEL_PIXEL_SCALE_TAG, GEO_KEY_DIRECTORY_TAG):
+            tags[tag] = _tiff_values(f, endian, field_type, count, value_bytes, big)
+
+    if 256 not in tags or 257 not in tags:
+        return None
+    meta = {'width': tags[256][0], 'height': tags[257][0]}
+
+    scale = tags.get(MODEL_PIXEL_SCALE_TAG)
+    if scale:
+        meta['pixel_scale_x'], meta['pixel_scale_y'] = scale[0], scale[1]
+
+        # only trust the scale as a GSD for projected, metric, coordinates
+        geo_keys = {}
+        directory = tags.get(GEO_KEY_DIRECTORY_TAG) or []
+        for n in range(4, len(directory) - 3, 4):
+            key_id, location, _, value = directory[n:n + 4]
+            if location == 0:
+                geo_keys[key_id] = value
+        projected = geo_keys.get(GT_MODEL_TYPE_KEY) == MODEL_TYPE_PROJECTED
+        if PROJ_LINEAR_UNITS_KEY in geo_keys:
+            metric = geo_keys[PROJ_LINEAR_UNITS_KEY] == LINEAR_UNIT_METER
+        else:
+            # the units come from the EPSG code, which may be in feet, so
+            # only codes known to be metric are trusted
+            epsg = geo_keys.get(PROJECTED_CS_TYPE_KEY)
+            metric = any(lo <= (epsg or 0) <= hi for lo, hi in METRIC_EPSG_RANGES)
+        if projected and metric:
+            meta['gsd'] = (scale[0] + scale[1]) / 2
+    return meta
+
+def read_image_header(fp):
+    '''
+    PURPOSE: Read an image's dimensions, and GeoTIFF pixel scale where there
+             is one, from its header alone without decoding the raster
+    IN:
+     - fp: str, path to a png, jpeg or tiff image
+    OUT:
+     - meta: dict with 'width', 'height' and, where available,
+             'pixel_scale_x', 'pixel_scale_y' and 'gsd', or None if the
+             format isn't recognised
+    '''
+    with open(fp, 'rb') as f:
+        magic = f.read(4)
+        f.seek(0)
+        try:
+            if magic == b'\x89PNG':
+                return _png_header(f)
+            elif magic[:2] == b'\xff\xd8':
+                return _jpeg_header(f)
+            elif magic[:2] in (b'II', b'MM'):
+                return _tiff_header(f)
+        except struct.error:
+            return None
+    return None
+
+
+class MetadataIndex:
+    '''
+    PURPOSE: Persistent table of image header metadata, keyed by path and
+             kept valid by each file's mtime and size, so headers are only
+             read again for new or changed files
+    IN:
+     - db_fp: str, path to the sqlite file
+    '''
+    COLUMNS = ['width', 'height', 'pixel_scale_x', 'pixel_scale_y', 'gsd']
+
+    def __init__(self, db_fp):
+        self.db_fp = db_fp
+        # several processes may share one index, so wait on each other's writes
+        self.db = sqlite3.connect(db_fp, timeout = 60)
+        self.db.execute('CREATE TABLE IF NOT EXISTS images (path TEXT PRIMARY KEY, mtime_ns INTEGER, size INTEGER, '
+                        'width INTEGER, height INTEGER, pixel_scale_x REAL, pixel_scale_y REAL, gsd REAL)')
+        self.db.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.db.close()
+
+    @classmethod
+    def open(cls, db_fp = None):
+        '''
+        PURPOSE: Open the index at db_fp, or else the first writable one of
+                 the user cache directory, the temp directory and, failing
+                 both, memory (which lasts only this run)
+        IN:
+         - db_fp: str, optional, index location
+        OUT:
+         - index: MetadataIndex
+        '''
+        if db_fp != None:
+            return cls(db_fp)
+        for directory in [CACHE_DIR, os.path.join(tempfile.gettempdir(), 'coco_scripts')]:
+            fp = os.path.join(directory, DB_NAME)
+            try:
+                os.makedirs(directory, exist_ok = True)
+                if not os.access(directory, os.W_OK) or (os.path.exists(fp) and not os.access(fp, os.W_OK)):
+                    continue
+                return cls(fp)
+            except (OSError, sqlite3.Error):
+                continue
+        return cls(':memory:')
+
+    def update(self, paths, workers = 16):
+        '''
+        PURPOSE: Read the headers of any paths that are new or have changed,
+                 with a thread pool, and store them
+        IN:
+         - paths: list of strs, image paths
+         - workers: int, number of reader threads
+        OUT:
+         - n_read: int, number of headers read
+        '''
+        cached = {p: (m, s) for p, m, s in self.db.execute('SELECT path, mtime_ns, size FROM images')}
+
+        stale = []
+        for fp in paths:
+            try:
+                stat = os.stat(fp)
+            except OSError:
+                continue
+            if cached.get(fp) != (stat.st_mtime_ns, stat.st_size):
+                stale.append((fp, stat.st_mtime_ns, stat.st_size))
+
+        def read(item):
+            fp, mtime_ns, size = item
+            try:
+                meta = read_image_header(fp) or {}
+            except OSError:
+                meta = {}
+            return (fp, mtime_ns, size) + tuple(meta.get(c) for c in self.COLUMNS)
+
+        with ThreadPoolExecutor(max_workers = workers) as pool:
+            rows = list(tqdm(pool.map(read, stale), total = len(stale), desc = 'Reading Image Headers'))
+
+        self.db.executemany('INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows)
+        self.db.commit()
+        return len(rows)
+
+    def get(self, fp):
+        '''
+        IN:
+         - fp: str, image path
+        OUT:
+         - meta: dict of the stored columns, or None if it isn't indexed
+        '''
+        row = self.db.execute('SELECT width, height, pixel_scale_x, pixel_scale_y, gsd FROM images WHERE path = ?', (fp,)).fetchone()
+        if row == None:
+            return None
+        return dict(zip(self.COLUMNS, row))
+
+
+def image_metadata(content, img_dir, db_fp = None, workers = 16):
+    '''
+    PURPOSE: Get header metadata for every image in a coco file, reading
+             headers in parallel only where the persistent index is out of date
+    IN:
+     - content: dict, coco contents
+     - img_dir: str, directory holding the images
+     - db_fp: str, optional, index location, defaults to one in the user
+              cache directory, see MetadataIndex.open
+     - workers: int, number of reader threads
+    OUT:
+     - meta: dict, image id to its metadata dict (see read_image_header)
+    '''
+    # one index serves every image directory, so it is keyed by absolute path
+    paths = {i['id']: os.path.abspath(os.path.join(img_dir, i['file_name'])) for i in content['images']}
+
+    meta = {}
+    with MetadataIndex.open(db_fp) as index:
+        index.update(list(paths.values()), workers = workers)
+        for im_id, fp in paths.items():
+            m = index.get(fp)
+            if m != None:
+                meta[im_id] = m
+    return meta
+
+def gsd_lookup_with_metadata(gsd_lookup, meta):
+    '''
+    PURPOSE: Fill in GSDs missing from a coco file with those read from the
+             image headers. GSDs recorded in the coco file take precedence
+    IN:
+     - gsd_lookup: dict, image id to GSD or None, from image_gsd_lookup
+     - meta: dict, from image_metadata
+    OUT:
+     - lookup: dict, image id to GSD or None
+    '''
+    lookup = dict(gsd_lookup)
+    for im_id, m in meta.items():
+        if lookup.get(im_id) == None and m.get('gsd'):
+            lookup[im_id] = m['gsd']
+    return lookup
+
+def image_bounds(content, meta = None):
+    '''
+    IN:
+     - content: dict, coco contents
+     - meta: dict, optional, from image_metadata, used where an image record
+             has no width or height
+    OUT:
+     - bounds: dict, image id to (width, height), for images where both are known
+    '''
+    meta = meta or {}
+    bounds = {}
+    for i in content['images']:
+        m = meta.get(i['id'], {})
+        w = i.get('width') or m.get('width')
+        h = i.get('height') or m.get('height')
+        if w and h:
+            bounds[i['id']] = (w, h)
+    return bounds
+
+def clip_bbox(bbox, width, height):
+    '''
+    IN:
+     - bbox: list, coco bbox [x1, y1, w, h]
+     - width, height: image dimensions
+    OUT:
+     - bbox: list, the bbox clipped to the image
+    '''
+    x1 = min(max(bbox[0], 0), width)
+    y1 = min(max(bbox[1], 0), height)
+    x2 = min(max(bbox[0] + bbox[2], 0), width)
+    y2 = min(max(bbox[1] + bbox[3], 0), height)
+    return [x1, y1, x2 - x1, y2 - y1]
+
+
+if __name__ == "__main__":
+
+    # Initialize parser
+    parser = argparse.ArgumentParser()
+    # Adding optional argument
+    parser.add_argument("-img_fp", "--img_fp", help = "str, File path to the images to index")
+    parser.add_argument("-db_fp", "--db_fp", help = "str, where to keep the index, defaults to one in the user cache directory", required = False)
+    parser.add_argument("-workers", "--workers", help = "int, number of reader threads", required = False, default = 16)
+
+    # Read arguments from command line
+    args = parser.parse_args()
+
+    img_dir = os.path.abspath(args.img_fp)
+    paths = [os.path.join(img_dir, n) for n in sorted(os.listdir(img_dir)) if not n.startswith('.')]
+    with MetadataIndex.open(args.db_fp) as index:
+        n_read = index.update(paths, workers = int(args.workers))
+        n_gsd = sum(1 for fp in paths if (index.get(fp) or {}).get('gsd') != None)
+        db_fp = index.db_fp
+    print(f'Read {n_read} of {len(paths)} image headers, {n_gsd} images have a GSD, index at {db_fp}')
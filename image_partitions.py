@@ -0,0 +1,230 @@
+import json
+import os
+import math
+import shutil
+import tempfile
+import zlib
+from annotation_views import materialize
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+# parsed annotations take several times the size of their json text
+MEMORY_FACTOR = 4
+# what reading a malformed file raises, streamed or not
+JSON_ERRORS = (ValueError,) + ((ijson.JSONError,) if ijson != None else ())
+
+
+def require_ijson():
+    '''
+    PURPOSE: Fail before any work if the out of core mode can't stream the
+             annotation file. Without ijson the file would be loaded whole,
+             using more memory than the in-memory path rather than less
+    '''
+    if ijson == None:
+        raise ImportError('max_memory_mb streams the annotation file with ijson, install it with pip install ijson')
+
+def iter_coco_annotations(anns_path):
+    '''
+    PURPOSE: Yield the annotations of a coco file one at a time. With ijson
+             installed the file is streamed, otherwise it is loaded whole
+    IN:
+     - anns_path: str, path to coco annotation file
+    OUT: generator of annotation dicts
+    '''
+    if ijson != None:
+        with open(anns_path, 'rb') as f:
+            yield from ijson.items(f, 'annotations.item', use_float = True)
+    else:
+        with open(anns_path, 'r') as f:
+            content = json.load(f)
+        yield from content['annotations']
+
+def load_coco_head(anns_path):
+    '''
+    PURPOSE: Load everything in a coco file except the annotations, in one
+             pass that streams past them when ijson is installed
+    IN:
+     - anns_path: str, path to coco annotation file
+    OUT:
+     - head: dict, every top level item of the file, with 'annotations' left
+             empty but in its place, so files written from it keep the
+             original key order
+    '''
+    if ijson == None:
+        with open(anns_path, 'r') as f:
+            content = json.load(f)
+        if 'annotations' in content:
+            content['annotations'] = []
+        return content
+
+    head = {}
+    with open(anns_path, 'rb') as f:
+        events = ijson.parse(f, use_float = True)
+        for prefix, event, key in events:
+            if prefix != '' or event != 'map_key':
+                continue
+            # build this key's value, or skip past it for the annotations
+            builder = ijson.ObjectBuilder() if key != 'annotations' else None
+            depth = 0
+            for _, event, value in events:
+                if builder != None:
+                    builder.event(event, value)
+                if event in ('start_map', 'start_array'):
+                    depth += 1
+                elif event in ('end_map', 'end_array'):
+                    depth -= 1
+                if depth == 0:
+                    break
+            head[key] = builder.value if builder != None else []
+    return head
+
+def write_annotation_variants(ann_contents, out_paths, annotation_sets):
+    '''
+    PURPOSE: Write several coco files which differ only in their annotations
+             with a single pass over the annotations, rather than building and
+             dumping a full copy of the dataset for each file. Annotations may
+             come from a generator, so they are never all held in memory
+    IN:
+     - ann_contents: dict, coco contents whose other sections are shared,
+                     the annotations are written where its 'annotations' key
+                     is, or last
+     - out_paths: list of strs, one output path per variant
+     - annotation_sets: iterable, yields one list of annotations per
+                        annotation, holding that annotation for each variant
+    OUT: None, the files are written to out_paths
+    '''
+    # everything but the annotations is serialized once and shared, split
+    # around the annotations so the output matches json.dump of the contents
+    keys = list(ann_contents.keys())
+    at = keys.index('annotations') if 'annotations' in keys else len(keys)
+    items = [json.dumps(k) + ': ' + json.dumps(ann_contents[k]) for k in keys if k != 'annotations']
+    prefix = '{' + ''.join(i + ', ' for i in items[:at]) + '"annotations": ['
+    suffix = ']' + ''.join(', ' + i for i in items[at:]) + '}'
+
+    handles = []
+    try:
+        for fp in out_paths:
+            if os.path.exists(fp):
+                os.remove(fp)
+            f = open(fp, 'w')
+            f.write(prefix)
+            handles.append(f)
+
+        for n, variants in enumerate(annotation_sets):
+            for f, a in zip(handles, variants):
+                if n > 0:
+                    f.write(', ')
+                f.write(json.dumps(a, default = materialize))
+
+        for f in handles:
+            f.write(suffix)
+    finally:
+        for f in handles:
+            f.close()
+
+    return
+
+
+class ImagePartitioner:
+    '''
+    PURPOSE: External memory group-by-image for annotations in any order.
+             Annotations are spilled to on-disk partitions by image id, and
+             replayed one partition, then one image, at a time, so per-image
+             transforms run in bounded memory
+    IN:
+     - max_memory_mb: int, rough memory cap for buffering and for replaying
+                      one partition
+     - expected_bytes: int, optional, size of the annotation json (e.g. the
+                       file size), used to pick the number of partitions
+     - n_partitions: int, optional, overrides the number of partitions
+     - tmp_dir: str, optional, where the partition files go
+    '''
+    def __init__(self, max_memory_mb = 512, expected_bytes = None, n_partitions = None, tmp_dir = None):
+        self.max_bytes = max_memory_mb * 1e6
+        if n_partitions == None:
+            if expected_bytes == None:
+                n_partitions = 64
+            else:
+                n_partitions = max(1, math.ceil(expected_bytes * MEMORY_FACTOR / self.max_bytes))
+        self.n_partitions = n_partitions
+        self.dir = tempfile.mkdtemp(prefix = 'coco_partitions_', dir = tmp_dir)
+        self.buffers = [[] for _ in range(n_partitions)]
+        self.buffered_bytes = 0
+        # annotations per image, small enough to keep in memory
+        self.counts = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if os.path.exists(self.dir):
+            shutil.rmtree(self.dir)
+
+    def _partition(self, im_id):
+        if isinstance(im_id, int):
+            return im_id % self.n_partitions
+        return zlib.crc32(str(im_id).encode()) % self.n_partitions
+
+    def _path(self, n):
+        return os.path.join(self.dir, f'{n}.jsonl')
+
+    def add(self, a):
+        '''
+        IN:
+         - a: dict, one annotation
+        '''
+        im_id = a['image_id']
+        # the image id leads each line so replays can skip without parsing
+        line = json.dumps(im_id) + '\t' + json.dumps(a, default = materialize) + '\n'
+        self.buffers[self._partition(im_id)].append(line)
+        self.buffered_bytes += len(line)
+        self.counts[im_id] = self.counts.get(im_id, 0) + 1
+        if self.buffered_bytes * MEMORY_FACTOR > self.max_bytes / 2:
+            self.flush()
+
+    def add_all(self, annotations):
+        '''
+        IN:
+         - annotations: iterable of annotation dicts
+        OUT:
+         - self, for chaining
+        '''
+        for a in annotations:
+            self.add(a)
+        return self
+
+    def flush(self):
+        for n, lines in enumerate(self.buffers):
+            if lines:
+                with open(self._path(n), 'a') as f:
+                    f.writelines(lines)
+                self.buffers[n] = []
+        self.buffered_bytes = 0
+
+    def iter_groups(self, image_ids = None):
+        '''
+        PURPOSE: Replay the annotations grouped by image. Within an image,
+                 annotations keep the order they were added in
+        IN:
+         - image_ids: set, optional, only replay these images
+        OUT: generator of (image id, list of annotations)
+        '''
+        self.flush()
+        for n in range(self.n_partitions):
+            if not os.path.exists(self._path(n)):
+                continue
+            groups = {}
+            with open(self._path(n), 'r') as f:
+                for line in f:
+                    key, ann = line.split('\t', 1)
+                    im_id = json.loads(key)
+                    if image_ids != None and im_id not in image_ids:
+                        continue
+                    groups.setdefault(im_id, []).append(json.loads(ann))
+            yield from groups.items()
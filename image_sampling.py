@@ -0,0 +1,153 @@
+import numpy as np
+
+# shift directions, as named by plan_image_shifts
+VERTICAL = ['up', 'down', 'centered']
+HORIZONTAL = ['left', 'right', 'centered']
+STRATA = ['gsd', 'category']
+
+
+def gsd_strata(gsds, n_buckets = 4):
+    '''
+    PURPOSE: Bucket images by GSD quantile
+    IN:
+     - gsds: numpy float array, one GSD per image, nan where it is missing
+     - n_buckets: int, number of quantile buckets
+    OUT:
+     - labels: numpy int array, bucket 0 to n_buckets - 1 per image, with
+               images without a GSD in bucket n_buckets
+    '''
+    labels = np.full(len(gsds), n_buckets)
+    known = ~np.isnan(gsds)
+    if known.any():
+        edges = np.quantile(gsds[known], np.linspace(0, 1, n_buckets + 1)[1:-1])
+        labels[known] = np.searchsorted(edges, gsds[known], side = 'right')
+    return labels
+
+def dominant_categories(image_ids, ann_image_ids, ann_category_ids):
+    '''
+    PURPOSE: Find the most common category on each image, ties going to the
+             lower category id
+    IN:
+     - image_ids: list of image ids
+     - ann_image_ids, ann_category_ids: lists or numpy arrays, one entry per
+                                        annotation, category ids of any one
+                                        sortable type (ints or strs)
+    OUT:
+     - dominant: numpy int array, per image the position of its most common
+                 category among the sorted category ids, -1 for images
+                 without annotations
+    '''
+    dominant = np.full(len(image_ids), -1)
+    if len(ann_image_ids) == 0:
+        return dominant
+    position = {im_id: n for n, im_id in enumerate(image_ids)}
+    im_index = np.array([position.get(i, -1) for i in ann_image_ids])
+    # category ids are kept as they are, and only their sorted positions used
+    _, cats = np.unique(np.asarray(ann_category_ids), return_inverse = True)
+    cats = cats.reshape(-1)
+    on_image = im_index >= 0
+    if not on_image.any():
+        return dominant
+
+    pairs, counts = np.unique(np.stack([im_index[on_image], cats[on_image]], axis = 1), axis = 0, return_counts = True)
+    # per image, highest count first, then lowest category id
+    ordered = np.lexsort((pairs[:, 1], -counts, pairs[:, 0]))
+    first = np.r_[True, np.diff(pairs[ordered, 0]) != 0]
+    dominant[pairs[ordered, 0][first]] = pairs[ordered, 1][first]
+    return dominant
+
+def nested_order(strata, rng):
+    '''
+    PURPOSE: Order images so that every prefix is a stratified sample. Each
+             image's key is (rank in its stratum + 0.5) / stratum size, over a
+             random ranking within each stratum, so taking the first k images
+             takes close to the same share of every stratum, and a smaller
+             selection is always a subset of a larger one
+    IN:
+     - strata: numpy int array, stratum label per image
+     - rng: numpy Generator
+    OUT:
+     - order: numpy int array, image indexes in selection order
+    '''
+    n = len(strata)
+    perm = rng.permutation(n)
+    grouped = perm[np.argsort(strata[perm], kind = 'stable')]
+    _, starts, sizes = np.unique(strata[grouped], return_index = True, return_counts = True)
+    size = np.repeat(sizes, sizes)
+    rank = np.arange(n) - np.repeat(starts, sizes)
+    key = (rank + 0.5) / size
+    tiebreak = rng.random(n)
+    return grouped[np.lexsort((tiebreak, key))]
+
+def image_shift_draws(images, gsd_lookup, avg_img_gsd, shift_meters = 5, random_amount = False, seed = None,
+                      stratify = None, gsd_buckets = 4, ann_image_ids = None, ann_category_ids = None):
+    '''
+    PURPOSE: Draw, once, the order images are selected in and every image's
+             shift amount and direction. Selections for different shift
+             percentages taken from the same draws are nested and give an
+             image the same shift in each
+    IN:
+     - images: list of coco image dicts
+     - gsd_lookup: dict, image id to GSD from image_gsd_lookup
+     - avg_img_gsd: float, GSD used for images without one
+     - shift_meters, random_amount: see convert_anns_centerpoint_meters
+     - seed: int, optional, seed for the draws
+     - stratify: list, optional, any of 'gsd' and 'category' to stratify by
+                 GSD bucket and/or the image's most common category
+     - gsd_buckets: int, number of GSD quantile buckets
+     - ann_image_ids, ann_category_ids: lists or numpy arrays, one entry per
+                                        annotation, needed to stratify by category
+    OUT:
+     - draws: dict with 'ids' (image ids), 'order' (image indexes in
+              selection order), 'shift', 'vertical' and 'horizontal' (per
+              image)
+    '''
+    rng = np.random.default_rng(seed)
+    ids = [i['id'] for i in images]
+    gsds = np.array([gsd_lookup.get(i) or np.nan for i in ids], dtype = float)
+
+    labels = []
+    for s in stratify or []:
+        if s == 'gsd':
+            labels.append(gsd_strata(gsds, gsd_buckets))
+        elif s == 'category':
+            labels.append(dominant_categories(ids, ann_image_ids, ann_category_ids))
+        else:
+            raise ValueError(f'Unknown stratum: {s}, use one of {STRATA}')
+    if labels:
+        _, strata = np.unique(np.stack(labels, axis = 1), axis = 0, return_inverse = True)
+        strata = strata.reshape(-1)
+    else:
+        strata = np.zeros(len(ids), dtype = int)
+
+    # shifts in pixels, from each image's GSD or the average
+    max_shift = shift_meters / np.where(np.isnan(gsds), avg_img_gsd, gsds)
+    if random_amount:
+        shift = rng.integers(1, np.maximum(max_shift.astype(int), 1) + 1)
+    else:
+        shift = max_shift
+
+    return {'ids': ids,
+            'order': nested_order(strata, rng),
+            'shift': shift,
+            'vertical': rng.integers(0, len(VERTICAL), len(ids)),
+            'horizontal': rng.integers(0, len(HORIZONTAL), len(ids))}
+
+def select_shifts(draws, images, percentage_shift = 100):
+    '''
+    PURPOSE: Take the images to shift for one shift percentage from the draws
+    IN:
+     - draws: dict, from image_shift_draws on these images
+     - images: list of coco image dicts
+     - percentage_shift: int, 0-100, percentage of images to shift
+    OUT:
+     - shifts, images_regular: as from plan_image_shifts
+    '''
+    split_point = int(len(images) * percentage_shift / 100)
+    shift = draws['shift'].tolist()
+
+    shifts = {}
+    for n in draws['order'][:split_point].tolist():
+        shifts[images[n]['id']] = (shift[n], VERTICAL[draws['vertical'][n]], HORIZONTAL[draws['horizontal'][n]])
+    images_regular = [images[n] for n in draws['order'][split_point:].tolist()]
+    return shifts, images_regular
@@ -0,0 +1,340 @@
+import json
+import os
+import shutil
+import tempfile
+import argparse
+from image_partitions import iter_coco_annotations, load_coco_head
+
+# measured throughput of earlier runs, used to project runtimes
+CALIBRATION_FP = os.path.join(os.path.expanduser('~'), '.coco_scripts_throughput.json')
+# used until a real run has measured this machine
+DEFAULT_THROUGHPUT = {'copy_bytes_per_s': 100e6,
+                      'json_read_bytes_per_s': 50e6,
+                      'json_write_bytes_per_s': 10e6,
+                      'geo_error_anns_per_s': 20000}
+# annotations serialized to estimate the size of json output
+SAMPLE_SIZE = 1000
+
+
+def load_calibration(calibration_fp = CALIBRATION_FP):
+    '''
+    OUT:
+     - throughput: dict, rate name to the last measured rate, or the default
+     - measured: set of the rate names which were measured on this machine
+    '''
+    measured = {}
+    if os.path.exists(calibration_fp):
+        try:
+            with open(calibration_fp, 'r') as f:
+                measured = json.load(f)
+        except ValueError:
+            measured = {}
+    throughput = dict(DEFAULT_THROUGHPUT)
+    throughput.update(measured)
+    return throughput, set(measured)
+
+def record_throughput(name, amount, seconds, calibration_fp = CALIBRATION_FP):
+    '''
+    PURPOSE: Store a rate measured by a real run for later plans. Tiny
+             measurements are skipped as they are mostly overhead, and a
+             failure to write never stops the run
+    IN:
+     - name: str, one of the keys of DEFAULT_THROUGHPUT
+     - amount: number of bytes or annotations processed
+     - seconds: float, time taken
+    '''
+    if seconds < 0.5 or amount <= 0:
+        return
+    try:
+        with open(calibration_fp, 'r') as f:
+            rates = json.load(f)
+    except (OSError, ValueError):
+        rates = {}
+    rates[name] = amount / seconds
+    try:
+        with open(calibration_fp + '.part', 'w') as f:
+            json.dump(rates, f)
+        os.replace(calibration_fp + '.part', calibration_fp)
+    except OSError:
+        pass
+
+def estimate_json_bytes(head, images, annotations, n_annotations = None, indent = None):
+    '''
+    PURPOSE: Estimate the size of a coco file from its head and a sample of
+             its annotations, without serializing all of them
+    IN:
+     - head: dict, coco contents other than images and annotations
+     - images: list of the image dicts which will be written
+     - annotations: list, a sample of the annotations which will be written
+     - n_annotations: int, number of annotations which will be written,
+                      defaults to len(annotations)
+     - indent: int, indent the file will be written with
+    OUT:
+     - n_bytes: int
+    '''
+    if n_annotations == None:
+        n_annotations = len(annotations)
+    head = {k: v for k, v in head.items() if k not in ('images', 'annotations')}
+    n_bytes = len(json.dumps(head, indent = indent))
+
+    # samples are nested as deep as in the file, so indents are counted right
+    sample = images[:SAMPLE_SIZE]
+    if sample:
+        per_image = len(json.dumps({'images': sample}, indent = indent)) / len(sample)
+        n_bytes += int(per_image * len(images))
+
+    sample = annotations[:SAMPLE_SIZE]
+    if sample:
+        per_ann = len(json.dumps({'annotations': sample}, indent = indent)) / len(sample)
+        n_bytes += int(per_ann * n_annotations)
+    return n_bytes
+
+def estimate_spill_bytes(annotations, n_annotations):
+    '''
+    PURPOSE: Estimate what an ImagePartitioner spills to its temp directory,
+             which is every annotation, one line each
+    IN:
+     - annotations: list, a sample of the annotations
+     - n_annotations: int, number of annotations partitioned
+    OUT:
+     - n_bytes: int
+    '''
+    sample = annotations[:SAMPLE_SIZE]
+    if not sample:
+        return 0
+    per_ann = sum(len(json.dumps(a['image_id']) + '\t' + json.dumps(a) + '\n') for a in sample) / len(sample)
+    return int(per_ann * n_annotations)
+
+def _existing(path):
+    # the nearest existing parent of a path which may not exist yet
+    path = os.path.abspath(path)
+    while not os.path.exists(path):
+        path = os.path.dirname(path)
+    return path
+
+def free_bytes(path):
+    '''
+    OUT: free bytes on the disk path is (or will be) on
+    '''
+    return shutil.disk_usage(_existing(path)).free
+
+def _dir_bytes(path):
+    if not os.path.isdir(path):
+        return 0
+    return sum(e.stat().st_size for e in os.scandir(path) if e.is_file())
+
+def _copy_plan(images, img_fp, dst_dir, resume):
+    '''
+    PURPOSE: Size the image copies of materialize_dataset from stat alone
+    OUT:
+     - n_bytes: int, total size of the images
+     - to_copy: int, bytes still to copy, less than n_bytes when resuming
+                over images already in place
+     - reclaimed: int, bytes of earlier output removed before copying
+     - overhead: int, rough size of the manifest and journal
+    '''
+    n_bytes = to_copy = overhead = 0
+    for i in images:
+        src = img_fp + i['file_name']
+        dst = dst_dir + 'images/' + i['file_name']
+        size = os.stat(src).st_size
+        n_bytes += size
+        if not (resume and os.path.exists(dst) and os.path.getsize(dst) == size):
+            to_copy += size
+        overhead += 2 * (len(src) + len(dst) + 80)
+    reclaimed = 0 if resume else _dir_bytes(dst_dir + 'images/')
+    return n_bytes, to_copy, reclaimed, overhead
+
+def plan_full_scene(cat_id, ann_fp, img_fp, seed = None, resume = False, max_memory_mb = None, calibration_fp = CALIBRATION_FP):
+    '''
+    PURPOSE: Work out what full_scene_vs_single_class.main would do, using the
+             annotations and image file sizes from stat, without copying or
+             writing anything. Without a seed the full scene selection is one
+             random draw, so its counts vary from run to run
+    IN:
+     - cat_id, ann_fp, img_fp, seed, resume, max_memory_mb: see 
+       full_scene_vs_single_class.main
+    OUT:
+     - plan: dict, see print_plan
+    '''
+    # imported here as full_scene_vs_single_class imports this module
+    import full_scene_vs_single_class as full_scene
+
+    head = load_coco_head(ann_fp)
+    ann_counts = {}
+    anns_1c = []
+    sample = []
+    for a in iter_coco_annotations(ann_fp):
+        ann_counts[a['image_id']] = ann_counts.get(a['image_id'], 0) + 1
+        if a['category_id'] == cat_id:
+            anns_1c.append(a)
+        if len(sample) < SAMPLE_SIZE:
+            sample.append(a)
+
+    cats = [c for c in head['categories'] if c['id'] == cat_id]
+    if not anns_1c or not cats:
+        raise ValueError(f'There are no annotations of category {cat_id} in the dataset')
+    on_cat = set(a['image_id'] for a in anns_1c)
+    ims_1c = [i for i in head['images'] if i['id'] in on_cat]
+    head_1c = dict(head, categories = cats)
+
+    ### experiment folders, as main names them
+    exp_dir_1c = full_scene.single_cat_exp_dir(ann_fp, cats[0]['name'].replace(' ', '-'))
+    exp_dir_mc = full_scene.full_scene_exp_dir(exp_dir_1c + ann_fp.split('/')[-1])
+
+    ### the full scene selection, drawn as main draws it
+    ims_options = list(ims_1c)
+    full_scene.full_scene_order(ims_options, seed, exp_dir_mc + 'manifest.json' if resume else None)
+    ims_mc = full_scene.select_full_scene_images(ims_options, ann_counts, len(anns_1c))
+    n_anns_mc = sum(ann_counts.get(i['id'], 0) for i in ims_mc)
+
+    experiments = []
+    for name, exp_dir, images, n_anns, ann_sample, exp_head in [
+            ('single_class', exp_dir_1c, ims_1c, len(anns_1c), anns_1c, head_1c),
+            ('full_scene', exp_dir_mc, ims_mc, n_anns_mc, sample, head)]:
+        # the full scene images are copied from the single class folder, which
+        # holds the same files
+        n_bytes, to_copy, reclaimed, overhead = _copy_plan(images, img_fp, exp_dir, resume)
+        experiments.append({'name': name, 'dir': exp_dir, 'images': len(images), 'annotations': n_anns,
+                            'copy_bytes': n_bytes, 'bytes_to_copy': to_copy,
+                            'json_bytes': estimate_json_bytes(exp_head, images, ann_sample, n_anns, indent = 3),
+                            'reclaimed_bytes': reclaimed, 'overhead_bytes': overhead})
+
+    throughput, measured = load_calibration(calibration_fp)
+    to_copy = sum(e['bytes_to_copy'] for e in experiments)
+    json_bytes = sum(e['json_bytes'] for e in experiments)
+    # the full file is read twice and the single class file once
+    read_bytes = 2 * os.path.getsize(ann_fp) + experiments[0]['json_bytes']
+    seconds = (to_copy / throughput['copy_bytes_per_s'] + read_bytes / throughput['json_read_bytes_per_s']
+               + json_bytes / throughput['json_write_bytes_per_s'])
+    needed = sum(e['bytes_to_copy'] + e['json_bytes'] + e['overhead_bytes'] - e['reclaimed_bytes'] for e in experiments)
+
+    spill = estimate_spill_bytes(sample, sum(ann_counts.values())) if max_memory_mb else 0
+
+    return _finish_plan({'run': 'full_scene_vs_single_class', 'selection': 'seeded' if seed != None else 'one random draw',
+                         'experiments': experiments, 'seconds': seconds,
+                         'calibrated': {'copy_bytes_per_s', 'json_read_bytes_per_s', 'json_write_bytes_per_s'} <= measured},
+                        exp_dir_1c, needed, spill)
+
+def plan_geo_error(anns_path, shift_meters = 5, percentage_shift = 100, max_memory_mb = None, calibration_fp = CALIBRATION_FP):
+    '''
+    PURPOSE: Work out what bboxes_to_centerpoints_geo_error would write
+             without running it. It writes a centerpoint file and a square box
+             file next to the input for each shift percentage, and rewrites 
+             the input in place with the category sizes added
+    IN:
+     - anns_path, shift_meters, max_memory_mb: see convert_anns_centerpoint_meters
+     - percentage_shift: int, or list of ints for a sweep
+    OUT:
+     - plan: dict, see print_plan
+    '''
+    percentages = percentage_shift if isinstance(percentage_shift, list) else [percentage_shift]
+    head = load_coco_head(anns_path)
+    n_anns = 0
+    raw = []
+    sample = []
+    for a in iter_coco_annotations(anns_path):
+        n_anns += 1
+        if len(sample) < SAMPLE_SIZE:
+            raw.append(a)
+            # the centerpoint file adds an object center to every annotation
+            x1, y1, w, h = a['bbox']
+            sample.append(dict(a, object_center = [x1 + int(w/2), y1 + int(h/2)]))
+
+    n_images = len(head['images'])
+    json_bytes = estimate_json_bytes(head, head['images'], sample, n_anns)
+
+    experiments = []
+    for p in percentages:
+        cp_fp = anns_path.split('.')[0] + f'_cp_{shift_meters}_meters_{p}_percent.json'
+        reclaimed = 0
+        for fp in [cp_fp, cp_fp.split('.')[0] + '_square.json']:
+            if os.path.exists(fp):
+                reclaimed += os.path.getsize(fp)
+        experiments.append({'name': f'geo_error_{p}_percent', 'dir': os.path.dirname(os.path.abspath(anns_path)) + '/',
+                            'images': n_images, 'shifted_images': int(n_images * p / 100),
+                            'annotations': n_anns, 'copy_bytes': 0, 'bytes_to_copy': 0,
+                            'json_bytes': 2 * json_bytes, 'reclaimed_bytes': reclaimed, 'overhead_bytes': 0})
+
+    throughput, measured = load_calibration(calibration_fp)
+    seconds = len(percentages) * n_anns / throughput['geo_error_anns_per_s']
+    needed = sum(e['json_bytes'] - e['reclaimed_bytes'] for e in experiments)
+
+    spill = estimate_spill_bytes(raw, n_anns) if max_memory_mb else 0
+
+    return _finish_plan({'run': 'bboxes_to_centerpoints_geo_error', 'experiments': experiments, 'seconds': seconds,
+                         'calibrated': 'geo_error_anns_per_s' in measured},
+                        anns_path, needed, spill)
+
+def _finish_plan(plan, dst, needed, spill = 0):
+    '''
+    PURPOSE: Check the plan fits on disk. Partitions spilled with
+             max_memory_mb go to the temp directory and are there while the
+             outputs are written, so they count against the destination
+             when both are on one disk, and against the temp disk otherwise
+    '''
+    plan['needed_bytes'] = max(needed, 0)
+    plan['free_bytes'] = free_bytes(dst)
+    plan['fits'] = plan['needed_bytes'] <= plan['free_bytes']
+    plan['spill_bytes'] = spill
+    if spill:
+        spill_dir = tempfile.gettempdir()
+        plan['spill_dir'] = spill_dir
+        if os.stat(spill_dir).st_dev == os.stat(_existing(dst)).st_dev:
+            plan['needed_bytes'] += spill
+            plan['fits'] = plan['needed_bytes'] <= plan['free_bytes']
+        else:
+            plan['spill_free_bytes'] = free_bytes(spill_dir)
+            plan['fits'] = plan['fits'] and spill <= plan['spill_free_bytes']
+    return plan
+
+def _size(n_bytes):
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if abs(n_bytes) < 1000:
+            return f'{n_bytes:.1f} {unit}'
+        n_bytes /= 1000
+    return f'{n_bytes:.1f} TB'
+
+def print_plan(plan):
+    '''
+    IN:
+     - plan: dict, from plan_full_scene or plan_geo_error
+    OUT: None, the plan is printed
+    '''
+    print(f'Plan for {plan["run"]}' + (f' ({plan["selection"]})' if 'selection' in plan else ''))
+    for e in plan['experiments']:
+        print(f' {e["name"]}: {e["dir"]}')
+        print(f' - images: {e["images"]}')
+        if 'shifted_images' in e:
+            print(f' - shifted images: {e["shifted_images"]}')
+        print(f' - annotations: {e["annotations"]}')
+        if e['copy_bytes']:
+            print(f' - image copies: {_size(e["copy_bytes"])} ({_size(e["bytes_to_copy"])} still to copy)')
+        print(f' - estimated annotation output: {_size(e["json_bytes"])}')
+    basis = 'measured' if plan['calibrated'] else 'default, not yet measured on this machine'
+    print(f' projected runtime: {plan["seconds"] / 60:.1f} minutes (throughput {basis})')
+    if plan.get('spill_bytes'):
+        print(f' out of core partitions: {_size(plan["spill_bytes"])} in {plan["spill_dir"]}'
+              + (', on the destination disk' if 'spill_free_bytes' not in plan else f', free: {_size(plan["spill_free_bytes"])}'))
+    print(f' disk needed: {_size(plan["needed_bytes"])}, free: {_size(plan["free_bytes"])}')
+    if plan['needed_bytes'] > plan['free_bytes']:
+        print(' ERROR: not enough free disk space at the destination')
+    if plan.get('spill_bytes', 0) > plan.get('spill_free_bytes', float('inf')):
+        print(f' ERROR: not enough free disk space in the temp directory {plan["spill_dir"]} for the partitions')
+    return
+
+
+if __name__ == "__main__":
+
+    # Initialize parser
+    parser = argparse.ArgumentParser()
+    # Adding optional argument
+    parser.add_argument("-calibration_fp", "--calibration_fp", help = "str, file of measured throughput to show", required = False, default = CALIBRATION_FP)
+
+    # Read arguments from command line
+    args = parser.parse_args()
+
+    # show the throughput plans project runtimes with
+    throughput, measured = load_calibration(args.calibration_fp)
+    for k, v in throughput.items():
+        print(f'{k}: {v:.0f} ({"measured" if k in measured else "default"})')
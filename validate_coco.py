@@ -0,0 +1,335 @@
+import json
+import os
+import sys
+import numpy as np
+import argparse
+from image_metadata import image_metadata
+from image_partitions import iter_coco_annotations, load_coco_head, JSON_ERRORS
+
+# the only annotation fields validation reads
+CHECKED_FIELDS = ['id', 'image_id', 'category_id', 'bbox']
+
+
+def _examples(values, limit = 5):
+    '''
+    IN:
+     - values: iterable of ids
+     - limit: int, how many to show
+    OUT: str, a short listing of the first few ids for a report line
+    '''
+    values = list(values)
+    shown = ', '.join(str(v) for v in values[:limit])
+    if len(values) > limit:
+        shown += f', ... ({len(values)} total)'
+    return shown
+
+def _duplicates(ids):
+    '''
+    IN:
+     - ids: numpy array of ids
+    OUT: numpy array of ids which appear more than once
+    '''
+    uniq, counts = np.unique(ids, return_counts = True)
+    return uniq[counts > 1]
+
+def _is_number(v):
+    '''
+    IN:
+     - v: a json value
+    OUT: boolean, whether it is a json number (booleans aren't)
+    '''
+    return isinstance(v, (int, float)) and not isinstance(v, bool)
+
+def image_gsd_array(images):
+    '''
+    PURPOSE: Pull every image's GSD into one array, the same way
+             get_im_gsd_from_id reads it, with nan where there isn't one
+    IN:
+     - images: list of coco image dicts
+    OUT:
+     - gsd: numpy float array, one GSD per image (nan if missing)
+     - malformed: list of image ids whose acquisition_data has no GSD list
+    '''
+    gsd = np.full(len(images), np.nan)
+    malformed = []
+    for n, i in enumerate(images):
+        if 'acquisition_data' not in i:
+            continue
+        try:
+            val = i['acquisition_data']['GSD'][0]
+        except (KeyError, IndexError, TypeError):
+            malformed.append(i.get('id'))
+            continue
+        if val != None:
+            try:
+                gsd[n] = float(val)
+            except (TypeError, ValueError):
+                malformed.append(i.get('id'))
+    return gsd, malformed
+
+def validate_coco_content(content, require_gsd = False, avg_img_gsd = None,
+                          require_average_size = False, require_size_estimates = False,
+                          img_dir = None, cat_id = None, sized_categories = None, gsd_lookup = None):
+    '''
+    PURPOSE: Check a coco dataset for the problems that otherwise make long
+             runs fail partway through: missing sections or fields, duplicate
+             ids, annotations pointing at images or categories that don't
+             exist, missing or invalid GSDs, and missing category sizes
+    IN:
+     - content: dict, contents of a coco file
+     - require_gsd: boolean, whether images without a GSD are errors rather
+                    than warnings (they'd otherwise use the average GSD)
+     - avg_img_gsd: float, optional, the fallback GSD the run will use
+     - require_average_size: boolean, whether every category needs the
+                             average_size written by estimate_category_size
+     - require_size_estimates: boolean, whether categories whose size
+                               estimate_category_size can't estimate are
+                               errors rather than warnings
+     - img_dir: str, optional, directory the image files should be in,
+                joined to file names as the runs join them (img_dir +
+                file_name), so give it with its trailing slash
+     - cat_id: int, optional, category the run focuses on. It must have
+               annotations, and only its images are checked in img_dir
+     - sized_categories: list, optional, ids of the categories the run will
+                         have sizes for, when they come from another file
+                         (the 'sized_categories' of its report). Annotations
+                         of any other category are errors
+     - gsd_lookup: dict, optional, image id to the GSD the run will use for
+                   images without one in the file, such as those read from
+                   the image headers
+    OUT:
+     - report: dict with 'counts', 'errors' and 'warnings', and once the
+               annotations are checked, 'sized_categories', the ids of the
+               categories whose size can be estimated from this file
+    '''
+    errors = []
+    warnings = []
+
+    missing = [k for k in ['images', 'annotations', 'categories'] if k not in content]
+    if missing:
+        errors.append(f'Missing top level sections: {", ".join(missing)}')
+        return {'counts': {}, 'errors': errors, 'warnings': warnings}
+
+    images = content['images']
+    anns = content['annotations']
+    cats = content['categories']
+
+    counts = {'images': len(images), 'annotations': len(anns), 'categories': len(cats)}
+
+    # required fields, checked once per section so every other check can
+    # work on whole arrays
+    required = [('images', images, ['id', 'file_name']),
+                ('annotations', anns, ['id', 'image_id', 'category_id', 'bbox']),
+                ('categories', cats, ['id', 'name'])]
+    for section, records, fields in required:
+        for field in fields:
+            lacking = [n for n, r in enumerate(records) if field not in r]
+            if lacking:
+                errors.append(f'{len(lacking)} {section} missing "{field}" (positions {_examples(lacking)})')
+    if errors:
+        return {'counts': counts, 'errors': errors, 'warnings': warnings}
+
+    im_ids = np.array([i['id'] for i in images])
+    ann_ids = np.array([a['id'] for a in anns])
+    cat_ids = np.array([c['id'] for c in cats])
+    ann_im_ids = np.array([a['image_id'] for a in anns])
+    ann_cat_ids = np.array([a['category_id'] for a in anns])
+
+    # duplicate ids
+    for section, ids in [('image', im_ids), ('annotation', ann_ids), ('category', cat_ids)]:
+        dups = _duplicates(ids)
+        if len(dups):
+            errors.append(f'{len(dups)} duplicate {section} ids: {_examples(dups)}')
+
+    # referential integrity
+    dangling = ~np.isin(ann_im_ids, im_ids)
+    if dangling.any():
+        errors.append(f'{dangling.sum()} annotations reference missing images: {_examples(np.unique(ann_im_ids[dangling]))}')
+    dangling = ~np.isin(ann_cat_ids, cat_ids)
+    if dangling.any():
+        errors.append(f'{dangling.sum()} annotations reference missing categories: {_examples(np.unique(ann_cat_ids[dangling]))}')
+
+    # bounding boxes
+    bad_shape = [a['id'] for a in anns if not isinstance(a['bbox'], list) or len(a['bbox']) != 4]
+    if bad_shape:
+        errors.append(f'{len(bad_shape)} annotations without a 4 value bbox: {_examples(bad_shape)}')
+    bad_values = [a['id'] for a in anns if isinstance(a['bbox'], list) and len(a['bbox']) == 4 
+                  and not all(_is_number(v) for v in a['bbox'])]
+    if bad_values:
+        errors.append(f'{len(bad_values)} annotations with a bbox value that isn\'t a number: {_examples(bad_values)}')
+    if len(anns) and not bad_shape and not bad_values:
+        bboxes = np.array([a['bbox'] for a in anns], dtype = float)
+        bad_size = ~np.isfinite(bboxes).all(axis = 1) | (bboxes[:, 2:] < 0).any(axis = 1)
+        if bad_size.any():
+            errors.append(f'{bad_size.sum()} annotations with a non-finite or negative bbox: {_examples(ann_ids[bad_size])}')
+
+    # image GSDs
+    gsd, malformed = image_gsd_array(images)
+    if gsd_lookup:
+        for n, i in enumerate(images):
+            if np.isnan(gsd[n]) and gsd_lookup.get(i['id']) != None:
+                gsd[n] = gsd_lookup[i['id']]
+    if malformed:
+        errors.append(f'{len(malformed)} images with acquisition_data but no usable GSD: {_examples(malformed)}')
+    invalid = np.isfinite(gsd) & (gsd <= 0)
+    if invalid.any():
+        errors.append(f'{invalid.sum()} images with a GSD of 0 or less: {_examples(im_ids[invalid])}')
+    no_gsd = np.isnan(gsd)
+    counts['images_without_gsd'] = int(no_gsd.sum())
+    if no_gsd.any():
+        message = f'{no_gsd.sum()} images have no GSD: {_examples(im_ids[no_gsd])}'
+        if require_gsd:
+            errors.append(message)
+        elif avg_img_gsd == None and no_gsd.all():
+            errors.append(message + ', and there are no GSDs to average for a fallback')
+        else:
+            warnings.append(message + ', the average GSD will be used')
+    if avg_img_gsd != None:
+        try:
+            fallback = float(avg_img_gsd)
+        except (TypeError, ValueError):
+            errors.append(f'The fallback average GSD must be a number, got {avg_img_gsd}')
+        else:
+            if not fallback > 0:
+                errors.append(f'The fallback average GSD must be positive, got {avg_img_gsd}')
+
+    # categories in use whose sizes can't be estimated, because none of their
+    # annotations are on an image with a GSD
+    measurable = np.array([], dtype = cat_ids.dtype)
+    if len(anns) and len(images):
+        order = np.argsort(im_ids, kind = 'stable')
+        pos = np.clip(np.searchsorted(im_ids[order], ann_im_ids), 0, len(im_ids) - 1)
+        ann_has_gsd = np.isfinite(gsd[order][pos]) & (im_ids[order][pos] == ann_im_ids)
+        measurable = np.unique(ann_cat_ids[ann_has_gsd])
+        used = np.unique(ann_cat_ids)
+        unmeasurable = used[~np.isin(used, measurable)]
+        if len(unmeasurable):
+            message = f'{len(unmeasurable)} categories have no annotations on images with a GSD, so their size can\'t be estimated: {_examples(unmeasurable)}'
+            if require_size_estimates:
+                errors.append(message)
+            else:
+                warnings.append(message)
+
+    # categories whose sizes come from another file
+    if sized_categories != None and len(anns):
+        used = np.unique(ann_cat_ids)
+        unsized = used[~np.isin(used, np.array(list(sized_categories), dtype = used.dtype))]
+        if len(unsized):
+            errors.append(f'{len(unsized)} categories in use won\'t have a size, they can\'t be estimated from the reference file: {_examples(unsized)}')
+
+    # category sizes
+    if require_average_size:
+        sizes = np.array([np.nan if c.get('average_size') == None else c['average_size'] for c in cats], dtype = float)
+        no_size = ~np.isfinite(sizes) | (sizes <= 0)
+        if no_size.any():
+            errors.append(f'{no_size.sum()} categories without a usable average_size: {_examples(cat_ids[no_size])}')
+
+    # the category of interest
+    check_images = images
+    if cat_id != None:
+        on_cat = np.unique(ann_im_ids[ann_cat_ids == cat_id])
+        counts['images_with_category'] = len(on_cat)
+        if not np.isin(cat_id, cat_ids):
+            errors.append(f'Category {cat_id} is not in the dataset')
+        elif not len(on_cat):
+            errors.append(f'There are no annotations of category {cat_id} in the dataset')
+        check_images = [i for i, keep in zip(images, np.isin(im_ids, on_cat)) if keep]
+
+    # image files
+    if img_dir != None:
+        absent = [i['id'] for i in check_images if not os.path.exists(img_dir + i['file_name'])]
+        if absent:
+            errors.append(f'{len(absent)} image files missing from {img_dir}: {_examples(absent)}')
+
+    return {'counts': counts, 'errors': errors, 'warnings': warnings,
+            'sized_categories': measurable[np.isin(measurable, cat_ids)].tolist()}
+
+def validate_coco(anns_path, require_gsd = False, avg_img_gsd = None,
+                  require_average_size = False, require_size_estimates = False,
+                  img_dir = None, cat_id = None, sized_categories = None, img_fp = None, stream = False,
+                  verbose = True):
+    '''
+    PURPOSE: Validate a coco file before starting an expensive transform,
+             printing a summary report
+    IN:
+     - anns_path: str, path to coco annotation file
+     - require_gsd, avg_img_gsd, require_average_size,
+       require_size_estimates, img_dir, cat_id, sized_categories: see 
+       validate_coco_content
+     - img_fp: str, optional, image directory the run reads GSDs missing
+               from the file from, see image_metadata. They're used here too
+     - stream: boolean, stream the annotations with ijson, keeping only the
+               fields checked, instead of loading the file whole
+     - verbose: boolean, whether to print the report
+    OUT:
+     - report: dict with 'counts', 'errors' and 'warnings'
+    '''
+    try:
+        if stream:
+            content = load_coco_head(anns_path)
+            if 'annotations' in content:
+                content['annotations'] = [{k: a[k] for k in CHECKED_FIELDS if k in a} 
+                                          for a in iter_coco_annotations(anns_path)]
+        else:
+            with open(anns_path, 'r') as f:
+                content = json.load(f)
+    except (OSError,) + JSON_ERRORS as e:
+        report = {'counts': {}, 'errors': [f'Could not read {anns_path}: {e}'], 'warnings': []}
+    else:
+        gsd_lookup = None
+        if img_fp and 'images' in content:
+            meta = image_metadata(content, img_fp)
+            gsd_lookup = {im_id: m['gsd'] for im_id, m in meta.items() if m.get('gsd')}
+        report = validate_coco_content(content, require_gsd = require_gsd, avg_img_gsd = avg_img_gsd,
+                                       require_average_size = require_average_size,
+                                       require_size_estimates = require_size_estimates,
+                                       img_dir = img_dir, cat_id = cat_id,
+                                       sized_categories = sized_categories, gsd_lookup = gsd_lookup)
+    if verbose:
+        print_report(anns_path, report)
+    return report
+
+def print_report(anns_path, report):
+    '''
+    IN:
+     - anns_path: str, the file the report is about
+     - report: dict, from validate_coco_content
+    OUT: None, the report is printed
+    '''
+    status = 'FAILED' if report['errors'] else 'OK'
+    print(f'Validation of {anns_path}: {status}')
+    for k, v in report['counts'].items():
+        print(f' - {k}: {v}')
+    for e in report['errors']:
+        print(f' ERROR: {e}')
+    for w in report['warnings']:
+        print(f' WARNING: {w}')
+    return
+
+
+if __name__ == "__main__":
+
+    # Initialize parser
+    parser = argparse.ArgumentParser()
+    # Adding optional argument
+    parser.add_argument("-ann_fps", "--ann_fps", nargs = '+', help = "str, File path(s) to coco annotations")
+    parser.add_argument("-img_fp", "--img_fp", help = "str, File path to images for the annotations", required = False)
+    parser.add_argument("-cat_id", "--cat_id", help = "int, COCO category id the run will focus on", required = False)
+    parser.add_argument("-avg_gsd", "--avg_gsd", help = "Average image GSD the run will use where an image doesn't have one", required = False)
+    parser.add_argument("-require_gsd", "--require_gsd", help = "Treat images without a GSD as errors", action = "store_true")
+    parser.add_argument("-require_average_size", "--require_average_size", help = "Require the average_size written by estimate_category_size", action = "store_true")
+    parser.add_argument("-require_size_estimates", "--require_size_estimates", help = "Require every category in use to have annotations on images with a GSD", action = "store_true")
+
+    # Read arguments from command line
+    args = parser.parse_args()
+
+    failed = False
+    for fp in args.ann_fps:
+        report = validate_coco(fp, require_gsd = args.require_gsd, avg_img_gsd = args.avg_gsd,
+                               require_average_size = args.require_average_size,
+                               require_size_estimates = args.require_size_estimates, 
+                               img_dir = os.path.join(args.img_fp, '') if args.img_fp else None, img_fp = args.img_fp,
+                               cat_id = int(args.cat_id) if args.cat_id else None)
+        failed = failed or bool(report['errors'])
+
+    sys.exit(1 if failed else 0)